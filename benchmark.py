@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+### Streaming benchmark
+# Times each hot path of the streaming pipeline, one packet (256 samples, or --samples_per_packet) at a time:
+#   reg_read      256 single reads of the FIFO count register, as the original reader did per sample
+#   fifo_drain    bulk drain of 256 FIFO words into a preallocated buffer
+#   pack_concat   bytes concatenation per sample, as the original create_packet() did
+#   pack_struct   one struct.pack_into() of the sequence number and 256 words
+#   pack_array    copy of the drained array('I') into a preallocated packet slot
+#   pack_numpy    NumPy view of the drained words copied into a preallocated packet slot
+#   udp_sendto    one socket.sendto() per packet
+#   udp_ring      PacketRing commit, sent in sendmmsg() batches
+#   pipeline      LinuxSDR.fill_packet() and send_packet(), the full Python streaming path
+# Each case reports samples/s, packets/s and the p50/p99 per-packet latency, and all results can be written as JSON
+# Comparing runs with larger packets, up to jumbo frames, shows how much of the cost is per packet
+# The FIFO cases drain the radio FIFO, so stop linux_sdr.py, linux_sdr_python.py and fifo_reader first; the radio
+# registers are only read, never written, so the radio keeps its tuning. The simulated radio is a file of its own
+# (BENCHMARK_SIM_PATH) that runs a packet ahead before each FIFO case's call, so the drains are of a ready FIFO
+
+import argparse
+import json
+import platform
+import socket
+import struct
+import sys
+import time
+from array import array
+from registers import open_radio, SimulatedRadio, FIFO_DATA_OFFSET, FIFO_COUNT_OFFSET
+from packet_ring import PacketRing, SAMPLES_PER_PACKET, HEADER_BYTES, MAX_SAMPLES_PER_PACKET, packet_geometry
+from startup import load_bitstreams
+
+# Define constants
+BENCHMARK_SIM_PATH = '/dev/shm/linux_sdr_benchmark_sim'
+
+
+class ReadOnlyRegisters():
+    '''
+    A register window whose writes are dropped, so the pipeline case's LinuxSDR, whose constructor sets the
+    frequencies, leaves the radio as it is
+    '''
+
+    def __init__(self, regs):
+        self.regs = regs
+        self.shadow = {}
+
+
+    def read(self, offset):
+        return self.regs.read(offset)
+
+
+    def write(self, offset, val):
+        pass
+
+
+    def write_cached(self, offset, val):
+        return False
+
+
+    def read_repeated(self, offset, buf, num_words):
+        self.regs.read_repeated(offset, buf, num_words)
+
+
+class ReadOnlyRadio():
+    '''
+    The radio backend with its radio registers read-only, the FIFO is drained as usual
+    '''
+
+    def __init__(self, radio):
+        self.radio = ReadOnlyRegisters(radio.radio)
+        self.fifo = radio.fifo
+        self.fifo_depth = radio.fifo_depth
+
+
+def time_case(func, num_packets, samples_per_packet=SAMPLES_PER_PACKET, setup=None):
+    '''
+    Calls func once per packet and times each call
+
+    Parameters:
+        func (function): processes one packet, called with the packet index
+        num_packets (int): the number of packets
+        samples_per_packet (int): the samples in each packet
+        setup (function): called with the packet index before each call, outside the timing
+
+    Returns:
+        result (dict): samples_per_s, packets_per_s, p50_us, p99_us, and packets
+    '''
+    latencies = array('q', bytes(8 * num_packets))
+    clock = time.perf_counter_ns
+    for i in range(num_packets):
+        if setup is not None:
+            setup(i)
+        before = clock()
+        func(i)
+        latencies[i] = clock() - before
+    elapsed = sum(latencies) / 1e9
+    ordered = sorted(latencies)
+    return {
+        'packets': num_packets,
+        'samples_per_s': num_packets * samples_per_packet / elapsed,
+        'packets_per_s': num_packets / elapsed,
+        'p50_us': ordered[len(ordered) // 2] / 1e3,
+        'p99_us': ordered[min(len(ordered) - 1, (99 * len(ordered)) // 100)] / 1e3,
+    }
+
+
+def make_cases(radio, dest, samples_per_packet=SAMPLES_PER_PACKET):
+    '''
+    Builds the benchmark cases
+
+    Parameters:
+        radio (object): the register backend from open_radio()
+        dest (tuple): the (ip, port) the UDP cases send to
+        samples_per_packet (int): the samples in each packet, with the legacy 2-byte header
+
+    Returns:
+        cases (dict): case name to function of the packet index, or to None if the case cannot run here
+        setups (dict): case name to the setup function to call before each timed call, for the FIFO cases on the
+                       simulated radio
+    '''
+    fifo = radio.fifo
+    _, packet_bytes = packet_geometry(samples_per_packet)
+    words = array('I', bytes(4 * samples_per_packet))
+    slot = bytearray(packet_bytes)
+    slot_words = memoryview(slot)[HEADER_BYTES:].cast('I')
+    fifo.read_repeated(FIFO_DATA_OFFSET, words, samples_per_packet)
+    samples = list(words)
+    cases = {}
+
+    def reg_read(i):
+        for _ in range(samples_per_packet):
+            fifo.read(FIFO_COUNT_OFFSET)
+    cases['reg_read'] = reg_read
+
+    def fifo_drain(i):
+        fifo.read_repeated(FIFO_DATA_OFFSET, words, samples_per_packet)
+    cases['fifo_drain'] = fifo_drain
+
+    def pack_concat(i):
+        payload_bytes = (i & 0xFFFF).to_bytes(2, 'little')
+        for samp in samples:
+            payload_bytes += (samp & 0x0000FFFF).to_bytes(2, 'little')
+            payload_bytes += ((samp & 0xFFFF0000) >> 16).to_bytes(2, 'little')
+        return payload_bytes
+    cases['pack_concat'] = pack_concat
+
+    packet_format = struct.Struct(f'<H{samples_per_packet}I')
+    def pack_struct(i):
+        packet_format.pack_into(slot, 0, i & 0xFFFF, *words)
+    cases['pack_struct'] = pack_struct
+
+    def pack_array(i):
+        struct.pack_into('<H', slot, 0, i & 0xFFFF)
+        slot_words[:] = words
+    cases['pack_array'] = pack_array
+
+    try:
+        import numpy as np
+    except ImportError:
+        cases['pack_numpy'] = None
+    else:
+        np_words = np.frombuffer(words, dtype='<u4')
+        np_slot = np.frombuffer(slot, dtype='<u4', offset=HEADER_BYTES)
+        def pack_numpy(i):
+            struct.pack_into('<H', slot, 0, i & 0xFFFF)
+            np_slot[:] = np_words
+        cases['pack_numpy'] = pack_numpy
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def udp_sendto(i):
+        sock.sendto(slot, dest)
+    cases['udp_sendto'] = udp_sendto
+
+    ring = PacketRing([dest], packet_bytes=packet_bytes)
+    def udp_ring(i):
+        ring.acquire()
+        ring.commit()
+    cases['udp_ring'] = udp_ring
+
+    from linux_sdr_python import LinuxSDR
+    sdr = LinuxSDR(udp_ip=dest[0], udp_port=dest[1], radio=ReadOnlyRadio(radio), samples_per_packet=samples_per_packet)
+    def pipeline(i):
+        sdr.send_packet(sdr.fill_packet())
+    cases['pipeline'] = pipeline
+
+    setups = {}
+    if isinstance(radio, SimulatedRadio):
+        # The simulated DDC runs at the real sample rate, make a packet ready before each drain, generating the
+        # samples here so only the drain is timed
+        def fill_fifo(i):
+            radio.advance(samples_per_packet)
+            radio.update_fifo()
+        setups = {'fifo_drain': fill_fifo, 'pipeline': fill_fifo}
+
+    return cases, setups
+
+
+def main(sim_path=None, num_packets=2000, case_names=None, json_path=None, dest=None, samples_per_packet=SAMPLES_PER_PACKET):
+    radio = open_radio(sim_path)
+
+    # Without a destination, send to a local socket that is never read, so the sends are measured on their own
+    sink = None
+    if dest is None:
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(('127.0.0.1', 0))
+        dest = sink.getsockname()
+
+    cases, setups = make_cases(radio, dest, samples_per_packet)
+    results = {
+        'backend': 'sim' if sim_path is not None else 'devmem',
+        'python': sys.version.split()[0],
+        'machine': platform.machine(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'samples_per_packet': samples_per_packet,
+        'cases': {},
+    }
+
+    print('')
+    print(f"{'case':<12} {'samples/s':>12} {'packets/s':>10} {'p50 (us)':>9} {'p99 (us)':>9}")
+    for name, func in cases.items():
+        if case_names and name not in case_names:
+            continue
+        if func is None:
+            print(f'{name:<12} skipped')
+            results['cases'][name] = None
+            continue
+        result = time_case(func, num_packets, samples_per_packet, setups.get(name))
+        results['cases'][name] = result
+        print(f"{name:<12} {result['samples_per_s']:>12.0f} {result['packets_per_s']:>10.1f} {result['p50_us']:>9.1f} {result['p99_us']:>9.1f}")
+    print('')
+
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {json_path}')
+    if sink is not None:
+        sink.close()
+    return results
+
+
+if __name__ == '__main__':
+    description = "Streaming benchmark - Times register reads, FIFO drains, payload packing, and UDP sends per packet against the radio registers or a simulated radio"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-n', '--packets', type=int, help='Packets timed per case', default=2000)
+    parser.add_argument('-c', '--cases', nargs='*', help='Cases to run (default all): reg_read fifo_drain pack_concat pack_struct pack_array pack_numpy udp_sendto udp_ring pipeline', default=None)
+    parser.add_argument('-s', '--samples_per_packet', type=int, help=f'Samples per packet, up to {MAX_SAMPLES_PER_PACKET} with a 9000-byte MTU', default=SAMPLES_PER_PACKET)
+    parser.add_argument('-j', '--json', help='Write the results as JSON to this file', default=None)
+    parser.add_argument('-d', '--dest_ip_addr', help='Destination IP address of the UDP cases (default: a local sink socket)', default=None)
+    parser.add_argument('-p', '--port', type=int, help='Destination UDP port of the UDP cases', default=25344)
+    parser.add_argument('--sim', nargs='?', const=BENCHMARK_SIM_PATH, help='Run against a simulated radio backed by the given file instead of /dev/mem, not one a reader is streaming from', default=None)
+    parser.add_argument('--force', action='store_true', help='Reload the FPGA images even if they are already loaded')
+    args = parser.parse_args()
+
+    if (args.sim is None):
+        # Load FPGA images
+        load_bitstreams(force=args.force)
+
+    dest = (args.dest_ip_addr, args.port) if args.dest_ip_addr is not None else None
+    main(args.sim, args.packets, args.cases, args.json, dest, args.samples_per_packet)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+### Polyphase channelizer
+# Streaming split of the radio's complex baseband (48828.125 Hz after filter_2) into M evenly spaced sub-channels,
+# and further decimation of a stream for narrowband consumers
+#   PolyphaseChannelizer   M-channel analysis filter bank: one prototype lowpass of M * taps_per_channel taps split
+#                          into M polyphase branches, whose outputs one M-point FFT turns into all M channels at once.
+#                          Channel k is centered at k * fs / M (channels above M / 2 are the negative frequencies, as
+#                          np.fft.fftfreq orders them) and comes out at fs / decimation, where decimation is M
+#                          (critically sampled) or a divisor of M (oversampled, so the channel edges do not alias)
+#   Decimator              decimate-by-D lowpass FIR for one complex stream, or every channel of a channelizer at once
+# Both keep the input samples their filters still need between calls, so a stream can be fed a packet (or any number of
+# samples) at a time with exactly the output of filtering it in one piece: there are no edge effects at packet
+# boundaries. Each output is computed from a strided window view of that history plus the new samples (as float32 I/Q
+# pairs, so one einsum or matmul does the multiply-accumulate), so only the kept outputs are computed and there is no per-sample
+# Python work
+# Outputs go to sinks: callables taking the complex64 samples of one channel, e.g. a Decimator's process method, a
+# ChannelWriter, or None to drop the channel
+#
+# The channelizer consumes the same interleaved I/Q the readers send: process_payloads() takes UDP payloads of any
+# frame format (LinuxSDR.create_packet(), fifo_reader.c) and process_iq() int16 I/Q pairs from captures
+
+import argparse
+import json
+import selectors
+import time
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from iq_tools import SAMPLE_RATE, packets_to_iq, to_complex, load_samples
+
+# Define constants
+DEFAULT_CHANNELS = 8
+TAPS_PER_CHANNEL = 16
+TAPS_PER_PHASE = 24
+KAISER_BETA = 8.0
+SIGMF_VERSION = '1.0.0'
+
+
+def lowpass(num_taps, cutoff, beta=KAISER_BETA):
+    '''
+    Designs a Kaiser-windowed sinc lowpass filter with unity gain at DC
+
+    Parameters:
+        num_taps (int): the filter length
+        cutoff (float): the -6 dB frequency in cycles per sample (0 to 0.5)
+        beta (float): the Kaiser window shape, higher for more stopband attenuation and a wider transition
+
+    Returns:
+        taps (ndarray): float64 filter taps
+    '''
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = np.sinc(2 * cutoff * n) * np.kaiser(num_taps, beta)
+    return taps / np.sum(taps)
+
+
+class StreamingFir():
+    '''
+    Keeps the input history of a decimating FIR filter across blocks, for any number of streams along the last axis
+
+    Output m is the filter applied to the inputs up to and including input step * m + step - 1, as in ddc_model.py
+    '''
+
+    def __init__(self, taps, step):
+        self.taps = np.asarray(taps, dtype=np.float64)
+        self.step = step
+        # Reversed, so tap i lines up with sample i of a window in time order
+        self.reversed = self.taps[::-1].astype(np.float32)
+        self.reset()
+
+
+    def reset(self):
+        # The window of the next output starts at buffer[..., 0]
+        self.buffer = None
+        self.outputs = 0
+
+
+    def advance(self, samples):
+        '''
+        Adds samples to the history and counts the outputs they complete
+
+        Parameters:
+            samples (ndarray): complex samples, shape (num_samples,) or (streams, num_samples)
+
+        Returns:
+            pairs (ndarray): float32 view of the history as interleaved I/Q, the window of output j of the block starts
+                             at pair step * j
+            count (int): the number of outputs completed
+            first (int): the index of the first of these outputs in the stream
+        '''
+        samples = np.asarray(samples, dtype=np.complex64)
+        if self.buffer is None or self.buffer.shape[:-1] != samples.shape[:-1]:
+            self.buffer = np.zeros(samples.shape[:-1] + (len(self.taps) - self.step,), dtype=np.complex64)
+        buf = np.concatenate((self.buffer, samples), axis=-1)
+        count = max((buf.shape[-1] - len(self.taps)) // self.step + 1, 0)
+        self.buffer = buf[..., count * self.step:]
+        first = self.outputs
+        self.outputs += count
+        return buf.view(np.float32), count, first
+
+
+class Decimator(StreamingFir):
+    '''
+    Streaming decimate-by-D lowpass filter, for one complex stream or a (streams, samples) array of them
+    '''
+
+    def __init__(self, decimation, taps_per_phase=TAPS_PER_PHASE, cutoff=0.4, taps=None, sink=None):
+        '''
+        Parameters:
+            decimation (int): the decimation factor D
+            taps_per_phase (int): the filter length over D, ignored with taps
+            cutoff (float): the -6 dB frequency as a fraction of the output sample rate, ignored with taps
+            taps (ndarray): the filter taps, designed from taps_per_phase and cutoff if not given
+            sink (callable): called with each block of output samples
+        '''
+        if taps is None:
+            taps = lowpass(decimation * taps_per_phase, cutoff / decimation)
+        super().__init__(taps, decimation)
+        self.decimation = decimation
+        self.sink = sink
+
+
+    def process(self, samples):
+        '''
+        Filters and decimates a block of samples
+
+        Parameters:
+            samples (ndarray): complex samples, shape (num_samples,) or (streams, num_samples)
+
+        Returns:
+            out (ndarray): complex64 output samples, one per decimation inputs along the last axis
+        '''
+        pairs, count, _ = self.advance(samples)
+        num_taps = len(self.taps)
+        # (..., outputs, I/Q, taps) windows of the history, without copying, so each output is one vector product
+        windows = as_strided(pairs, pairs.shape[:-1] + (count, 2, num_taps),
+                             pairs.strides[:-1] + (8 * self.step, 4, 8), writeable=False)
+        out = np.ascontiguousarray(windows @ self.reversed).view(np.complex64)[..., 0]
+        if self.sink is not None and count:
+            self.sink(out)
+        return out
+
+
+class PolyphaseChannelizer(StreamingFir):
+    '''
+    Streaming M-channel polyphase FFT filter bank, see the module notes
+    '''
+
+    def __init__(self, num_channels=DEFAULT_CHANNELS, decimation=None, taps_per_channel=TAPS_PER_CHANNEL, cutoff=0.5,
+                 taps=None, sinks=None, post_decimation=1, fs=SAMPLE_RATE):
+        '''
+        Parameters:
+            num_channels (int): the number of channels M
+            decimation (int): the input samples per output sample, M by default, must divide M
+            taps_per_channel (int): the prototype filter length over M, ignored with taps
+            cutoff (float): the prototype's -6 dB frequency as a fraction of the channel spacing, ignored with taps
+            taps (ndarray): the prototype lowpass, of a length that is a multiple of M
+            sinks (list): one callable (or None) per channel, called with each block of the channel's samples
+            post_decimation (int): further decimation of every channel by a Decimator before the sinks
+            fs (float): the input sample rate
+        '''
+        decimation = num_channels if decimation is None else decimation
+        if (num_channels % decimation):
+            raise ValueError(f'decimation {decimation} does not divide {num_channels} channels')
+        if taps is None:
+            taps = lowpass(num_channels * taps_per_channel, cutoff / num_channels)
+        if (len(taps) % num_channels):
+            raise ValueError(f'{len(taps)} prototype taps are not a multiple of {num_channels} channels')
+        super().__init__(taps, decimation)
+        self.num_channels = num_channels
+        self.decimation = decimation
+        self.fs = fs
+        self.sinks = list(sinks) if sinks is not None else [None] * num_channels
+        if (len(self.sinks) != num_channels):
+            raise ValueError(f'{len(self.sinks)} sinks for {num_channels} channels')
+        self.post = Decimator(post_decimation) if post_decimation > 1 else None
+        # Branch t holds taps t*M .. t*M + M - 1 of the reversed prototype, repeated for I and Q
+        self.branches = np.repeat(self.reversed.reshape(-1, num_channels), 2, axis=1)
+        # Channel k of output m is FFT bin k of the branch sums times exp(-2j pi k (m + 1) D / M), which repeats every
+        # M / D outputs (and is 1 when critically sampled)
+        period = num_channels // decimation
+        k = np.arange(num_channels)
+        self.rotations = np.exp(-2j * np.pi * np.outer(np.arange(1, period + 1) * decimation, k) / num_channels)
+        self.rotations = self.rotations.astype(np.complex64)
+
+
+    def channel_freqs(self):
+        '''
+        Returns the center frequency of each channel relative to the input's center (Hz)
+        '''
+        return np.fft.fftfreq(self.num_channels, 1 / self.fs)
+
+
+    def channel_rate(self):
+        '''
+        Returns the sample rate of each channel at the sinks (Hz)
+        '''
+        return self.fs / self.decimation / (self.post.decimation if self.post is not None else 1)
+
+
+    def process(self, samples):
+        '''
+        Channelizes a block of samples and passes each channel's new samples to its sink
+
+        Parameters:
+            samples (ndarray): complex samples
+
+        Returns:
+            out (ndarray): complex64 of shape (num_channels, outputs), row k is channel k
+        '''
+        pairs, count, first = self.advance(samples)
+        m = self.num_channels
+        # (outputs, taps_per_channel, 2M) windows of the history, each the M interleaved I/Q samples of one branch
+        windows = as_strided(pairs, (count, len(self.branches), 2 * m), (8 * self.step, 8 * m, 4), writeable=False)
+        acc = np.einsum('ctm,tm->cm', windows, self.branches).view(np.complex64)
+        spectrum = np.fft.fft(acc, axis=1)
+        if (len(self.rotations) > 1):
+            spectrum *= self.rotations[(first + np.arange(count)) % len(self.rotations)]
+        out = np.ascontiguousarray(spectrum.T, dtype=np.complex64)
+        if self.post is not None:
+            out = self.post.process(out)
+        if out.shape[1]:
+            for sink, channel in zip(self.sinks, out):
+                if sink is not None:
+                    sink(channel)
+        return out
+
+
+    def process_iq(self, iq, scale=1.0 / 32768):
+        '''
+        Channelizes int16 I/Q pairs of shape (num_samples, 2), see iq_tools.to_complex() for scale
+        '''
+        return self.process(to_complex(iq, scale))
+
+
+    def process_payloads(self, payloads):
+        '''
+        Channelizes UDP payloads, one payload or a list of payloads of one frame format, see iq_tools.packets_to_iq()
+        '''
+        if isinstance(payloads, (bytes, bytearray, memoryview)):
+            payloads = [payloads]
+        _, iq = packets_to_iq(list(payloads))
+        return self.process_iq(iq)
+
+
+class ChannelWriter():
+    '''
+    Sink writing one channel to a SigMF cf32_le capture, <path>.sigmf-data with a <path>.sigmf-meta sidecar
+    '''
+
+    def __init__(self, path, sample_rate, frequency=None, description=''):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.frequency = frequency
+        self.description = description
+        self.samples_written = 0
+        self.file = open(path + '.sigmf-data', 'wb')
+
+
+    def __call__(self, samples):
+        np.asarray(samples, dtype='<c8').tofile(self.file)
+        self.samples_written += len(samples)
+
+
+    def close(self):
+        self.file.close()
+        capture = {'core:sample_start': 0}
+        if self.frequency is not None:
+            capture['core:frequency'] = self.frequency
+        meta = {
+            'global': {
+                'core:datatype': 'cf32_le',
+                'core:sample_rate': self.sample_rate,
+                'core:version': SIGMF_VERSION,
+                'core:recorder': 'channelizer.py',
+                'core:description': self.description,
+            },
+            'captures': [capture],
+            'annotations': [],
+        }
+        with open(self.path + '.sigmf-meta', 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+def benchmark(num_channels=DEFAULT_CHANNELS, decimation=None, taps_per_channel=TAPS_PER_CHANNEL, post_decimation=1,
+              block=256, seconds=2.0):
+    '''
+    Times the channelizer (and per-channel decimators) on a tone, fed block samples at a time as packets arrive
+
+    Returns:
+        realtime (float): the stream seconds processed per second of one core's time
+    '''
+    channelizer = PolyphaseChannelizer(num_channels, decimation, taps_per_channel, post_decimation=post_decimation)
+    stream = np.exp(2j * np.pi * 1000 / SAMPLE_RATE * np.arange(block * 1024)).astype(np.complex64)
+    blocks = stream.reshape(-1, block)
+    processed = 0
+    start = time.process_time()
+    while (time.process_time() - start < seconds):
+        for samples in blocks:
+            channelizer.process(samples)
+        processed += len(stream)
+    elapsed = time.process_time() - start
+    return processed / SAMPLE_RATE / elapsed
+
+
+def main(num_channels=DEFAULT_CHANNELS, decimation=None, taps_per_channel=TAPS_PER_CHANNEL, post_decimation=1,
+         capture=None, port=None, ip='0.0.0.0', prefix='channel', duration=None, tuner_freq=None):
+    fs = SAMPLE_RATE
+    if capture is not None:
+        iq, fs = load_samples(capture)
+    channelizer = PolyphaseChannelizer(num_channels, decimation, taps_per_channel, post_decimation=post_decimation,
+                                       fs=fs)
+    rate = channelizer.channel_rate()
+    writers = []
+    for k, offset in enumerate(channelizer.channel_freqs()):
+        frequency = tuner_freq + offset if tuner_freq is not None else None
+        writer = ChannelWriter(f'{prefix}_{k}', rate, frequency, f'channel {k}, {offset:+.1f} Hz from the input center')
+        writers.append(writer)
+        channelizer.sinks[k] = writer
+    print(f'{num_channels} channels {fs / num_channels:.1f} Hz apart at {rate:.1f} samples/s, '
+          f'writing {prefix}_<channel>.sigmf-data')
+
+    start = time.monotonic()
+    try:
+        if capture is not None:
+            chunk = 1 << 16
+            for pos in range(0, len(iq), chunk):
+                channelizer.process_iq(iq[pos:pos + chunk])
+        else:
+            from udp_receiver import StreamReceiver
+            receiver = StreamReceiver(port, ip, sink=channelizer.process)
+            selector = selectors.DefaultSelector()
+            selector.register(receiver, selectors.EVENT_READ)
+            print(f'Receiving on {ip}:{port}')
+            try:
+                while (duration is None or time.monotonic() - start < duration):
+                    if selector.select(timeout=0.1):
+                        receiver.poll()
+            finally:
+                receiver.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for writer in writers:
+            writer.close()
+    elapsed = time.monotonic() - start
+    print(f'Wrote {writers[0].samples_written} samples per channel in {elapsed:.1f} seconds')
+    return writers
+
+
+if __name__ == '__main__':
+    description = "Polyphase channelizer - Splits a radio stream or capture into sub-channel SigMF captures"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-m', '--channels', type=int, help='Number of channels', default=DEFAULT_CHANNELS)
+    parser.add_argument('-d', '--decimation', type=int, help='Channelizer decimation, a divisor of the channels (default: the number of channels)', default=None)
+    parser.add_argument('-t', '--taps', type=int, help='Prototype filter taps per channel', default=TAPS_PER_CHANNEL)
+    parser.add_argument('-D', '--post_decimation', type=int, help='Further decimation of each channel', default=1)
+    parser.add_argument('-c', '--capture', help='Channelize a capture file (or fifo_data.pkl) instead of a UDP stream', default=None)
+    parser.add_argument('-p', '--port', type=int, help='UDP port to receive the stream on', default=25344)
+    parser.add_argument('-i', '--ip', help='Local IP address to receive on', default='0.0.0.0')
+    parser.add_argument('-o', '--output', help='Output prefix, channels are written to <OUTPUT>_<channel>.sigmf-data/-meta', default='channel')
+    parser.add_argument('-s', '--seconds', type=float, help='Seconds to receive (default: until Ctrl-C)', default=None)
+    parser.add_argument('-f', '--tuner_freq', type=float, help='Tuner frequency (Hz), to record each channel\'s frequency', default=None)
+    parser.add_argument('-b', '--block', type=int, help='Samples per block fed to the channelizer by --benchmark', default=256)
+    parser.add_argument('--benchmark', action='store_true', help='Report the processing speed as a multiple of real time and exit')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        realtime = benchmark(args.channels, args.decimation, args.taps, args.post_decimation, args.block)
+        print(f'{args.channels} channels, {args.taps} taps per channel, {args.block} samples per block: '
+              f'{realtime:.0f}x real time on one core')
+    else:
+        main(args.channels, args.decimation, args.taps, args.post_decimation, args.capture, args.port, args.ip,
+             args.output, args.seconds, args.tuner_freq)
@@ -9,7 +9,8 @@ tic;
 % set some things that might change, like the number of samples
 % in one UDP frame, the port number to listen on...etc.
 % This is what I use
-complex_samples_per_packet = 256; 
+complex_samples_per_packet = 256; % the radio's samples per packet (-n)
+header_bytes = 2; % 28 with the extended header (-x), uncompressed samples only (no -z)
 samples_per_packet = complex_samples_per_packet*2;
 port = 25344;
 
@@ -22,7 +23,7 @@ fftsize_packets = 16;
 fs = 100e6/(32*64);
 
 
-bytes_per_packet = 2*samples_per_packet+2; %each packet has a 2 byte seq #
+bytes_per_packet = 2*samples_per_packet+header_bytes; %each packet starts with a 2 byte seq #
 
 % freqs transforms the index into actual frequencies for a nice axis to
 % plot against.
@@ -65,7 +66,7 @@ for i1 = 1:fftsize_packets
             disp('missed packet\n');
         end
         oldpacketct = packetct;
-        fftdata(((i1-1)*samples_per_packet+1):((i1)*samples_per_packet))= typecast(rawData(3:end),'int16');
+        fftdata(((i1-1)*samples_per_packet+1):((i1)*samples_per_packet))= typecast(rawData(header_bytes+1:end),'int16');
     catch
         disp('receive timed out?');
     end
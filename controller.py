@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+
+### SDR controller
+# asyncio event loop shared by linux_sdr.py and linux_sdr_python.py. It owns three tasks:
+#   streaming   the SDR's packet stream (the fifo_reader process or the Python reader thread)
+#   stdin       the interactive command reader, which no longer blocks the radio
+#   network     a TCP control endpoint taking the same commands, one per line, e.g. 'f 1000' or 'i 192.168.1.10'
+# Commands take their values on the same line, so scripts never go through a prompt; at the terminal a missing value
+# is prompted for. Register writes happen directly in the event loop while streaming continues
+
+### JSON control API
+# Network requests that start with '{' or '[' are JSON, over the TCP endpoint (one request per line) or as UDP datagrams
+# to the same port. A request is one command object or a list of them, run in order and answered with one result
+# object or a list of them, each {"ok": true, ...} or {"ok": false, "error": "..."}, echoing any "id" of the command
+#   {"cmd": "set_freq", "target": "adc"|"tuner", "hz": 1000}
+#   {"cmd": "step", "target": "adc"|"tuner", "hz": -100}
+#   {"cmd": "mute", "on": true}                            omit "on" to toggle
+#   {"cmd": "stream", "on": false}                         omit "on" to toggle
+#   {"cmd": "destination", "ip": "...", "port": 25344}     also "add_destination" and "remove_destination"
+#   {"cmd": "status"}                                      frequencies, mute, streaming, destinations, counters, sweep
+#   {"cmd": "timer"}                                       the 125 MHz radio timer register, and extended to 64 bits
+#   {"cmd": "latency", "reset": false}                     drain to send latency histogram of extended-header packets
+#   {"cmd": "format", "samples": 1024, "extended": true}   UDP frame format from the next packet, omit a value to keep it
+#                  "compression": "bfp12"                  also the sample format, "none", "bfp12" or "bfp8"
+#   {"cmd": "spectrum", "nfft": 4096, "rate": 2}           send on-board spectra instead of samples, "nfft": 0 to go back
+#   {"cmd": "sweep", "target": "tuner", "freqs": [...] or "start"/"stop"/"step", "dwell_ms": 100, "repeat": 1}
+#   {"cmd": "sweep_stop"}
+# A sweep runs on the device as a task of the event loop, stepping on absolute deadlines so dwell errors do not add up;
+# a new sweep replaces a running one
+# The same requests can come from a multiprocessing pipe (radio_manager.py runs one controller per radio process this
+# way), and closing the pipe shuts the controller down
+
+import asyncio
+import contextlib
+import io
+import json
+import os
+import signal
+import stat
+import sys
+from registers import sweep_table, inc_to_freq
+from timestamps import extend_timer
+
+# Define constants
+DEFAULT_CONTROL_ADDR = '127.0.0.1'
+DEFAULT_CONTROL_PORT = 25345
+
+
+def stdin_readable():
+    '''
+    Returns True if stdin is a terminal, pipe or socket the event loop can watch, not e.g. /dev/null or a regular file
+    '''
+    if sys.stdin is None or sys.stdin.closed:
+        return False
+    try:
+        mode = os.fstat(sys.stdin.fileno()).st_mode
+    except (OSError, ValueError):
+        return False
+    return sys.stdin.isatty() or stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+
+
+class ControlDatagramProtocol(asyncio.DatagramProtocol):
+    '''
+    Answers each JSON request datagram with a JSON reply datagram
+    '''
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.transport = None
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(self.controller.execute_json(data).encode(), addr)
+
+
+class Controller():
+    '''
+    Runs the SDR commands from the terminal and the network, and shuts everything down together
+
+    The SDR object provides set_freq_reg(), toggle_mute(), toggle_udp(), set_destination(), add_destination(),
+    remove_destination(), get_destinations(), stats(), print_counters(), print_instructions(), and a stream()
+    coroutine that streams until cancelled
+    '''
+
+    def __init__(self, sdr, control_addr=DEFAULT_CONTROL_ADDR, control_port=DEFAULT_CONTROL_PORT, interactive=True, pipe=None):
+        self.sdr = sdr
+        self.control_addr = control_addr
+        self.control_port = control_port
+        self.interactive = interactive
+        self.pipe = pipe
+        self.server = None
+        self.udp_transport = None
+        self.stopping = None
+        self.sweep_task = None
+        self.sweep_state = None
+
+
+    async def execute(self, line, ask=None):
+        '''
+        Runs one command line
+
+        Parameters:
+            line (str): the command and its values, e.g. 'f 1000'
+            ask (coroutine function): prompts for a missing value, None to treat missing values as an error
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: if the command is unknown or a value is missing or invalid
+        '''
+        sdr = self.sdr
+        words = line.split()
+        if not words:
+            return
+        command, values = words[0], words[1:]
+
+        async def value(prompt, convert=str):
+            if values:
+                return convert(values.pop(0))
+            if ask is None:
+                raise ValueError(f"'{command}' needs a value: {prompt}")
+            return convert(await ask(prompt))
+
+        if (command == 'f' or command == 'frequency'):
+            sdr.set_freq_reg(sdr.adc_offset, await value('Enter an ADC frequency: ', int))
+        elif (command == 't' or command == 'tune'):
+            sdr.set_freq_reg(sdr.tuner_offset, await value('Enter a tuner frequency: ', int))
+        elif (command == 'u'):
+            sdr.set_freq_reg(sdr.adc_offset, sdr.adc_freq + 100)
+        elif (command == 'U'):
+            sdr.set_freq_reg(sdr.adc_offset, sdr.adc_freq + 1000)
+        elif (command == 'd'):
+            if (sdr.adc_freq >= 100):
+                sdr.set_freq_reg(sdr.adc_offset, sdr.adc_freq - 100)
+            else:
+                print('Frequency cannot be decreased any further!')
+        elif (command == 'D'):
+            if (sdr.adc_freq >= 1000):
+                sdr.set_freq_reg(sdr.adc_offset, sdr.adc_freq - 1000)
+            else:
+                print('Frequency cannot be decreased any further!')
+        elif (command == 'm' or command == 'mute'):
+            sdr.toggle_mute()
+        elif (command == 's' or command == 'stream'):
+            sdr.toggle_udp()
+        elif (command == 'i' or command == 'IP'):
+            sdr.set_destination(await value('Enter a new destination IP address: '), sdr.udp_port)
+        elif (command == 'p' or command == 'port'):
+            sdr.set_destination(sdr.udp_ip, await value('Enter a new destination UDP port: ', int))
+        elif (command == 'a' or command == 'add'):
+            dest_ip = await value('Enter the destination IP address to add: ')
+            dest_port = await value('Enter the destination UDP port to add: ', int)
+            if not sdr.add_destination(dest_ip, dest_port):
+                print('    Already streaming to that destination')
+        elif (command == 'r' or command == 'remove'):
+            dest_ip = await value('Enter the destination IP address to remove: ')
+            dest_port = await value('Enter the destination UDP port to remove: ', int)
+            if not sdr.remove_destination(dest_ip, dest_port):
+                print('    Not an added destination')
+        elif (command == 'l' or command == 'list'):
+            for dest_ip, dest_port in sdr.get_destinations():
+                print(f'    {dest_ip}:{dest_port}')
+        elif (command == 'c' or command == 'counters'):
+            sdr.print_counters()
+        elif (command == 'h' or command == 'help'):
+            sdr.print_instructions()
+        elif (command == 'e' or command == 'exit'):
+            self.stop()
+        else:
+            raise ValueError(f"Unknown command '{command}', enter 'h' for help")
+
+
+    def stop(self):
+        '''
+        Starts a graceful shutdown: the streaming, stdin, and network tasks are cancelled and the radio is zeroed
+        '''
+        if not self.stopping.done():
+            self.stopping.set_result(None)
+
+
+    def set_freq(self, target, freq):
+        '''
+        Sets the ADC or tuner frequency without printing the update
+        '''
+        self.sdr.set_freq_reg(self.freq_offset(target), int(freq), verbose=False)
+
+
+    def freq_offset(self, target):
+        '''
+        Returns the register offset of a frequency target, 'adc' or 'tuner'
+        '''
+        if (target == 'adc'):
+            return self.sdr.adc_offset
+        elif (target == 'tuner'):
+            return self.sdr.tuner_offset
+        raise ValueError(f"Unknown target '{target}', use 'adc' or 'tuner'")
+
+
+    def status(self):
+        '''
+        Returns the radio and stream status as a dict
+        '''
+        sdr = self.sdr
+        return {
+            'adc_freq': sdr.adc_freq,
+            'tuner_freq': sdr.tuner_freq,
+            'adc_achieved_hz': inc_to_freq(sdr.freq_to_inc(sdr.adc_freq)),
+            'tuner_achieved_hz': inc_to_freq(sdr.freq_to_inc(sdr.tuner_freq)),
+            'mute': bool(sdr.mute),
+            'streaming': bool(sdr.udp_enable),
+            'destinations': [list(dest) for dest in sdr.get_destinations()],
+            'format': sdr.packet_format(),
+            'spectrum': sdr.spectrum_format(),
+            'counters': sdr.stats(),
+            'sweep': self.sweep_state,
+        }
+
+
+    async def sweep(self, target, freqs, dwell, repeat):
+        '''
+        Steps the target frequency through freqs, holding each for dwell seconds, repeat times (0 repeats forever)
+
+        The phase increments are computed once up front, so each step is a single (cached) register write
+        '''
+        loop = asyncio.get_running_loop()
+        offset = self.freq_offset(target)
+        phase_incs, _ = sweep_table(freqs)
+        deadline = loop.time()
+        try:
+            while (repeat == 0 or self.sweep_state['pass'] < repeat):
+                for step, freq in enumerate(freqs):
+                    self.sdr.set_freq_reg(offset, freq, phase_incs[step], verbose=False)
+                    self.sweep_state['step'] = step
+                    deadline += dwell
+                    await asyncio.sleep(max(deadline - loop.time(), 0))
+                self.sweep_state['pass'] += 1
+        finally:
+            self.sweep_state['running'] = False
+
+
+    def start_sweep(self, request):
+        '''
+        Starts a sweep task from a JSON sweep command, replacing any running sweep
+
+        Returns:
+            result (dict): the number of steps per pass
+        '''
+        target = request.get('target', 'tuner')
+        self.freq_offset(target)
+        if 'freqs' in request:
+            freqs = [int(freq) for freq in request['freqs']]
+        else:
+            start, stop, step = int(request['start']), int(request['stop']), int(request.get('step', 1000))
+            if (step == 0):
+                raise ValueError('step must not be 0')
+            freqs = list(range(start, stop + (1 if step > 0 else -1), step))
+        if not freqs:
+            raise ValueError('The sweep has no frequencies')
+        dwell = float(request.get('dwell_ms', 100)) / 1e3
+        if (dwell <= 0):
+            raise ValueError('dwell_ms must be positive')
+        self.stop_sweep()
+        self.sweep_state = {'target': target, 'steps': len(freqs), 'dwell_ms': dwell * 1e3, 'pass': 0, 'step': 0,
+                            'running': True}
+        self.sweep_task = asyncio.create_task(self.sweep(target, freqs, dwell, int(request.get('repeat', 1))), name='sweep')
+        return {'steps': len(freqs)}
+
+
+    def stop_sweep(self):
+        '''
+        Cancels the running sweep, leaving the frequency at its last step
+        '''
+        if self.sweep_task is not None and not self.sweep_task.done():
+            self.sweep_task.cancel()
+
+
+    def execute_command(self, request):
+        '''
+        Runs one JSON command
+
+        Parameters:
+            request (dict): the command, see the JSON control API above
+
+        Returns:
+            result (dict): the values returned by the command
+
+        Raises:
+            ValueError, KeyError, TypeError: if the command is unknown or its values are missing or invalid
+        '''
+        sdr = self.sdr
+        cmd = request['cmd']
+        if (cmd == 'set_freq'):
+            self.set_freq(request['target'], request['hz'])
+        elif (cmd == 'step'):
+            target = request['target']
+            freq = (sdr.adc_freq if target == 'adc' else sdr.tuner_freq) + int(request['hz'])
+            if (freq < 0):
+                raise ValueError('Frequency cannot be decreased any further')
+            self.set_freq(target, freq)
+        elif (cmd == 'mute' or cmd == 'stream'):
+            state = sdr.mute if cmd == 'mute' else sdr.udp_enable
+            if request.get('on') is None or bool(request['on']) != bool(state):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if (cmd == 'mute'):
+                        sdr.toggle_mute()
+                    else:
+                        sdr.toggle_udp()
+        elif (cmd == 'destination'):
+            sdr.set_destination(request['ip'], int(request['port']))
+        elif (cmd == 'add_destination'):
+            return {'changed': sdr.add_destination(request['ip'], int(request['port']))}
+        elif (cmd == 'remove_destination'):
+            return {'changed': sdr.remove_destination(request['ip'], int(request['port']))}
+        elif (cmd == 'status'):
+            return self.status()
+        elif (cmd == 'timer'):
+            timer = sdr.get_ctrl_reg(sdr.timer_offset)
+            return {'timer': timer, 'timer64': extend_timer(timer)}
+        elif (cmd == 'latency'):
+            latency = sdr.latency(bool(request.get('reset', False)))
+            return {**latency.summary(), 'bins': latency.bins()}
+        elif (cmd == 'format'):
+            samples = request.get('samples')
+            extended = request.get('extended')
+            sdr.set_format(None if samples is None else int(samples), None if extended is None else bool(extended),
+                           request.get('compression'))
+            return sdr.packet_format()
+        elif (cmd == 'spectrum'):
+            rate = request.get('rate')
+            sdr.set_spectrum(int(request.get('nfft', 0)), None if rate is None else float(rate))
+            return sdr.spectrum_format()
+        elif (cmd == 'sweep'):
+            return self.start_sweep(request)
+        elif (cmd == 'sweep_stop'):
+            self.stop_sweep()
+        else:
+            raise ValueError(f"Unknown command '{cmd}'")
+        return {}
+
+
+    def execute_json(self, text):
+        '''
+        Runs a JSON request, a command object or a list of them
+
+        Returns:
+            reply (str): the JSON result object, or list of result objects
+        '''
+        try:
+            request = json.loads(text)
+        except ValueError as e:
+            return json.dumps({'ok': False, 'error': f'Invalid JSON: {e}'})
+        results = []
+        for command in (request if isinstance(request, list) else [request]):
+            try:
+                if not isinstance(command, dict):
+                    raise TypeError('A command must be a JSON object')
+                result = {'ok': True, **self.execute_command(command)}
+            except KeyError as e:
+                result = {'ok': False, 'error': f'Missing value {e}'}
+            except (ValueError, TypeError, OSError, RuntimeError) as e:
+                result = {'ok': False, 'error': str(e)}
+            if isinstance(command, dict) and 'id' in command:
+                result['id'] = command['id']
+            results.append(result)
+        return json.dumps(results if isinstance(request, list) else results[0])
+
+
+    def pipe_request(self):
+        '''
+        Answers one JSON request from the pipe, and stops the controller once the other end closes it
+        '''
+        try:
+            text = self.pipe.recv_bytes()
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(self.pipe.fileno())
+            self.stop()
+            return
+        self.pipe.send_bytes(self.execute_json(text).encode())
+
+
+    async def read_stdin(self):
+        '''
+        Reads commands from the terminal without blocking the event loop
+        '''
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+        async def ask(prompt):
+            print(prompt, end='', flush=True)
+            line = await reader.readline()
+            if not line:
+                raise ValueError('No value given')
+            return line.decode().strip()
+
+        while True:
+            print('Enter a command: ', end='', flush=True)
+            line = await reader.readline()
+            if not line:
+                # End of a piped script, keep streaming until an exit command or a signal
+                return
+            print('')
+            try:
+                await self.execute(line.decode(), ask)
+            except (ValueError, TypeError, OSError, RuntimeError) as e:
+                print(f'    {e}')
+            print('')
+
+
+    async def handle_client(self, reader, writer):
+        '''
+        Runs the commands of one network client, replying to each JSON line with a JSON line, and to each text command
+        line with the command output followed by 'ok' or 'error: <reason>'
+        '''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.lstrip()[:1] in (b'{', b'['):
+                    writer.write(self.execute_json(line).encode() + b'\n')
+                    await writer.drain()
+                    continue
+                output = io.StringIO()
+                try:
+                    with contextlib.redirect_stdout(output):
+                        await self.execute(line.decode())
+                    reply = output.getvalue() + 'ok\n'
+                except (ValueError, TypeError, OSError, RuntimeError) as e:
+                    reply = output.getvalue() + f'error: {e}\n'
+                writer.write(reply.encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def run(self):
+        '''
+        Streams and takes commands until an exit command, SIGINT, or SIGTERM, then shuts down in order: the command
+        readers, the stream, and finally the radio frequencies are zeroed
+        '''
+        loop = asyncio.get_running_loop()
+        self.stopping = loop.create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        tasks = [asyncio.create_task(self.sdr.stream(), name='streaming')]
+        if self.control_port is not None:
+            self.server = await asyncio.start_server(self.handle_client, self.control_addr, self.control_port)
+            print(f'Listening for commands on {self.control_addr}:{self.control_port} (TCP, and JSON over UDP)\n')
+            tasks.append(asyncio.create_task(self.server.serve_forever(), name='network'))
+            self.udp_transport, _ = await loop.create_datagram_endpoint(lambda: ControlDatagramProtocol(self),
+                                                                        local_addr=(self.control_addr, self.control_port))
+        if self.pipe is not None:
+            loop.add_reader(self.pipe.fileno(), self.pipe_request)
+        if self.interactive and stdin_readable():
+            tasks.append(asyncio.create_task(self.read_stdin(), name='stdin'))
+
+        # Stop when asked to, or if the stream ends on its own
+        await asyncio.wait([self.stopping, tasks[0]], return_when=asyncio.FIRST_COMPLETED)
+
+        self.stop_sweep()
+        for task in reversed(tasks):
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.udp_transport.close()
+        if self.pipe is not None and not self.pipe.closed:
+            loop.remove_reader(self.pipe.fileno())
+        self.sdr.set_ctrl_reg(self.sdr.adc_offset, 0)
+        self.sdr.set_ctrl_reg(self.sdr.tuner_offset, 0)
+        print('Terminated UDP sender...')
+        print('Exiting...')
+        print('')
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+                raise result
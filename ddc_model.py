@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+
+### DDC model
+# Block-streaming NumPy model of the full_radio DDC chain in ip_repo/full_radio/src/ddc.vhd:
+#   dds_compiler_0 (ADC)  -> cosine, 16 bits
+#   dds_compiler_1 (tuner) -> cosine + sine, 16 bits
+#   cmpy_0 (ADC x tuner)   -> bits 29..14 of each 33-bit product
+#   filter_1               -> 177 taps, decimate by 40, 17-bit truncated output, low 16 bits kept
+#   filter_2               -> 724 taps, decimate by 64, 17-bit truncated output, low 16 bits kept
+# The output is the packed 32-bit FIFO word (Q in the upper and I in the lower 16 bits) at 125 MHz / 2560
+#
+# Fixed point details follow the IP configurations (.xci): the DDSs have a 27-bit phase accumulator and a unit circle
+# amplitude (1.0 = 2^14), the FIR coefficients are the .coe values quantized with 20 (filter_1) and 21 (filter_2)
+# fractional bits, and both filters truncate their full precision accumulators to 17 bits.
+# The DDSs are modelled as ideal rounded sine/cosine lookups, which the Taylor series corrected cores match to within 1 LSB.
+#
+# Decimation is done polyphase: each block of D inputs is one row of a matrix, and a single matrix product against the
+# D x P polyphase coefficient matrix gives every partial sum, so discarded outputs are never computed. The products are
+# exact in float64 since the accumulators stay well below 2^53.
+
+import os
+import argparse
+import time
+import numpy as np
+from registers import freq_to_inc
+
+# Define constants
+SAMP_FREQ = 125000000
+PHASE_RESOLUTION_BITS = 27
+DDS_AMPLITUDE = 1 << 14
+MIXER_SHIFT = 14
+FILTER_1_DECIMATION = 40
+FILTER_1_FRAC_BITS = 20
+FILTER_2_DECIMATION = 64
+FILTER_2_FRAC_BITS = 21
+DECIMATION = FILTER_1_DECIMATION * FILTER_2_DECIMATION
+OUT_SAMP_FREQ = SAMP_FREQ / DECIMATION
+
+COE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ip_repo', 'full_radio', 'src')
+FILTER_1_COE = os.path.join(COE_DIR, 'filter_1.coe')
+FILTER_2_COE = os.path.join(COE_DIR, 'filter_2.coe')
+
+# DDS lookup table resolution, the phase is kept in the top 27 bits of a uint32 so it wraps for free
+TABLE_BITS = 20
+PHASE_SHIFT = 32 - PHASE_RESOLUTION_BITS
+
+
+def read_coe(path, frac_bits):
+    '''
+    Reads a Vivado .coe coefficient file and quantizes the coefficients as the FIR compiler does
+
+    Parameters:
+        path (str): the .coe file path
+        frac_bits (int): the number of fractional bits of the quantized coefficients
+
+    Returns:
+        coefs (ndarray): int64 array of quantized coefficients
+    '''
+    with open(path) as file:
+        text = file.read()
+    data = text.split('coefdata=')[1].replace(';', '')
+    coefs = np.array([float(val) for val in data.split(',') if val.strip()])
+    return np.round(coefs * (1 << frac_bits)).astype(np.int64)
+
+
+def wrap16(vals):
+    '''
+    Keeps the low 16 bits of integer valued samples as signed values, as the VHDL slices do
+    '''
+    return ((vals.astype(np.int64) + 0x8000) & 0xFFFF) - 0x8000
+
+
+class PolyphaseDecimator():
+    '''
+    Streaming decimate-by-D FIR filter over interleaved I/Q paths
+
+    Output m uses inputs up to and including input D*m + D - 1, and the filter history is carried across blocks
+    '''
+
+    def __init__(self, coefs, decimation, frac_bits):
+        self.decimation = decimation
+        self.frac_bits = frac_bits
+        self.num_phases = -(-len(coefs) // decimation)
+        padded = np.zeros(self.num_phases * decimation)
+        padded[:len(coefs)] = coefs
+        # Column j holds taps j*D .. j*D + D - 1, reversed to line up with the input order within a row
+        poly = padded.reshape(self.num_phases, decimation)[:, ::-1].T
+        # Rows hold interleaved I/Q, so spread the polyphase matrix over the two paths: columns 0..P-1 give the I
+        # partial sums and columns P..2P-1 the Q partial sums
+        self.poly = np.zeros((2 * decimation, 2 * self.num_phases))
+        self.poly[0::2, :self.num_phases] = poly
+        self.poly[1::2, self.num_phases:] = poly
+        self.scale = 1.0 / (1 << frac_bits)
+        self.reset()
+
+
+    def reset(self):
+        self.history = np.zeros((self.num_phases - 1, 2 * self.num_phases))
+
+
+    def process(self, rows):
+        '''
+        Filters and decimates a block of input rows
+
+        Parameters:
+            rows (ndarray): (N, 2D) float64 interleaved I/Q inputs, one output per row
+
+        Returns:
+            out (ndarray): (N, 2) int64 I/Q outputs, truncated to 17 bits and wrapped to the low 16 bits
+        '''
+        num_rows = rows.shape[0]
+        taps = self.num_phases - 1
+        partial = np.concatenate((self.history, rows @ self.poly))
+        acc = partial[taps:, 0::self.num_phases].copy()
+        for j in range(1, self.num_phases):
+            acc += partial[taps - j:taps - j + num_rows, j::self.num_phases]
+        self.history = partial[num_rows:]
+        return wrap16(np.floor(acc * self.scale))
+
+
+class DDCModel():
+    '''
+    Streaming model of the DDC, see the module header for the details
+
+    With exact=True every DDS sample is generated and pushed through the mixer and both filters in fixed point, which
+    is bit-accurate but runs the 125 MHz front end in NumPy. With exact=False the chain is replaced by its linear
+    response: the mixer produces the sum and difference tones of the two DDSs, and the output is those tones scaled by
+    the filter responses and quantized, computed directly at the output rate. That ignores DDS quantization spurs,
+    truncation noise and filter transients after a retune (a few LSBs), and runs many times faster than real time.
+
+    Can be used as the sample source of a registers.SimulatedRadio
+    '''
+
+    # Outputs needed after a filter reset before the outputs are exact again (filter_2 spans 724 / 64 outputs)
+    WARMUP_OUTPUTS = 16
+
+    def __init__(self, adc_inc=0, tuner_inc=0, exact=True, block_outputs=16):
+        self.exact = exact
+        self.block_outputs = block_outputs
+        self.coefs_1 = read_coe(FILTER_1_COE, FILTER_1_FRAC_BITS)
+        self.coefs_2 = read_coe(FILTER_2_COE, FILTER_2_FRAC_BITS)
+        self.filter_1 = PolyphaseDecimator(self.coefs_1, FILTER_1_DECIMATION, FILTER_1_FRAC_BITS)
+        self.filter_2 = PolyphaseDecimator(self.coefs_2, FILTER_2_DECIMATION, FILTER_2_FRAC_BITS)
+
+        # DDS cosine table indexed by the top TABLE_BITS bits of the phase, sine is looked up a quarter turn back
+        angle = np.arange(1 << TABLE_BITS) * (2 * np.pi / (1 << TABLE_BITS))
+        self.cos_table = np.round(DDS_AMPLITUDE * np.cos(angle)).astype(np.int32)
+
+        # Per-block phase offsets relative to the first input of the block, and preallocated work buffers
+        rows = block_outputs * FILTER_2_DECIMATION
+        shape = (rows, FILTER_1_DECIMATION)
+        self.row_idx = np.arange(rows, dtype=np.uint32) * np.uint32(FILTER_1_DECIMATION)
+        self.col_idx = np.arange(FILTER_1_DECIMATION, dtype=np.uint32)
+        self.adc_idx = np.empty(shape, dtype=np.uint32)
+        self.tuner_idx = np.empty(shape, dtype=np.uint32)
+        self.adc = np.empty(shape, dtype=np.int32)
+        self.mixed_I = np.empty(shape, dtype=np.int32)
+        self.mixed_Q = np.empty(shape, dtype=np.int32)
+        self.rows = np.empty((rows, 2 * FILTER_1_DECIMATION))
+
+        self.adc_phase = 0
+        self.tuner_phase = 0
+        self.adc_inc = None
+        self.tuner_inc = None
+        self.index = 0
+        self.pending = np.zeros(0, dtype=np.uint32)
+        self.set_phase_incs(adc_inc, tuner_inc)
+
+
+    def set_phase_incs(self, adc_inc, tuner_inc):
+        '''
+        Sets the DDS phase increments, as written to the adc_offset and tuner_offset registers
+
+        Parameters:
+            adc_inc (int): the ADC DDS phase increment, e.g. from LinuxSDR.freq_to_inc
+            tuner_inc (int): the tuner DDS phase increment
+
+        Returns:
+            None
+        '''
+        mask = (1 << PHASE_RESOLUTION_BITS) - 1
+        if (adc_inc != self.adc_inc):
+            self.adc_inc = adc_inc
+            self.adc_step = ((adc_inc & mask) << PHASE_SHIFT) & 0xFFFFFFFF
+            self.adc_offsets = self.phase_offsets(self.adc_step)
+        if (tuner_inc != self.tuner_inc):
+            self.tuner_inc = tuner_inc
+            self.tuner_step = ((tuner_inc & mask) << PHASE_SHIFT) & 0xFFFFFFFF
+            self.tuner_offsets = self.phase_offsets(self.tuner_step)
+        self.tone_gains = None
+
+
+    def phase_offsets(self, step):
+        '''
+        Returns the (row, column) phase offsets within one block for the given scaled phase increment
+        '''
+        step = np.uint32(step)
+        return (self.row_idx * step)[:, None], self.col_idx * step
+
+
+    def reset_dds(self):
+        '''
+        Models the DDS reset (control register bit 0): both phase accumulators restart from 0
+        '''
+        self.adc_phase = 0
+        self.tuner_phase = 0
+
+
+    def advance_dds(self, num_inputs):
+        self.adc_phase = (self.adc_phase + num_inputs * self.adc_step) & 0xFFFFFFFF
+        self.tuner_phase = (self.tuner_phase + num_inputs * self.tuner_step) & 0xFFFFFFFF
+
+
+    def mix_block(self):
+        '''
+        Generates one block of DDS samples and mixes them
+
+        Returns:
+            rows (ndarray): (rows, 80) float64 interleaved I/Q mixer outputs, one filter_1 output per row
+        '''
+        shift = np.uint32(32 - TABLE_BITS)
+        for offsets, phase, idx in ((self.adc_offsets, self.adc_phase, self.adc_idx),
+                                    (self.tuner_offsets, self.tuner_phase, self.tuner_idx)):
+            np.add(offsets[0], np.uint32(phase), out=idx)
+            np.add(idx, offsets[1], out=idx)
+            np.right_shift(idx, shift, out=idx)
+        self.advance_dds(self.adc_idx.size)
+
+        table = self.cos_table
+        table.take(self.adc_idx, out=self.adc)
+        table.take(self.tuner_idx, out=self.mixed_I)
+        np.subtract(self.tuner_idx, np.uint32(1 << (TABLE_BITS - 2)), out=self.tuner_idx)
+        np.bitwise_and(self.tuner_idx, np.uint32((1 << TABLE_BITS) - 1), out=self.tuner_idx)
+        table.take(self.tuner_idx, out=self.mixed_Q)
+        for mixed in (self.mixed_I, self.mixed_Q):
+            np.multiply(mixed, self.adc, out=mixed)
+            np.right_shift(mixed, MIXER_SHIFT, out=mixed)
+        self.rows[:, 0::2] = self.mixed_I
+        self.rows[:, 1::2] = self.mixed_Q
+        return self.rows
+
+
+    def linear_block(self, num_samples):
+        '''
+        Computes num_samples outputs from the linear response of the chain (exact=False)
+
+        Returns:
+            out (ndarray): (num_samples, 2) int64 I/Q output samples
+        '''
+        mask = (1 << PHASE_RESOLUTION_BITS) - 1
+        adc_inc = self.adc_step >> PHASE_SHIFT
+        tuner_inc = self.tuner_step >> PHASE_SHIFT
+        tones = ((tuner_inc + adc_inc, (self.tuner_phase + self.adc_phase) >> PHASE_SHIFT),
+                 (tuner_inc - adc_inc, (self.tuner_phase - self.adc_phase) >> PHASE_SHIFT))
+        if self.tone_gains is None:
+            # The floors in the mixer and filters each bias the output by half an LSB
+            bias = -0.5 * (1 + 1j)
+            dc = ((bias * self.coefs_1.sum() / (1 << FILTER_1_FRAC_BITS)) + bias) * self.coefs_2.sum() / (1 << FILTER_2_FRAC_BITS) + bias
+            gains = []
+            for inc, _ in tones:
+                omega = 2 * np.pi * (inc & mask) / (1 << PHASE_RESOLUTION_BITS)
+                h_1 = np.exp(-1j * omega * np.arange(len(self.coefs_1))) @ self.coefs_1 / (1 << FILTER_1_FRAC_BITS)
+                h_2 = np.exp(-1j * FILTER_1_DECIMATION * omega * np.arange(len(self.coefs_2))) @ self.coefs_2 / (1 << FILTER_2_FRAC_BITS)
+                gains.append(DDS_AMPLITUDE / 2 * h_1 * h_2)
+            self.tone_gains = (gains, dc)
+        gains, dc = self.tone_gains
+
+        # Output p ends at input 2560*p + 2559 of this block
+        n = np.arange(num_samples, dtype=np.int64) * DECIMATION + (DECIMATION - 1)
+        out = np.full(num_samples, dc, dtype=np.complex128)
+        for (inc, phase), gain in zip(tones, gains):
+            tone_phase = ((n * (inc & mask) + phase) & mask) * (2 * np.pi / (1 << PHASE_RESOLUTION_BITS))
+            out += gain * np.exp(1j * tone_phase)
+        self.advance_dds(num_samples * DECIMATION)
+        return wrap16(np.floor(out.view(np.float64))).reshape(-1, 2)
+
+
+    def process_block(self):
+        '''
+        Runs one block of inputs through the chain
+
+        Returns:
+            out (ndarray): (block_outputs, 2) int64 I/Q output samples
+        '''
+        mid = self.filter_1.process(self.mix_block())
+        mid = mid.reshape(-1, 2 * FILTER_2_DECIMATION).astype(np.float64)
+        return self.filter_2.process(mid)
+
+
+    def read(self, num_samples):
+        '''
+        Runs the chain for num_samples outputs
+
+        Parameters:
+            num_samples (int): the number of output samples
+
+        Returns:
+            words (ndarray): uint32 packed FIFO words (Q in the upper and I in the lower 16 bits)
+        '''
+        words = np.empty(num_samples, dtype=np.uint32)
+        count = min(num_samples, len(self.pending))
+        words[:count] = self.pending[:count]
+        self.pending = self.pending[count:]
+        while (count < num_samples):
+            if self.exact:
+                out = self.process_block()
+            else:
+                out = self.linear_block(num_samples - count)
+            block = (((out[:, 1] & 0xFFFF) << 16) | (out[:, 0] & 0xFFFF)).astype(np.uint32)
+            used = min(num_samples - count, len(block))
+            words[count:count + used] = block[:used]
+            self.pending = block[used:]
+            count += used
+        self.index += num_samples
+        return words
+
+
+    def skip(self, num_samples):
+        '''
+        Advances the chain by num_samples outputs without computing them where possible
+
+        The DDS phases are jumped forward and only the last WARMUP_OUTPUTS outputs are run, which refills the filter
+        histories exactly
+
+        Parameters:
+            num_samples (int): the number of output samples to skip
+
+        Returns:
+            None
+        '''
+        jump = num_samples - len(self.pending) - self.WARMUP_OUTPUTS
+        if (jump <= 0 or not self.exact):
+            self.read(num_samples)
+            return
+        self.index += len(self.pending) + jump
+        self.pending = self.pending[:0]
+        self.advance_dds(jump * DECIMATION)
+        self.filter_1.reset()
+        self.filter_2.reset()
+        self.read(self.WARMUP_OUTPUTS)
+
+
+    def generate(self, adc_inc, tuner_inc, ctrl, start_index, num_samples):
+        '''
+        SimulatedRadio sample source interface
+
+        Parameters:
+            adc_inc (int): the ADC DDS phase increment register value
+            tuner_inc (int): the tuner DDS phase increment register value
+            ctrl (int): the control register value, bit 0 holds the DDSs in reset
+            start_index (int): the output sample index of the first generated sample, the outputs before it that were
+                               never requested (e.g. dropped while the FIFO was full) are skipped
+            num_samples (int): the number of samples to generate
+
+        Returns:
+            words (ndarray): uint32 packed FIFO words
+        '''
+        if (start_index > self.index):
+            self.skip(start_index - self.index)
+        self.index = start_index
+        if (ctrl & 1):
+            # The hardware stops producing samples while the DDSs are in reset, the simulated FIFO reads zeros instead
+            self.reset_dds()
+            self.index += num_samples
+            return np.zeros(num_samples, dtype=np.uint32)
+        self.set_phase_incs(adc_inc, tuner_inc)
+        return self.read(num_samples)
+
+
+def main(adc_freq, tuner_freq, seconds, exact):
+    model = DDCModel(freq_to_inc(adc_freq), freq_to_inc(tuner_freq), exact=exact)
+    num_samples = int(seconds * OUT_SAMP_FREQ)
+    start = time.perf_counter()
+    words = model.read(num_samples)
+    elapsed = time.perf_counter() - start
+    samples = words.view(np.int16)
+    print(f'Generated {num_samples} samples ({seconds} s of radio time) in {elapsed:.3f} s, {seconds / elapsed:.2f}x real time')
+    print(f'Peak I = {np.abs(samples[0::2]).max()}, peak Q = {np.abs(samples[1::2]).max()}')
+
+
+if __name__ == '__main__':
+    description = "DDC model - Runs the model of the radio DDC chain and reports its speed"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-f', '--freq', nargs='?', help='Simulated ADC frequency (Hz)', default=1001000)
+    parser.add_argument('-t', '--tuner_freq', nargs='?', help='Tuner frequency (Hz)', default=1000000)
+    parser.add_argument('-s', '--seconds', nargs='?', help='Seconds of radio time to generate', default=1.0)
+    parser.add_argument('--linear', action='store_true', help='Use the linear response model instead of the bit-accurate one')
+    args = parser.parse_args()
+
+    main(int(args.freq), int(args.tuner_freq), float(args.seconds), not args.linear)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+### AM/FM demodulator
+# Receiver-side audio for remote listeners: demodulates radio UDP streams to 48 kHz 16-bit PCM, to a WAV file or stdout
+#   AM   envelope |x|, divided by the carrier level (averaged over carrier_tau seconds) so full modulation is full
+#        scale, less the carrier
+#   FM   discriminator angle(x[n] * conj(x[n - 1])), scaled so the peak deviation is full scale, then de-emphasis
+#        (a one-pole lowpass of time constant deemphasis, 75 us by default, applied as its impulse response truncated
+#        at -80 dB)
+#   Both are then resampled from 48828.125 Hz to 48000 Hz by a polyphase rational resampler (up 3072, down 3125)
+#   whose lowpass also limits the audio to bandwidth
+# Every stage works on whole blocks with NumPy and carries its state (the last sample, the filter histories, the
+# resampler phase) across blocks, so a stream is demodulated a packet or a receive batch at a time with no edge
+# effects, and the audio of each batch is written as soon as it is demodulated: the latency is the receive batch plus
+# the filter delays (about 0.3 ms for the resampler)
+# One process serves any number of streams (one UDP port each, any frame format) from a single selector loop
+
+### Output format
+# Mono signed 16-bit little endian PCM at 48000 Hz: a WAV file per stream, or raw on stdout (one stream only), e.g.
+#   python3 demodulator.py -p 25344 -m fm -o - | aplay -f S16_LE -r 48000 -c 1
+
+import argparse
+import selectors
+import sys
+import time
+import wave
+from fractions import Fraction
+import numpy as np
+from channelizer import lowpass
+from iq_tools import SAMPLE_RATE
+
+# Define constants
+AUDIO_RATE = 48000
+MODES = ('am', 'fm')
+FM_DEVIATION = 5000
+DEEMPHASIS = 75e-6
+AUDIO_BANDWIDTH = 8000
+CARRIER_TAU = 0.1
+RESAMPLER_TAPS = 32
+VOLUME = 0.5
+
+
+def deemphasis_taps(tau, fs, floor=1e-4):
+    '''
+    Returns the impulse response of a one-pole de-emphasis lowpass with unity gain at DC, truncated once it falls
+    below floor (relative to its first tap)
+
+    Parameters:
+        tau (float): the time constant (s), e.g. 75e-6 or 50e-6
+        fs (float): the sample rate
+        floor (float): the truncation level
+
+    Returns:
+        taps (ndarray): float32 filter taps
+    '''
+    a = np.exp(-1 / (tau * fs))
+    length = max(int(np.ceil(np.log(floor) / np.log(a))), 1)
+    taps = a ** np.arange(length)
+    return (taps / np.sum(taps)).astype(np.float32)
+
+
+class Resampler():
+    '''
+    Streaming polyphase rational resampler of a real signal, by up / down
+
+    Output n is at input position n * down / up, computed from the taps_per_phase inputs up to input
+    floor(n * down / up) with the prototype phase (n * down) mod up, so only the kept outputs are computed
+    '''
+
+    def __init__(self, fs_in, fs_out=AUDIO_RATE, bandwidth=None, taps_per_phase=RESAMPLER_TAPS):
+        '''
+        Parameters:
+            fs_in (float): the input sample rate
+            fs_out (float): the output sample rate
+            bandwidth (float): the passband edge (Hz), up to the lower Nyquist frequency by default
+            taps_per_phase (int): the prototype filter length over up
+        '''
+        ratio = (Fraction(fs_out) / Fraction(fs_in)).limit_denominator(10000)
+        self.up, self.down = ratio.numerator, ratio.denominator
+        self.taps_per_phase = taps_per_phase
+        nyquist = min(fs_in, fs_out) / 2
+        # -6 dB at the bandwidth, but low enough that the transition (about 5 / taps_per_phase of the input rate for
+        # the Kaiser window) ends by the Nyquist frequency
+        transition = 5 * fs_in / taps_per_phase
+        edge = nyquist - transition / 2
+        if bandwidth is not None:
+            edge = min(bandwidth, edge)
+        cutoff = edge / (fs_in * self.up)
+        taps = lowpass(self.up * taps_per_phase, cutoff) * self.up
+        # Row p holds phase p in time order against a window of inputs: taps p + up * (T - 1 - j) for j = 0 .. T - 1
+        self.phases = taps.reshape(taps_per_phase, self.up).T[:, ::-1].astype(np.float32)
+        self.reset()
+
+
+    def reset(self):
+        # buffer[0] is input base, next_out the index of the next output
+        self.buffer = np.zeros(self.taps_per_phase - 1, dtype=np.float32)
+        self.base = -(self.taps_per_phase - 1)
+        self.next_out = 0
+
+
+    def process(self, samples):
+        '''
+        Resamples a block of samples
+
+        Parameters:
+            samples (ndarray): real samples
+
+        Returns:
+            out (ndarray): float32 output samples
+        '''
+        buf = np.concatenate((self.buffer, np.asarray(samples, dtype=np.float32)))
+        last = self.base + len(buf) - 1
+        # Outputs whose newest input has arrived: n * down < (last + 1) * up
+        end = -(-(last + 1) * self.up // self.down)
+        n = np.arange(self.next_out, end, dtype=np.int64)
+        pos = n * self.down
+        newest = pos // self.up - self.base
+        # (outputs, taps) gather of each output's window and its phase's taps
+        windows = buf[newest[:, None] + np.arange(1 - self.taps_per_phase, 1)]
+        out = np.einsum('ct,ct->c', windows, self.phases[pos % self.up])
+        self.next_out = end
+        # Keep the inputs from the window of the next output on
+        keep = (end * self.down) // self.up - (self.taps_per_phase - 1) - self.base
+        self.buffer = buf[keep:]
+        self.base += keep
+        return out
+
+
+class Demodulator():
+    '''
+    Streaming AM or FM demodulator from complex baseband to 48 kHz audio, see the module notes
+    '''
+
+    def __init__(self, mode='fm', fs=SAMPLE_RATE, deviation=FM_DEVIATION, deemphasis=DEEMPHASIS,
+                 bandwidth=AUDIO_BANDWIDTH, carrier_tau=CARRIER_TAU, fs_out=AUDIO_RATE, sink=None):
+        '''
+        Parameters:
+            mode (str): 'am' or 'fm'
+            fs (float): the input sample rate
+            deviation (float): the FM peak deviation (Hz) that gives full scale audio
+            deemphasis (float): the FM de-emphasis time constant (s), 0 for none
+            bandwidth (float): the audio bandwidth (Hz)
+            carrier_tau (float): the AM carrier level averaging time (s)
+            fs_out (float): the audio sample rate
+            sink (callable): called with each block of int16 PCM, see pcm()
+        '''
+        if mode not in MODES:
+            raise ValueError(f'unknown mode {mode}, expected one of {MODES}')
+        self.mode = mode
+        self.fs = fs
+        self.fm_scale = fs / (2 * np.pi * deviation)
+        self.deemphasis = deemphasis_taps(deemphasis, fs) if mode == 'fm' and deemphasis else None
+        self.carrier_tau = carrier_tau
+        self.resampler = Resampler(fs, fs_out, bandwidth)
+        self.sink = sink
+        self.reset()
+
+
+    def reset(self):
+        self.last = np.complex64(0)
+        self.carrier = None
+        self.history = np.zeros(len(self.deemphasis) - 1 if self.deemphasis is not None else 0, dtype=np.float32)
+        self.resampler.reset()
+
+
+    def demodulate(self, samples):
+        '''
+        Demodulates a block of complex samples to audio at the input rate, full scale 1.0
+        '''
+        samples = np.asarray(samples, dtype=np.complex64)
+        if not len(samples):
+            return np.zeros(0, dtype=np.float32)
+        if (self.mode == 'fm'):
+            prev = np.concatenate(([self.last], samples[:-1]))
+            self.last = samples[-1]
+            audio = np.angle(samples * np.conj(prev)).astype(np.float32) * np.float32(self.fm_scale)
+            if self.deemphasis is not None:
+                buf = np.concatenate((self.history, audio))
+                audio = np.convolve(buf, self.deemphasis, mode='valid').astype(np.float32)
+                self.history = buf[len(buf) - len(self.history):]
+            return audio
+        envelope = np.abs(samples)
+        level = float(np.mean(envelope))
+        if self.carrier is None:
+            self.carrier = level
+        else:
+            # Exponential average over carrier_tau, weighted by the block's duration
+            weight = 1 - np.exp(-len(samples) / (self.carrier_tau * self.fs))
+            self.carrier += weight * (level - self.carrier)
+        return (envelope / max(self.carrier, 1e-9) - 1).astype(np.float32)
+
+
+    def process(self, samples, volume=VOLUME):
+        '''
+        Demodulates and resamples a block of complex samples, and passes its PCM to the sink
+
+        Returns:
+            pcm (ndarray): int16 audio samples
+        '''
+        pcm = self.pcm(self.resampler.process(self.demodulate(samples)), volume)
+        if self.sink is not None and len(pcm):
+            self.sink(pcm)
+        return pcm
+
+
+    @staticmethod
+    def pcm(audio, volume=VOLUME):
+        '''
+        Converts audio (full scale 1.0) to int16 PCM at volume, clipping
+        '''
+        return np.clip(np.rint(audio * (volume * 32767)), -32768, 32767).astype('<i2')
+
+
+class PcmWriter():
+    '''
+    Sink writing int16 PCM to a mono WAV file, or raw to stdout with path '-', flushed after every block so the
+    audio is available as soon as it is demodulated
+    '''
+
+    def __init__(self, path, rate=AUDIO_RATE):
+        self.path = path
+        self.samples_written = 0
+        if (path == '-'):
+            self.wav = None
+            self.out = sys.stdout.buffer
+        else:
+            self.file = open(path, 'wb')
+            self.wav = wave.open(self.file, 'wb')
+            self.wav.setnchannels(1)
+            self.wav.setsampwidth(2)
+            self.wav.setframerate(rate)
+
+
+    def __call__(self, pcm):
+        data = pcm.tobytes()
+        if self.wav is not None:
+            # writeframes() also patches the header with the length so far, so the file plays while it grows
+            self.wav.writeframes(data)
+            self.file.flush()
+        else:
+            self.out.write(data)
+            self.out.flush()
+        self.samples_written += len(pcm)
+
+
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+            self.file.close()
+
+
+def benchmark(mode='fm', radios=24, block=1024, seconds=2.0):
+    '''
+    Times the demodulation of several streams fed block samples at a time, an FM tone for each
+
+    Returns:
+        realtime (float): the stream seconds processed per second of one core's time, over all the streams
+    '''
+    demods = [Demodulator(mode) for _ in range(radios)]
+    t = np.arange(block * 64) / SAMPLE_RATE
+    phase = 2 * np.pi * 1000 * t + FM_DEVIATION / 1000 * np.sin(2 * np.pi * 1000 * t)
+    blocks = np.exp(1j * phase).astype(np.complex64).reshape(-1, block)
+    processed = 0
+    start = time.process_time()
+    while (time.process_time() - start < seconds):
+        for samples in blocks:
+            for demod in demods:
+                demod.process(samples)
+        processed += radios * blocks.size
+    elapsed = time.process_time() - start
+    return processed / SAMPLE_RATE / elapsed
+
+
+def main(ports, mode='fm', output='audio', ip='0.0.0.0', deviation=FM_DEVIATION, deemphasis=DEEMPHASIS,
+         bandwidth=AUDIO_BANDWIDTH, volume=VOLUME, duration=None):
+    if (output == '-' and len(ports) > 1):
+        raise ValueError('only one stream can be written to stdout')
+    from udp_receiver import StreamReceiver
+    # Keep stdout for the audio
+    log = sys.stderr if output == '-' else sys.stdout
+    receivers, writers = [], []
+    selector = selectors.DefaultSelector()
+    for port in ports:
+        if (output == '-'):
+            path = output
+        elif (len(ports) == 1):
+            path = output if output.endswith('.wav') else output + '.wav'
+        else:
+            path = f"{output.rsplit('.wav', 1)[0]}_{port}.wav"
+        writer = PcmWriter(path)
+        demod = Demodulator(mode, deviation=deviation, deemphasis=deemphasis, bandwidth=bandwidth, sink=writer)
+        receiver = StreamReceiver(port, ip, sink=lambda samples, demod=demod: demod.process(samples, volume))
+        receivers.append(receiver)
+        writers.append(writer)
+        selector.register(receiver, selectors.EVENT_READ)
+        print(f"Demodulating {mode.upper()} from {ip}:{port} to {'stdout' if path == '-' else path}", file=log)
+
+    start = time.monotonic()
+    try:
+        while (duration is None or time.monotonic() - start < duration):
+            for key, _ in selector.select(timeout=0.1):
+                key.fileobj.poll()
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        for receiver, writer in zip(receivers, writers):
+            receiver.close()
+            writer.close()
+    for receiver, writer in zip(receivers, writers):
+        print(f'{receiver.port}: {writer.samples_written / AUDIO_RATE:.1f} s of audio, {receiver.tracker.received} '
+              f'packets received, {receiver.tracker.lost} lost', file=log)
+    return writers
+
+
+if __name__ == '__main__':
+    description = "AM/FM demodulator - Demodulates radio UDP streams to 48 kHz PCM audio in WAV files or on stdout"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-p', '--ports', nargs='+', type=int, help='UDP ports to receive, one stream per port', default=[25344])
+    parser.add_argument('-i', '--ip', help='Local IP address to receive on', default='0.0.0.0')
+    parser.add_argument('-m', '--mode', choices=MODES, help='Demodulation', default='fm')
+    parser.add_argument('-o', '--output', help="WAV file (<OUTPUT>_<port>.wav with several ports), or - for raw PCM on stdout", default='audio.wav')
+    parser.add_argument('-d', '--deviation', type=float, help='FM peak deviation (Hz) for full scale audio', default=FM_DEVIATION)
+    parser.add_argument('-e', '--deemphasis', type=float, help='FM de-emphasis time constant (us), 0 for none', default=DEEMPHASIS * 1e6)
+    parser.add_argument('-b', '--bandwidth', type=float, help='Audio bandwidth (Hz)', default=AUDIO_BANDWIDTH)
+    parser.add_argument('-v', '--volume', type=float, help='Full scale audio as a fraction of the PCM range', default=VOLUME)
+    parser.add_argument('-t', '--time', type=float, help='Seconds to run (default: until Ctrl-C)', default=None)
+    parser.add_argument('--benchmark', type=int, nargs='?', const=24, help='Time the demodulation of BENCHMARK streams and exit', default=None)
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        realtime = benchmark(args.mode, args.benchmark)
+        print(f'{args.benchmark} {args.mode.upper()} streams: {realtime:.0f}x real time on one core, '
+              f'about {realtime:.0f} streams per core')
+    else:
+        main(args.ports, args.mode, args.output, args.ip, args.deviation, args.deemphasis * 1e-6, args.bandwidth,
+             args.volume, args.time)
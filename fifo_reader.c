@@ -1,66 +1,968 @@
+#define _GNU_SOURCE
 #include <stdio.h>
 #include <stdlib.h>
-#include <sys/mman.h> 
-#include <fcntl.h> 
+#include <sys/mman.h>
+#include <fcntl.h>
 #include <unistd.h>
 #include <sys/socket.h>
+#include <sys/un.h>
 #include <arpa/inet.h>
 #include <string.h>
-#define _BSD_SOURCE
+#include <errno.h>
+#include <stdint.h>
+#include <poll.h>
+#include <time.h>
+#include <sys/resource.h>
+#include <math.h>
+
+// Radio register locations, read for the extended header
+#define RADIO_BASE_ADDR 0x43c00000
+#define RADIO_ADC_OFFSET 0
+#define RADIO_TUNER_OFFSET 1
+#define RADIO_TIMER_OFFSET 3
+#define TIMER_HZ 125000000ULL
 
 // Radio FIFO register locations
 #define FIFO_BASE_ADDR 0x43c10000
 #define FIFO_DATA_OFFSET 0
 #define FIFO_COUNT_OFFSET 1
+#define FIFO_DEPTH 512
+
+// UDP packet ring: each slot is a header followed by interleaved I/Q samples, by default a 16-bit sequence number and
+// 256 samples. Slots are sized for the largest packet that fits a 9000-byte MTU, so the format can change in place
+#define SAMPLES_PER_PACKET 256
+#define MAX_SAMPLES_PER_PACKET 2236
+#define LEGACY_HEADER_WORDS 1
+#define EXT_HEADER_WORDS 14
+#define SLOT_WORDS (EXT_HEADER_WORDS + 2 * MAX_SAMPLES_PER_PACKET)
+#define NUM_SLOTS 8
+
+// Extended header (-x), little endian like the samples, see packet_ring.py
+#define EXT_VERSION 2
+struct ext_header {
+    uint16_t seq;
+    uint8_t version;
+    uint8_t flags;
+    uint16_t header_bytes;
+    uint16_t samples;
+    uint64_t timer;
+    uint32_t tuner_inc;
+    uint32_t adc_inc;
+    uint32_t send_delay;
+} __attribute__((packed));
+
+// Compressed samples (-z bfp12|bfp8, extended header only), see packet_ring.py and iq_compression.py: each frame's
+// I/Q is shifted right by its block exponent and packed into 12 or 8 bits per value, the format code and exponent
+// go in the header flags
+#define NUM_COMPRESSIONS 3
+#define FLAGS_FORMAT_SHIFT 4
+static const char *compression_names[NUM_COMPRESSIONS] = {"none", "bfp12", "bfp8"};
+static const int compression_bits[NUM_COMPRESSIONS] = {16, 12, 8};
+
+// Spectrum frames (-s NFFT), see packet_ring.py and spectrum_frames.py: averaged power spectra computed here are sent
+// instead of the samples, one byte per bin in SPEC_DB_STEP steps below the frame's peak
+#define SPEC_VERSION 3
+#define SPEC_HEADER_BYTES 40
+#define SPEC_BINS_PER_DATAGRAM 1024
+#define SPEC_DB_STEP 0.5f
+#define SPEC_CODES 255
+#define MIN_SPECTRUM_NFFT 64
+#define MAX_SPECTRUM_NFFT 32768
+#define SPECTRUM_RATE 2.0
+struct spec_header {
+    uint16_t seq;
+    uint8_t version;
+    uint8_t flags;
+    uint16_t header_bytes;
+    uint16_t bins;
+    uint64_t timer;
+    uint32_t tuner_inc;
+    uint32_t adc_inc;
+    uint32_t frame;
+    uint16_t nfft;
+    uint16_t first_bin;
+    uint16_t averages;
+    uint16_t db_step;
+    float ref_db;
+} __attribute__((packed));
+
+// Radio output sample rate, 125 MHz decimated by 2560, used to sleep until a packet's worth of samples is ready
+#define SAMPLE_RATE (125000000.0 / 2560)
+
+// Ways to wait for the FIFO: spin on the count register, sleep for the expected fill time, or wait for a UIO interrupt
+enum wait_mode { WAIT_POLL, WAIT_SLEEP, WAIT_UIO };
+
+// Destinations the same packet stream is sent to, given as ip/port pairs on the command line or over the control socket
+#define MAX_DESTS 16
+
+// Control socket commands and replies are single datagrams of text
+#define CONTROL_MSG_LEN 512
+
+struct destination {
+    struct sockaddr_in addr;
+    int socket_desc;
+};
+
+static struct destination dests[MAX_DESTS];
+static int num_dests = 0;
+static int paused = 0;
+
+// Frame format, and a change asked for over the control socket, which is made between packets
+static unsigned int samples_per_packet = SAMPLES_PER_PACKET;
+static int extended_header = 0;
+static unsigned int next_samples_per_packet = 0;
+static int next_extended_header = 0;
+static int compression = 0;
+static int next_compression = 0;
+
+// Spectrum mode: the FFT plan (bit reversal and twiddle tables) and the buffers are allocated once per FFT size by
+// spectrum_plan(), nfft is 0 when streaming samples. A change asked for over the control socket is made between packets
+struct spectrum {
+    unsigned int nfft;
+    unsigned int averages;
+    unsigned int fill;
+    unsigned int segments;
+    uint32_t frame;
+    float scale;
+    float ref_db;
+    float *window;
+    float *twiddle;
+    uint32_t *bitrev;
+    float *segment;
+    float *accum;
+    uint8_t *codes;
+};
+static struct spectrum spec;
+static double spectrum_rate = SPECTRUM_RATE;
+static int spectrum_change = 0;
+static unsigned int next_spectrum_nfft = 0;
+static double next_spectrum_rate = SPECTRUM_RATE;
+
+// Counters reported by the "stats" command
+static uint64_t packets_built = 0;
+static uint64_t datagrams_sent = 0;
+static uint64_t samples_read = 0;
+static uint64_t wakeups = 0;
+static unsigned int fifo_high_water = 0;
+static uint64_t fifo_overflows = 0;
+static uint64_t spectrum_frames = 0;
+static struct timespec start_time;
+
+// Drain to send latency of extended-header packets, in the bins of timestamps.py: 0-3 us, then quarter octaves
+#define LATENCY_BINS 104
+static uint64_t latency_counts[LATENCY_BINS];
+static uint64_t latency_count = 0;
+static uint64_t latency_max_us = 0;
+
+// The radio timer register, extended to 64 bits by extend_timer()
+static volatile unsigned int *timer_reg = NULL;
+static uint64_t timer_high = 0;
+static uint32_t timer_last = 0;
+static int timer_started = 0;
 
 volatile unsigned int * get_a_pointer(unsigned int phys_addr) {
-	int mem_fd = open("/dev/mem", O_RDWR | O_SYNC); 
-	void *map_base = mmap(0, 4096, PROT_READ | PROT_WRITE, MAP_SHARED, mem_fd, phys_addr); 
-	volatile unsigned int *radio_base = (volatile unsigned int *)map_base; 
+	int mem_fd = open("/dev/mem", O_RDWR | O_SYNC);
+	void *map_base = mmap(0, 4096, PROT_READ | PROT_WRITE, MAP_SHARED, mem_fd, phys_addr);
+	volatile unsigned int *radio_base = (volatile unsigned int *)map_base;
 	return (radio_base);
 }
 
+// Extends a 32-bit timer reading to 64 bits, as timestamps.py does: the first reading is put in the 2^32-tick period
+// nearest CLOCK_MONOTONIC counted in timer ticks, so every reader on the board agrees, then each wrap is counted
+uint64_t extend_timer(uint32_t raw) {
+    if (!timer_started) {
+        struct timespec now;
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        int64_t mono_ticks = (int64_t)now.tv_sec * TIMER_HZ + now.tv_nsec / 8;
+        int64_t periods = (mono_ticks - raw + (1LL << 31)) >> 32;
+        timer_high = periods > 0 ? (uint64_t)periods << 32 : 0;
+        timer_started = 1;
+    } else if (raw < timer_last) {
+        timer_high += 1ULL << 32;
+    }
+    timer_last = raw;
+    return timer_high + raw;
+}
+
+int latency_bin(uint64_t us) {
+    if (us < 4) {
+        return (int)us;
+    }
+    int msb = 63 - __builtin_clzll(us);
+    int bin = 4 * (msb - 1) + (int)((us >> (msb - 2)) & 3);
+    return bin < LATENCY_BINS ? bin : LATENCY_BINS - 1;
+}
+
+// Returns the upper edge (us) of the bin holding the given percentile
+uint64_t latency_percentile(double percent) {
+    double needed = percent / 100 * latency_count;
+    uint64_t seen = 0;
+    for (int bin = 0; bin < LATENCY_BINS && latency_count > 0; bin++) {
+        seen += latency_counts[bin];
+        if (latency_counts[bin] > 0 && seen >= needed) {
+            int next = bin + 1;
+            uint64_t edge = next < 4 ? (uint64_t)next : (uint64_t)(4 + next % 4) << (next / 4 - 1);
+            return edge < latency_max_us ? edge : latency_max_us;
+        }
+    }
+    return latency_max_us;
+}
+
+// Sends the queued slots [first, first + count) in as few system calls as possible
+// Datagrams refused by the socket (e.g. ECONNREFUSED after an ICMP port unreachable) are dropped
+void send_slots(int socket_desc, struct mmsghdr *msgs, int first, int count) {
+    while (count > 0) {
+        int sent = sendmmsg(socket_desc, &msgs[first], count, 0);
+        if (sent < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            if (errno == ENOSYS) {
+                send(socket_desc, msgs[first].msg_hdr.msg_iov->iov_base, msgs[first].msg_hdr.msg_iov->iov_len, 0);
+            }
+            sent = 1;
+        }
+        first += sent;
+        count -= sent;
+    }
+}
+
+// Sends the queued ring slots [first, first + count), which may wrap around the end of the ring, to every destination
+// Nothing is sent while streaming is paused, but the FIFO is still drained so it never overflows
+// Extended headers get the ticks from the drain of the packet's first sample until now, which are also counted as the
+// drain to send latency
+void flush_slots(struct mmsghdr *msgs, int first, int count) {
+    int to_end = NUM_SLOTS - first;
+    if (paused) {
+        return;
+    }
+    if (extended_header && spec.nfft == 0 && num_dests > 0) {
+        uint64_t now = extend_timer(*timer_reg);
+        for (int i = 0; i < count; i++) {
+            struct ext_header *header = msgs[(first + i) % NUM_SLOTS].msg_hdr.msg_iov->iov_base;
+            uint64_t delay = now - header->timer;
+            uint64_t us = delay / (TIMER_HZ / 1000000);
+            header->send_delay = delay < 0xFFFFFFFF ? (uint32_t)delay : 0xFFFFFFFF;
+            latency_counts[latency_bin(us)]++;
+            latency_count++;
+            if (us > latency_max_us) {
+                latency_max_us = us;
+            }
+        }
+    }
+    for (int d = 0; d < num_dests; d++) {
+        if (count > to_end) {
+            send_slots(dests[d].socket_desc, msgs, first, to_end);
+            send_slots(dests[d].socket_desc, msgs, 0, count - to_end);
+        } else {
+            send_slots(dests[d].socket_desc, msgs, first, count);
+        }
+    }
+    datagrams_sent += (uint64_t)count * num_dests;
+}
+
+// Returns the index of a compression name in compression_names, or -1
+int compression_code(const char *name) {
+    for (int code = 0; code < NUM_COMPRESSIONS; code++) {
+        if (strcmp(name, compression_names[code]) == 0) {
+            return code;
+        }
+    }
+    return -1;
+}
+
+// Returns the bytes the samples of a frame take, padded to a multiple of 4
+unsigned int sample_bytes(unsigned int samples, int code) {
+    return (samples * 2 * compression_bits[code] + 31) / 32 * 4;
+}
+
+// Compresses a frame's interleaved I/Q in place: shifts it right by the block exponent, the fewest bits that fit its
+// largest sample, rounding to the nearest step, and packs the values into 12 (I in the low and Q in the high bits of
+// 3 bytes) or 8 bits, then zeros the padding. Each sample's packed bytes end before the next sample starts, so the
+// packing can overwrite the samples as it goes. Returns the exponent
+unsigned int compress_samples(int16_t *iq, unsigned int samples, int code) {
+    int bits = compression_bits[code];
+    int32_t top = (1 << (bits - 1)) - 1;
+    int32_t high = 0;
+    int32_t low = 0;
+    for (unsigned int i = 0; i < 2 * samples; i++) {
+        if (iq[i] > high) {
+            high = iq[i];
+        } else if (iq[i] < low) {
+            low = iq[i];
+        }
+    }
+    int32_t peak = high > ~low ? high : ~low;
+    unsigned int length = 0;
+    while (peak >> length) {
+        length++;
+    }
+    unsigned int exponent = length + 1 > (unsigned int)bits ? length + 1 - bits : 0;
+    int32_t half = exponent > 0 ? 1 << (exponent - 1) : 0;
+    uint8_t *packed = (uint8_t *)iq;
+    uint8_t *p = packed;
+    for (unsigned int k = 0; k < samples; k++) {
+        int32_t i_val = (iq[2 * k] + half) >> exponent;
+        int32_t q_val = (iq[2 * k + 1] + half) >> exponent;
+        i_val = i_val < top ? i_val : top;
+        q_val = q_val < top ? q_val : top;
+        if (bits == 8) {
+            *p++ = (uint8_t)i_val;
+            *p++ = (uint8_t)q_val;
+        } else {
+            *p++ = (uint8_t)i_val;
+            *p++ = (uint8_t)(((i_val >> 8) & 0x0F) | ((q_val & 0x0F) << 4));
+            *p++ = (uint8_t)(q_val >> 4);
+        }
+    }
+    memset(p, 0, packed + sample_bytes(samples, code) - p);
+    return exponent;
+}
+
+// Returns 1 if nfft and rate are a valid spectrum mode, nfft 0 being streaming the samples
+int spectrum_valid(unsigned long nfft, double rate) {
+    if (nfft == 0) {
+        return 1;
+    }
+    return nfft >= MIN_SPECTRUM_NFFT && nfft <= MAX_SPECTRUM_NFFT && (nfft & (nfft - 1)) == 0 && rate > 0;
+}
+
+// Sets up spectrum mode for nfft-point spectra at about rate frames per second, or streaming the samples for nfft 0:
+// the Hann window (scaled to int16 full scale), the twiddle factors and bit reversal of a radix-2 FFT, and the
+// buffers, which are only reallocated when the FFT size changes. Returns 0 on success
+int spectrum_plan(unsigned int nfft, double rate) {
+    if (nfft != spec.nfft) {
+        free(spec.window);
+        free(spec.twiddle);
+        free(spec.bitrev);
+        free(spec.segment);
+        free(spec.accum);
+        free(spec.codes);
+        memset(&spec, 0, sizeof(spec));
+        if (nfft == 0) {
+            return 0;
+        }
+        spec.window = malloc(nfft * sizeof(float));
+        spec.twiddle = malloc(nfft * sizeof(float));
+        spec.bitrev = malloc(nfft * sizeof(uint32_t));
+        spec.segment = malloc(2 * nfft * sizeof(float));
+        spec.accum = calloc(nfft, sizeof(float));
+        spec.codes = malloc(nfft);
+        if (!spec.window || !spec.twiddle || !spec.bitrev || !spec.segment || !spec.accum || !spec.codes) {
+            spectrum_plan(0, rate);
+            return -1;
+        }
+        unsigned int bits = __builtin_ctz(nfft);
+        double window_power = 0;
+        for (unsigned int i = 0; i < nfft; i++) {
+            double w = 0.5 - 0.5 * cos(2 * M_PI * i / (nfft - 1));
+            window_power += w * w;
+            spec.window[i] = (float)(w / 32768);
+            spec.bitrev[i] = 0;
+            for (unsigned int b = 0; b < bits; b++) {
+                spec.bitrev[i] |= ((i >> b) & 1) << (bits - 1 - b);
+            }
+        }
+        for (unsigned int k = 0; k < nfft / 2; k++) {
+            spec.twiddle[2 * k] = (float)cos(2 * M_PI * k / nfft);
+            spec.twiddle[2 * k + 1] = (float)-sin(2 * M_PI * k / nfft);
+        }
+        spec.nfft = nfft;
+        spec.scale = (float)(1.0 / (SAMPLE_RATE * window_power));
+    }
+    if (nfft > 0) {
+        long averages = lround(SAMPLE_RATE / (rate * nfft));
+        spec.averages = averages < 1 ? 1 : averages > 0xFFFF ? 0xFFFF : (unsigned int)averages;
+        spec.fill = 0;
+        spec.segments = 0;
+        memset(spec.accum, 0, nfft * sizeof(float));
+    }
+    spectrum_rate = rate;
+    return 0;
+}
+
+// In-place radix-2 FFT of the segment, whose samples were stored in bit-reversed order
+void spectrum_fft(void) {
+    float *x = spec.segment;
+    unsigned int n = spec.nfft;
+    for (unsigned int len = 2; len <= n; len <<= 1) {
+        unsigned int half = len >> 1;
+        unsigned int stride = 2 * (n / len);
+        for (unsigned int start = 0; start < n; start += len) {
+            float *a = &x[2 * start];
+            float *b = &x[2 * (start + half)];
+            const float *w = spec.twiddle;
+            for (unsigned int k = 0; k < half; k++, a += 2, b += 2, w += stride) {
+                float tr = b[0] * w[0] - b[1] * w[1];
+                float ti = b[0] * w[1] + b[1] * w[0];
+                b[0] = a[0] - tr;
+                b[1] = a[1] - ti;
+                a[0] += tr;
+                a[1] += ti;
+            }
+        }
+    }
+}
+
+// Reads up to count samples into the spectrum segment, windowed and in bit-reversed order, and adds the power spectrum
+// of every full segment to the frame. Stops once the frame has all its segments, returns the samples read
+unsigned int spectrum_read(volatile unsigned int *fifo, unsigned int count) {
+    unsigned int n = 0;
+    while (n < count) {
+        uint32_t sample = fifo[FIFO_DATA_OFFSET];
+        float w = spec.window[spec.fill];
+        float *pair = &spec.segment[2 * spec.bitrev[spec.fill]];
+        pair[0] = (int16_t)(sample & 0x0000FFFF) * w;
+        pair[1] = (int16_t)((sample & 0xFFFF0000) >> 16) * w;
+        n++;
+        if (++spec.fill == spec.nfft) {
+            spec.fill = 0;
+            spectrum_fft();
+            for (unsigned int k = 0; k < spec.nfft; k++) {
+                spec.accum[k] += spec.segment[2 * k] * spec.segment[2 * k] + spec.segment[2 * k + 1] * spec.segment[2 * k + 1];
+            }
+            if (++spec.segments == spec.averages) {
+                break;
+            }
+        }
+    }
+    return n;
+}
+
+// Quantizes the frame's summed power spectra to codes from -fs/2 to fs/2 (dB/Hz, full scale = 1.0, the top code at the
+// peak rounded up to a whole step), then starts the next frame
+void spectrum_quantize(void) {
+    float scale = spec.scale / spec.averages;
+    float peak = 0;
+    for (unsigned int k = 0; k < spec.nfft; k++) {
+        if (spec.accum[k] > peak) {
+            peak = spec.accum[k];
+        }
+    }
+    float peak_db = 10 * log10f(peak * scale + 1e-30f);
+    spec.ref_db = ceilf(peak_db / SPEC_DB_STEP) * SPEC_DB_STEP - SPEC_CODES * SPEC_DB_STEP;
+    for (unsigned int i = 0; i < spec.nfft; i++) {
+        float db = 10 * log10f(spec.accum[(i + spec.nfft / 2) % spec.nfft] * scale + 1e-30f);
+        long code = lrintf((db - spec.ref_db) / SPEC_DB_STEP);
+        spec.codes[i] = code < 0 ? 0 : code > SPEC_CODES ? SPEC_CODES : (uint8_t)code;
+    }
+    memset(spec.accum, 0, spec.nfft * sizeof(float));
+    spec.segments = 0;
+}
+
+// Adds a destination with its own connected socket, returns 0 on success
+int add_dest(const char *ip, const char *port) {
+    struct sockaddr_in dest_addr;
+    memset(&dest_addr, 0, sizeof(dest_addr));
+    dest_addr.sin_family = AF_INET;
+    dest_addr.sin_port = htons(strtol(port, NULL, 10)); // UDP port
+    if (inet_pton(AF_INET, ip, &dest_addr.sin_addr) != 1) { // IP address
+        return -1;
+    }
+    for (int d = 0; d < num_dests; d++) {
+        if (dests[d].addr.sin_addr.s_addr == dest_addr.sin_addr.s_addr && dests[d].addr.sin_port == dest_addr.sin_port) {
+            return -1;
+        }
+    }
+    if (num_dests >= MAX_DESTS) {
+        return -1;
+    }
+    int socket_desc = socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP);
+    if (socket_desc < 0 || connect(socket_desc, (struct sockaddr*)&dest_addr, sizeof(dest_addr)) < 0) {
+        if (socket_desc >= 0) {
+            close(socket_desc);
+        }
+        return -1;
+    }
+    dests[num_dests].addr = dest_addr;
+    dests[num_dests].socket_desc = socket_desc;
+    num_dests++;
+    return 0;
+}
+
+// Removes a destination and closes its socket, returns 0 on success
+int remove_dest(const char *ip, const char *port) {
+    struct in_addr addr;
+    uint16_t port_n = htons(strtol(port, NULL, 10));
+    if (inet_pton(AF_INET, ip, &addr) != 1) {
+        return -1;
+    }
+    for (int d = 0; d < num_dests; d++) {
+        if (dests[d].addr.sin_addr.s_addr == addr.s_addr && dests[d].addr.sin_port == port_n) {
+            close(dests[d].socket_desc);
+            dests[d] = dests[--num_dests];
+            return 0;
+        }
+    }
+    return -1;
+}
+
+int64_t elapsed_ns(const struct timespec *since) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (int64_t)(now.tv_sec - since->tv_sec) * 1000000000 + (now.tv_nsec - since->tv_nsec);
+}
+
+// Returns the CPU time used by the reader as a percentage of one core since it started
+double cpu_percent(void) {
+    struct rusage usage;
+    getrusage(RUSAGE_SELF, &usage);
+    double cpu_s = usage.ru_utime.tv_sec + usage.ru_stime.tv_sec + (usage.ru_utime.tv_usec + usage.ru_stime.tv_usec) / 1e6;
+    return 100.0 * cpu_s / (elapsed_ns(&start_time) / 1e9);
+}
+
+// Waits until about `needed` more samples are in the FIFO, or until a control command arrives
+// WAIT_SLEEP sleeps for the expected fill time, shortened by the measured wakeup latency so the FIFO never overflows
+// WAIT_UIO blocks on the UIO interrupt, with twice the fill time as a timeout in case an interrupt is missed
+void wait_for_samples(enum wait_mode mode, int ctl_desc, int uio_fd, unsigned int needed) {
+    static int64_t wake_latency_ns = 0;
+    struct pollfd fds[2];
+    int nfds = 0;
+    int64_t fill_ns = (int64_t)(needed * 1e9 / SAMPLE_RATE);
+    int64_t timeout_ns;
+    if (mode == WAIT_POLL) {
+        return;
+    }
+    if (mode == WAIT_UIO) {
+        fds[nfds].fd = uio_fd;
+        fds[nfds++].events = POLLIN;
+        timeout_ns = 2 * fill_ns;
+    } else {
+        timeout_ns = fill_ns - wake_latency_ns;
+        if (timeout_ns < 0) {
+            timeout_ns = 0;
+        }
+    }
+    if (ctl_desc >= 0) {
+        fds[nfds].fd = ctl_desc;
+        fds[nfds++].events = POLLIN;
+    }
+    struct timespec timeout = {timeout_ns / 1000000000, timeout_ns % 1000000000};
+    struct timespec before;
+    clock_gettime(CLOCK_MONOTONIC, &before);
+    int ready = ppoll(fds, nfds, &timeout, NULL);
+    wakeups++;
+    if (mode == WAIT_SLEEP && ready == 0) {
+        // track how much later than asked the sleep ends, as a running average
+        int64_t late_ns = elapsed_ns(&before) - timeout_ns;
+        wake_latency_ns += (late_ns - wake_latency_ns) / 8;
+    }
+    if (mode == WAIT_UIO && ready > 0 && (fds[0].revents & POLLIN)) {
+        // acknowledge the interrupt and unmask it again
+        uint32_t irq_count, enable = 1;
+        if (read(uio_fd, &irq_count, sizeof(irq_count)) == sizeof(irq_count)) {
+            write(uio_fd, &enable, sizeof(enable));
+        }
+    }
+}
+
+// Opens the control socket, a Unix datagram socket bound to path
+int open_control(const char *path) {
+    struct sockaddr_un ctl_addr;
+    int ctl_desc = socket(AF_UNIX, SOCK_DGRAM, 0);
+    memset(&ctl_addr, 0, sizeof(ctl_addr));
+    ctl_addr.sun_family = AF_UNIX;
+    strncpy(ctl_addr.sun_path, path, sizeof(ctl_addr.sun_path) - 1);
+    unlink(path);
+    if (ctl_desc < 0 || bind(ctl_desc, (struct sockaddr*)&ctl_addr, sizeof(ctl_addr)) < 0) {
+        perror("control socket");
+        exit(1);
+    }
+    return ctl_desc;
+}
+
+// Applies every command waiting on the control socket and replies to each sender, without blocking
+// Commands: "add IP PORT", "remove IP PORT", "set [IP PORT ...]", "pause", "resume", "list", "stats",
+// "format SAMPLES [ext|legacy] [none|bfp12|bfp8]", "spectrum NFFT [RATE]" (NFFT 0 to stream the samples again), "latency [reset]" (the
+// non-empty drain to send latency bins as BIN:COUNT)
+// Replies start with "ok" or "error", after the "#TOKEN" field a command may start with, so a client can tell the reply
+// to its latest command from a late reply to an earlier one
+void poll_control(int ctl_desc, uint16_t seq_num) {
+    char msg[CONTROL_MSG_LEN];
+    char reply[CONTROL_MSG_LEN];
+    struct sockaddr_un from;
+    socklen_t from_len;
+    ssize_t len;
+    while (1) {
+        from_len = sizeof(from);
+        len = recvfrom(ctl_desc, msg, sizeof(msg) - 1, MSG_DONTWAIT, (struct sockaddr*)&from, &from_len);
+        if (len < 0) {
+            return;
+        }
+        msg[len] = '\0';
+        char *token = NULL;
+        char *cmd = strtok(msg, " \n");
+        if (cmd != NULL && cmd[0] == '#') {
+            token = cmd;
+            cmd = strtok(NULL, " \n");
+        }
+        char *ip = strtok(NULL, " \n");
+        char *port = strtok(NULL, " \n");
+        int ok = 1;
+        reply[0] = '\0';
+        if (cmd == NULL) {
+            ok = 0;
+        } else if (strcmp(cmd, "add") == 0) {
+            ok = ip != NULL && port != NULL && add_dest(ip, port) == 0;
+        } else if (strcmp(cmd, "remove") == 0) {
+            ok = ip != NULL && port != NULL && remove_dest(ip, port) == 0;
+        } else if (strcmp(cmd, "set") == 0) {
+            // replace the whole table
+            while (num_dests > 0) {
+                close(dests[--num_dests].socket_desc);
+            }
+            while (ip != NULL && port != NULL) {
+                ok &= add_dest(ip, port) == 0;
+                ip = strtok(NULL, " \n");
+                port = strtok(NULL, " \n");
+            }
+        } else if (strcmp(cmd, "format") == 0) {
+            // the samples per packet, the header and the sample format come in the first three fields, compression
+            // is kept with the extended header and turned off without it unless given
+            unsigned long samples = ip != NULL ? strtoul(ip, NULL, 10) : 0;
+            char *name = strtok(NULL, " \n");
+            int ext = port == NULL ? extended_header : strcmp(port, "ext") == 0;
+            int code = name != NULL ? compression_code(name) : (ext ? compression : 0);
+            ok = samples >= 1 && samples <= MAX_SAMPLES_PER_PACKET &&
+                 (port == NULL || strcmp(port, "ext") == 0 || strcmp(port, "legacy") == 0) &&
+                 code >= 0 && (ext || code == 0);
+            if (ok) {
+                next_extended_header = ext;
+                next_compression = code;
+                next_samples_per_packet = samples;
+            }
+        } else if (strcmp(cmd, "spectrum") == 0) {
+            // the FFT size and the frame rate come in the first two fields
+            unsigned long nfft = ip != NULL ? strtoul(ip, NULL, 10) : 0;
+            double rate = port != NULL ? strtod(port, NULL) : spectrum_rate;
+            ok = ip != NULL && spectrum_valid(nfft, rate);
+            if (ok) {
+                next_spectrum_nfft = (unsigned int)nfft;
+                next_spectrum_rate = rate;
+                spectrum_change = 1;
+            }
+        } else if (strcmp(cmd, "pause") == 0) {
+            paused = 1;
+        } else if (strcmp(cmd, "resume") == 0) {
+            paused = 0;
+        } else if (strcmp(cmd, "list") == 0) {
+            size_t used = 0;
+            for (int d = 0; d < num_dests && used < sizeof(reply); d++) {
+                char ip_str[INET_ADDRSTRLEN];
+                inet_ntop(AF_INET, &dests[d].addr.sin_addr, ip_str, sizeof(ip_str));
+                used += snprintf(reply + used, sizeof(reply) - used, " %s %u", ip_str, ntohs(dests[d].addr.sin_port));
+            }
+        } else if (strcmp(cmd, "latency") == 0) {
+            size_t used = snprintf(reply, sizeof(reply), " max=%llu", (unsigned long long)latency_max_us);
+            for (int bin = 0; bin < LATENCY_BINS && used < sizeof(reply); bin++) {
+                if (latency_counts[bin] > 0) {
+                    used += snprintf(reply + used, sizeof(reply) - used, " %d:%llu", bin,
+                                     (unsigned long long)latency_counts[bin]);
+                }
+            }
+            if (ip != NULL && strcmp(ip, "reset") == 0) {
+                memset(latency_counts, 0, sizeof(latency_counts));
+                latency_count = 0;
+                latency_max_us = 0;
+            }
+        } else if (strcmp(cmd, "stats") == 0) {
+            snprintf(reply, sizeof(reply), " packets=%llu datagrams=%llu samples=%llu seq=%u paused=%d dests=%d"
+                     " cpu=%.1f hwm=%u overflows=%llu wakeups=%llu samples_per_packet=%u extended=%d sample_bits=%d"
+                     " latency_p50=%llu latency_p99=%llu latency_max=%llu spectrum_nfft=%u spectrum_frames=%llu",
+                     (unsigned long long)packets_built, (unsigned long long)datagrams_sent,
+                     (unsigned long long)samples_read, seq_num, paused, num_dests,
+                     cpu_percent(), fifo_high_water, (unsigned long long)fifo_overflows, (unsigned long long)wakeups,
+                     samples_per_packet, extended_header, compression_bits[compression],
+                     (unsigned long long)latency_percentile(50),
+                     (unsigned long long)latency_percentile(99), (unsigned long long)latency_max_us, spec.nfft,
+                     (unsigned long long)spectrum_frames);
+        } else {
+            ok = 0;
+        }
+        char out[2 * CONTROL_MSG_LEN + 8];
+        int out_len = snprintf(out, sizeof(out), "%s%s%s%s", token != NULL ? token : "", token != NULL ? " " : "",
+                               ok ? "ok" : "error", reply);
+        if (from_len > sizeof(sa_family_t)) {
+            sendto(ctl_desc, out, out_len, MSG_DONTWAIT, (struct sockaddr*)&from, from_len);
+        }
+    }
+}
+
 int main(int argc, char* argv[]) {
-    // Open memory mapped FIFO registers
-    volatile unsigned int *fifoBase = get_a_pointer(FIFO_BASE_ADDR);
-    
+    // Options: the control socket, through which the destinations can be changed while the reader keeps running,
+    // how to wait for the FIFO to fill, the radio and FIFO base addresses when a bitstream carries several radio cores,
+    // the frame format and sample format, and the spectrum mode
+    int ctl_desc = -1;
+    unsigned int radio_base_addr = RADIO_BASE_ADDR;
+    unsigned int fifo_base_addr = FIFO_BASE_ADDR;
+    int uio_fd = -1;
+    enum wait_mode mode = WAIT_SLEEP;
+    int opt;
+    while ((opt = getopt(argc, argv, "c:w:u:a:b:n:xz:s:r:")) != -1) {
+        if (opt == 'c') {
+            ctl_desc = open_control(optarg);
+        } else if (opt == 'w' && strcmp(optarg, "poll") == 0) {
+            mode = WAIT_POLL;
+        } else if (opt == 'w' && strcmp(optarg, "sleep") == 0) {
+            mode = WAIT_SLEEP;
+        } else if (opt == 'w' && strcmp(optarg, "uio") == 0) {
+            mode = WAIT_UIO;
+        } else if (opt == 'u') {
+            uio_fd = open(optarg, O_RDWR);
+            if (uio_fd < 0) {
+                perror(optarg);
+                return 1;
+            }
+        } else if (opt == 'a') {
+            radio_base_addr = (unsigned int)strtoul(optarg, NULL, 0);
+        } else if (opt == 'b') {
+            fifo_base_addr = (unsigned int)strtoul(optarg, NULL, 0);
+        } else if (opt == 'n') {
+            samples_per_packet = (unsigned int)strtoul(optarg, NULL, 10);
+            if (samples_per_packet < 1 || samples_per_packet > MAX_SAMPLES_PER_PACKET) {
+                fprintf(stderr, "-n must be 1 to %d samples\n", MAX_SAMPLES_PER_PACKET);
+                return 1;
+            }
+        } else if (opt == 'x') {
+            extended_header = 1;
+        } else if (opt == 'z') {
+            compression = compression_code(optarg);
+            if (compression < 0) {
+                fprintf(stderr, "-z must be none, bfp12 or bfp8\n");
+                return 1;
+            }
+        } else if (opt == 's') {
+            next_spectrum_nfft = (unsigned int)strtoul(optarg, NULL, 10);
+            spectrum_change = 1;
+        } else if (opt == 'r') {
+            next_spectrum_rate = strtod(optarg, NULL);
+        } else {
+            optind = argc + 1;
+            break;
+        }
+    }
+    if (mode == WAIT_UIO && uio_fd < 0) {
+        fprintf(stderr, "-w uio needs the interrupt device, e.g. -u /dev/uio0\n");
+        return 1;
+    }
+    if (compression > 0 && !extended_header) {
+        fprintf(stderr, "-z needs the extended header, -x\n");
+        return 1;
+    }
+    if (!spectrum_valid(next_spectrum_nfft, next_spectrum_rate)) {
+        fprintf(stderr, "-s must be a power of 2 from %d to %d, and -r a positive rate\n", MIN_SPECTRUM_NFFT, MAX_SPECTRUM_NFFT);
+        return 1;
+    }
+    if (optind > argc || (argc - optind) % 2 != 0 || (ctl_desc < 0 && argc - optind < 2)) {
+        fprintf(stderr, "usage: %s [-c control_socket] [-w poll|sleep|uio] [-u /dev/uioN] [-a radio_base_addr] [-b fifo_base_addr] [-n samples_per_packet] [-x] [-z none|bfp12|bfp8] [-s spectrum_nfft] [-r spectrum_rate] ip port [ip port ...]\n", argv[0]);
+        return 1;
+    }
+    if (uio_fd >= 0) {
+        uint32_t enable = 1;
+        write(uio_fd, &enable, sizeof(enable));
+    }
+    clock_gettime(CLOCK_MONOTONIC, &start_time);
+
+    // Open memory mapped radio and FIFO registers
+    volatile unsigned int *radioBase = get_a_pointer(radio_base_addr);
+    volatile unsigned int *fifoBase = get_a_pointer(fifo_base_addr);
+    timer_reg = &radioBase[RADIO_TIMER_OFFSET];
+
     // Initialize FIFO data & UDP packet variables
     int32_t sample;
     int16_t sample_I, sample_Q;
-    int16_t udpBuff[513] = {0};
-    uint16_t idx = 1;
-    int16_t seqNum = 0;
-    
-    // Create socket
-    int socket_desc = socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP);
-    struct sockaddr_in dest_addr;
-    int dest_addr_len = sizeof(dest_addr);
+    static int16_t udpBuff[NUM_SLOTS][SLOT_WORDS];
+    struct iovec iovs[NUM_SLOTS];
+    struct mmsghdr msgs[NUM_SLOTS];
+    int slot = 0;
+    int first_pending = 0;
+    int pending = 0;
+    unsigned int header_words = extended_header ? EXT_HEADER_WORDS : LEGACY_HEADER_WORDS;
+    // samples are read into the slot as 16-bit words up to packet_words, then compressed in place to packet_bytes
+    unsigned int packet_words = header_words + 2 * samples_per_packet;
+    unsigned int packet_bytes = 2 * header_words + sample_bytes(samples_per_packet, compression);
+    unsigned int idx = header_words;
+    // 16-bit sequence number, starting at 0 and wrapping from 65535 to 0
+    uint16_t seqNum = 0;
+    // radio state when the current packet's first sample was read, for the extended header, and the time of each drain
+    struct ext_header header;
+    uint64_t drain_timer;
+    memset(&header, 0, sizeof(header));
+
+    // Each slot is sent in place, so the message headers are built once
+    memset(msgs, 0, sizeof(msgs));
+    for (int i = 0; i < NUM_SLOTS; i++) {
+        iovs[i].iov_base = udpBuff[i];
+        iovs[i].iov_len = packet_bytes;
+        msgs[i].msg_hdr.msg_iov = &iovs[i];
+        msgs[i].msg_hdr.msg_iovlen = 1;
+    }
+
+    // Create one socket per destination, connecting each so sends need no address
+    for (int arg = optind; arg + 1 < argc; arg += 2) {
+        if (add_dest(argv[arg], argv[arg + 1]) != 0) {
+            fprintf(stderr, "invalid destination %s:%s\n", argv[arg], argv[arg + 1]);
+        }
+    }
 
-    // Set port and IP
-    dest_addr.sin_family = AF_INET;
-    dest_addr.sin_port = htons(strtol(argv[2], NULL, 10)); // UDP port
-    dest_addr.sin_addr.s_addr = inet_addr(argv[1]); // IP address
-    
     // Main loop
-    unsigned int count = fifoBase[FIFO_COUNT_OFFSET];
     while(1) {
-        if (count > 0) {
-            sample = fifoBase[FIFO_DATA_OFFSET];
-            sample_I = (int16_t)(sample & 0x0000FFFF);
-            sample_Q = (int16_t)((sample & 0xFFFF0000) >> 16);
-            udpBuff[idx++] = sample_I;
-            udpBuff[idx++] = sample_Q;
-            if (idx > 512) {
-                // send packet
-                sendto(socket_desc, udpBuff, sizeof(udpBuff), 0, (struct sockaddr*)&dest_addr, dest_addr_len);
-                // clear buffer, reset index
-                memset(udpBuff, 0, sizeof(udpBuff));
-                idx = 0;
-                // set new sequence number
+        // drain everything the count register reports without reading it again per sample
+        unsigned int count = fifoBase[FIFO_COUNT_OFFSET];
+        // read on every drain, also without extended headers, so no timer wrap is missed
+        drain_timer = extend_timer(*timer_reg);
+        if (count > fifo_high_water) {
+            fifo_high_water = count;
+        }
+        // a full FIFO means the radio has been dropping samples since the last drain
+        if (count >= FIFO_DEPTH) {
+            fifo_overflows++;
+        }
+        // a packet may span several drains, and a drain several packets
+        unsigned int n = 0;
+        while (n < count) {
+            if (spectrum_change && (spec.nfft > 0 || idx == header_words)) {
+                // switch between samples and spectra once the packet being filled is complete, sending what is
+                // queued first; a partly computed spectrum is dropped
+                if (pending > 0) {
+                    flush_slots(msgs, first_pending, pending);
+                    first_pending = (first_pending + pending) % NUM_SLOTS;
+                    pending = 0;
+                }
+                if (spectrum_plan(next_spectrum_nfft, next_spectrum_rate) != 0) {
+                    fprintf(stderr, "no memory for %u-point spectra, streaming the samples\n", next_spectrum_nfft);
+                }
+                spectrum_change = 0;
+                unsigned int spec_bins = spec.nfft < SPEC_BINS_PER_DATAGRAM ? spec.nfft : SPEC_BINS_PER_DATAGRAM;
+                for (int i = 0; i < NUM_SLOTS; i++) {
+                    iovs[i].iov_len = spec.nfft > 0 ? SPEC_HEADER_BYTES + spec_bins : packet_bytes;
+                }
+                idx = header_words;
+            }
+            if (spec.nfft > 0) {
+                n += spectrum_read(fifoBase, count - n);
+                if (spec.segments < spec.averages) {
+                    continue;
+                }
+                // a frame is complete: quantize it and split it over datagrams, stamped with this drain's time
+                spectrum_quantize();
+                struct spec_header spec_header;
+                spec_header.version = SPEC_VERSION;
+                spec_header.flags = 0;
+                spec_header.header_bytes = SPEC_HEADER_BYTES;
+                spec_header.bins = spec.nfft < SPEC_BINS_PER_DATAGRAM ? spec.nfft : SPEC_BINS_PER_DATAGRAM;
+                spec_header.timer = drain_timer;
+                spec_header.tuner_inc = radioBase[RADIO_TUNER_OFFSET];
+                spec_header.adc_inc = radioBase[RADIO_ADC_OFFSET];
+                spec_header.frame = spec.frame++;
+                spec_header.nfft = (uint16_t)spec.nfft;
+                spec_header.averages = (uint16_t)spec.averages;
+                spec_header.db_step = (uint16_t)lrintf(100 * SPEC_DB_STEP);
+                spec_header.ref_db = spec.ref_db;
+                for (unsigned int first = 0; first < spec.nfft; first += spec_header.bins) {
+                    spec_header.seq = seqNum;
+                    spec_header.first_bin = (uint16_t)first;
+                    memcpy(udpBuff[slot], &spec_header, sizeof(spec_header));
+                    memcpy((uint8_t *)udpBuff[slot] + SPEC_HEADER_BYTES, spec.codes + first, spec_header.bins);
+                    packets_built++;
+                    pending++;
+                    if (pending == NUM_SLOTS) {
+                        flush_slots(msgs, first_pending, pending);
+                        pending = 0;
+                    }
+                    slot = (slot + 1) % NUM_SLOTS;
+                    seqNum++;
+                }
+                spectrum_frames++;
+                continue;
+            }
+            if (idx == header_words) {
+                // start of a packet: change the format if asked, sending what is queued in the old one first
+                if (next_samples_per_packet > 0) {
+                    if (pending > 0) {
+                        flush_slots(msgs, first_pending, pending);
+                        first_pending = (first_pending + pending) % NUM_SLOTS;
+                        pending = 0;
+                    }
+                    samples_per_packet = next_samples_per_packet;
+                    extended_header = next_extended_header;
+                    compression = next_compression;
+                    next_samples_per_packet = 0;
+                    header_words = extended_header ? EXT_HEADER_WORDS : LEGACY_HEADER_WORDS;
+                    packet_words = header_words + 2 * samples_per_packet;
+                    packet_bytes = 2 * header_words + sample_bytes(samples_per_packet, compression);
+                    idx = header_words;
+                    for (int i = 0; i < NUM_SLOTS; i++) {
+                        iovs[i].iov_len = packet_bytes;
+                    }
+                }
+                if (extended_header) {
+                    header.timer = drain_timer;
+                    header.tuner_inc = radioBase[RADIO_TUNER_OFFSET];
+                    header.adc_inc = radioBase[RADIO_ADC_OFFSET];
+                }
+            }
+            unsigned int take = (packet_words - idx) / 2;
+            if (take > count - n) {
+                take = count - n;
+            }
+            for (unsigned int i = 0; i < take; i++) {
+                sample = fifoBase[FIFO_DATA_OFFSET];
+                sample_I = (int16_t)(sample & 0x0000FFFF);
+                sample_Q = (int16_t)((sample & 0xFFFF0000) >> 16);
+                udpBuff[slot][idx++] = sample_I;
+                udpBuff[slot][idx++] = sample_Q;
+            }
+            n += take;
+            if (idx >= packet_words) {
+                // write the header now the samples are in place, compressing them first
+                if (extended_header) {
+                    header.flags = 0;
+                    if (compression > 0) {
+                        unsigned int exponent = compress_samples(&udpBuff[slot][header_words], samples_per_packet,
+                                                                 compression);
+                        header.flags = (uint8_t)(compression << FLAGS_FORMAT_SHIFT | exponent);
+                    }
+                    header.seq = seqNum;
+                    header.version = EXT_VERSION;
+                    header.header_bytes = 2 * EXT_HEADER_WORDS;
+                    header.samples = samples_per_packet;
+                    header.send_delay = 0;
+                    memcpy(udpBuff[slot], &header, sizeof(header));
+                } else {
+                    udpBuff[slot][0] = (int16_t)seqNum;
+                }
+                // queue packet, sending once the ring is full
+                packets_built++;
+                pending++;
+                if (pending == NUM_SLOTS) {
+                    flush_slots(msgs, first_pending, pending);
+                    pending = 0;
+                }
+                // move to the next slot, every word of which is overwritten before it is sent
+                slot = (slot + 1) % NUM_SLOTS;
+                idx = header_words;
                 seqNum++;
-                udpBuff[idx++] = seqNum;
             }
         }
-        count = fifoBase[FIFO_COUNT_OFFSET];
+        samples_read += count;
+        if (count > 0) {
+            continue;
+        }
+
+        // FIFO drained, send what is queued rather than waiting for a full batch
+        if (pending > 0) {
+            flush_slots(msgs, first_pending, pending);
+            first_pending = (first_pending + pending) % NUM_SLOTS;
+            pending = 0;
+        }
+        // apply any control commands between packets, then wait for the rest of the current packet, at most half the
+        // FIFO so a jumbo packet, which takes several drains, never lets it fill
+        if (ctl_desc >= 0) {
+            poll_control(ctl_desc, seqNum);
+        }
+        // spectrum mode has no packet to wait for
+        unsigned int needed = spec.nfft > 0 ? FIFO_DEPTH / 2 : samples_per_packet - (idx - header_words) / 2;
+        wait_for_samples(mode, ctl_desc, uio_fd, needed < FIFO_DEPTH / 2 ? needed : FIFO_DEPTH / 2);
     }
-}
\ No newline at end of file
+}
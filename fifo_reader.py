@@ -3,14 +3,12 @@
 ### Linux SDR Milestone 2 - Radio + Custom FIFO Peripheral
 # Demonstrates radio FIFO by reading 480,000 samples from the FIFO
 
-import os
 import argparse
-import subprocess
-import mmap
-import struct
-import math
 import time
 import socket
+from registers import open_radio, freq_to_inc, inc_to_freq, DEFAULT_SIM_PATH, SIM_SOURCES, FIFO_DEPTH
+from iq_recorder import CaptureWriter, record, DEFAULT_FILE_SAMPLES
+from startup import load_bitstreams
 
 # Define memory-mapped peripheral addresses and offsets
 radio_periph_base_addr = 0x43c00000
@@ -22,14 +20,9 @@ fifo_base_addr = 0x43c10000
 fifo_data_offset = 0x00
 fifo_count_offset = 0x04
 
-# Define constants
-SAMP_FREQ = 125000000
-PHASE_RESOLUTION_BITS = 27
-
-# Open memory-mapped peripheral location
-file = os.open('/dev/mem', os.O_RDWR, os.O_SYNC)
-mem_radio = mmap.mmap(file, 4096, offset=radio_periph_base_addr)
-mem_fifo = mmap.mmap(file, 4096, offset=fifo_base_addr)
+# Memory-mapped peripheral registers, opened in main()
+mem_radio = None
+mem_fifo = None
 
 # Misc global variables
 mute = 0
@@ -40,14 +33,13 @@ def set_radio_reg(dev, offset, val):
     Sets the value of the specified radio control register
 
     Parameters:
-        dev (hex): the memory mapped device to write to, from {mem_radio, mem_fifo}
+        dev (registers): the register window to write to, from {mem_radio, mem_fifo}
         offset (hex): the desired register memory offset value, from {adc_offset, tuner_offset, ctrl_offset, timer_offset}
         val (int): the value to write to the specified register
     Returns:
         None  
     '''
-    dev.seek(offset)
-    dev.write(struct.pack('i', int(val)))
+    dev.write(offset, val)
 
 
 def get_radio_reg(dev, offset):
@@ -55,14 +47,13 @@ def get_radio_reg(dev, offset):
     Returns the value of the specified 32-bit radio control register
 
     Parameters:
-        dev (hex): the memory mapped device to write to, from {mem_radio, mem_fifo}
+        dev (registers): the register window to read from, from {mem_radio, mem_fifo}
         offset (hex): the specified register memory offset value, from {adc_offset, tuner_offset, ctrl_offset, timer_offset}
 
     Returns:
         val (int): the value from the specified register
     '''
-    dev.seek(offset)
-    val = int.from_bytes(dev.read(4), 'little')
+    val = dev.read(offset)
     return val
 
 
@@ -76,21 +67,37 @@ def toggle_mute():
         print('    Unmuted')
 
 
-def freq_to_inc(freq):
+def record_samples(radio, prefix, num_samples, adc_phase_inc, tuner_phase_inc, file_samples, max_files):
     '''
-    Converts a desired frequency to a phase increment value for the DDS
+    Records num_samples samples to SigMF capture files instead of reading them one at a time
 
-        Parameters:
-            freq (int): the input frequency value to convert
+    Parameters:
+        radio (object): the register backend from open_radio()
+        prefix (str): the capture file prefix
+        num_samples (int): the number of samples to record
+        adc_phase_inc (int): the ADC phase increment that was set
+        tuner_phase_inc (int): the tuner phase increment that was set
+        file_samples (int): samples per capture file before rotating
+        max_files (int): keep only the latest max_files files, or 0 for all
 
-        Returns:
-            phase_inc (int): the phase increment value
+    Returns:
+        writer (CaptureWriter): the closed capture writer
     '''
-    phase_inc = math.floor((freq << PHASE_RESOLUTION_BITS) / SAMP_FREQ)
-    return phase_inc
+    writer = CaptureWriter(prefix, file_samples, max_files, inc_to_freq(adc_phase_inc), inc_to_freq(tuner_phase_inc))
+    try:
+        record(radio, writer, num_samples)
+    finally:
+        writer.close()
+    return writer
+
 
+def main(ip, num_samples, sim_path=None, sim_source='tone', record_prefix=None, file_samples=DEFAULT_FILE_SAMPLES,
+         max_files=0):
+    global mem_radio, mem_fifo
+    radio = open_radio(sim_path, sim_source)
+    mem_radio = radio.radio
+    mem_fifo = radio.fifo
 
-def main(ip, num_samples):
     adc_phase_inc = freq_to_inc(1001000)
     tuner_phase_inc = freq_to_inc(1000000)
 
@@ -98,6 +105,14 @@ def main(ip, num_samples):
     set_radio_reg(mem_radio, tuner_offset, tuner_phase_inc)
     
     print('\nLinux SDR with Ethernet Milestone 2 - Zach Hicks\n')
+    if record_prefix is not None:
+        print(f'Recording {num_samples} samples from the radio FIFO to {record_prefix}_*.sigmf-data...')
+        start = time.time()
+        writer = record_samples(radio, record_prefix, num_samples, adc_phase_inc, tuner_phase_inc, file_samples, max_files)
+        end = time.time()
+        print(f'Recording {writer.samples_written} samples took {end-start} seconds, about {writer.dropped_samples} samples dropped')
+        print('')
+        return
     print(f'Reading {num_samples} samples from the radio FIFO...')
     if (ip != '0'):
         udp_port = 25344
@@ -110,9 +125,13 @@ def main(ip, num_samples):
     samples_read = 0
     samples = []
     seq_num = 0
+    packets_sent = 0
+    fifo_overflows = 0
 
     while(samples_read <= num_samples):
         fifo_count = get_radio_reg(mem_fifo, fifo_count_offset)
+        if (fifo_count >= FIFO_DEPTH):
+            fifo_overflows += 1
         if (fifo_count > 0):
             sample = get_radio_reg(mem_fifo, fifo_data_offset)
             samples_read += 1
@@ -127,11 +146,13 @@ def main(ip, num_samples):
                         payload_bytes += samp_I.to_bytes(2, "little")
                         payload_bytes += samp_Q.to_bytes(2, "little")    
                     sock.sendto(payload_bytes, (ip, udp_port))
-                    seq_num += 1
+                    packets_sent += 1
+                    seq_num = (seq_num + 1) & 0xFFFF
                     samples = []
 
     end = time.time()
     print(f'Reading {num_samples} samples took {end-start} seconds')
+    print(f'FIFO found full {fifo_overflows} times, {packets_sent} packets sent')
     print('')
 
 if __name__ == '__main__':
@@ -139,11 +160,15 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('-d', '--ip', nargs='?', help='Destination IP address', default='0')
     parser.add_argument('-n', '--num_samps', nargs='?', help='Number of samples', default='480000')
+    parser.add_argument('-r', '--record', help='Record the samples to SigMF capture files <RECORD>_<index>.sigmf-data instead of streaming them', default=None)
+    parser.add_argument('--file_samples', type=int, help='Samples per capture file before rotating', default=DEFAULT_FILE_SAMPLES)
+    parser.add_argument('--max_files', type=int, help='Keep only the latest MAX_FILES capture files (default: keep all)', default=0)
+    parser.add_argument('--sim', nargs='?', const=DEFAULT_SIM_PATH, help='Run against a simulated radio backed by the given file instead of /dev/mem', default=None)
+    parser.add_argument('--sim_source', choices=SIM_SOURCES, help='Simulated sample source: tone, linear DDC model, or bit-accurate DDC model', default='tone')
+    parser.add_argument('--force', action='store_true', help='Reload the FPGA images even if they are already loaded')
     args = parser.parse_args()
 
-    codec_config_cmd = 'fpgautil -b config_codec.bit.bin'
-    radio_config_cmd = 'fpgautil -b design_1_wrapper.bit.bin'
-    subprocess.run(codec_config_cmd, shell=True)
-    subprocess.run(radio_config_cmd, shell=True)
+    if (args.sim is None):
+        load_bitstreams(force=args.force)
 
-    main(args.ip, int(args.num_samps))
\ No newline at end of file
+    main(args.ip, int(args.num_samps), args.sim, args.sim_source, args.record, args.file_samples, args.max_files)
\ No newline at end of file
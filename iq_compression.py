@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+### IQ frame compression
+# Block floating point compression of the sample frames (see packet_ring.py), for radios behind constrained links:
+# the DDC output rarely uses the full int16 range, so each frame is shifted right by its own block exponent, the
+# fewest bits that fit its largest sample, and its I/Q values packed into 12 (bfp12, 3 bytes per sample, 75 % of the
+# bandwidth) or 8 (bfp8, 2 bytes per sample, 50 %) bits. Frames whose samples fit are exact; louder frames are rounded
+# to the nearest step of their exponent (within one step at the very top of the range), so the quantization noise
+# follows the signal level frame by frame
+#   BfpEncoder     the board side, encodes one frame's FIFO words into its datagram as the frame completes, so
+#                  compression adds no latency, with NumPy operations on preallocated buffers
+#   decode_frames  the receiver side, decodes any number of frames of one format at once, each with its own exponent
+# fifo_reader.c implements the same encoder in C (-z bfp12|bfp8), packing each frame in place
+#
+# python3 iq_compression.py times the encoder and decoder and reports the compression error on a tone
+
+import argparse
+import time
+import numpy as np
+from packet_ring import COMPRESSIONS, COMPRESSION_BITS, sample_bytes
+
+# Define constants
+SAMPLES_PER_PACKET = 256
+
+
+class BfpEncoder():
+    '''
+    Encodes frames of samples_per_packet samples to a compressed sample format
+
+    code and bits are the format's index in COMPRESSIONS and its bits per value
+    '''
+
+    def __init__(self, samples_per_packet=SAMPLES_PER_PACKET, compression='bfp12'):
+        '''
+        Parameters:
+            samples_per_packet (int): the samples in each frame
+            compression (str): 'bfp12' or 'bfp8'
+
+        Raises:
+            ValueError: if compression is not a compressed format
+        '''
+        if compression not in COMPRESSIONS[1:]:
+            raise ValueError(f'compression must be one of {COMPRESSIONS[1:]}')
+        self.samples_per_packet = samples_per_packet
+        self.compression = compression
+        self.code = COMPRESSIONS.index(compression)
+        self.bits = COMPRESSION_BITS[self.code]
+        self.top = (1 << (self.bits - 1)) - 1
+        self.body_bytes = sample_bytes(samples_per_packet, compression)
+        self.values = np.zeros((samples_per_packet, 2), dtype=np.int32)
+        self.scratch = np.zeros(samples_per_packet, dtype=np.int32)
+
+
+    def encode(self, words, out):
+        '''
+        Encodes one frame
+
+        Parameters:
+            words (buffer): the frame's samples_per_packet FIFO words (Q in the upper and I in the lower 16 bits,
+                            little endian), e.g. an array('I') or a memoryview of one
+            out (buffer): the writable body_bytes after the frame's header, e.g. a memoryview of the packet slot
+
+        Returns:
+            exponent (int): the frame's block exponent, for the header flags
+        '''
+        iq = np.frombuffer(words, dtype='<i2').reshape(-1, 2)
+        packed = np.frombuffer(out, dtype=np.uint8)
+        values = self.values
+        peak = max(int(iq.max()), ~int(iq.min()))
+        exponent = max(0, peak.bit_length() + 1 - self.bits)
+        values[:] = iq
+        if exponent:
+            # Round to the nearest step, the top value can round up past the range
+            values += 1 << (exponent - 1)
+            values >>= exponent
+            np.minimum(values, self.top, out=values)
+        n = self.samples_per_packet
+        if (self.bits == 8):
+            np.copyto(packed[:2 * n].reshape(n, 2), values, casting='unsafe')
+        else:
+            # I in the low 12 bits and Q in the high 12 bits of 3 bytes
+            values &= 0xFFF
+            i, q, scratch = values[:, 0], values[:, 1], self.scratch
+            triples = packed[:3 * n].reshape(n, 3)
+            np.copyto(triples[:, 0], i, casting='unsafe')
+            np.right_shift(i, 8, out=scratch)
+            scratch |= (q & 0xF) << 4
+            np.copyto(triples[:, 1], scratch, casting='unsafe')
+            np.right_shift(q, 4, out=scratch)
+            np.copyto(triples[:, 2], scratch, casting='unsafe')
+        packed[(3 if self.bits == 12 else 2) * n:self.body_bytes] = 0
+        return exponent
+
+
+def decode_frames(bodies, samples_per_packet, compression, exponents):
+    '''
+    Decodes the samples of compressed frames of one format
+
+    Parameters:
+        bodies (ndarray): uint8 array of shape (num_frames, bytes), each row a frame's samples (the bytes after its
+                          header, at least sample_bytes())
+        samples_per_packet (int): the samples in each frame
+        compression (str): the frames' format, one of COMPRESSIONS
+        exponents (ndarray): the block exponent of each frame, from the header flags
+
+    Returns:
+        iq (ndarray): int16 array of shape (num_frames * samples_per_packet, 2), column 0 is I and column 1 is Q
+    '''
+    num = len(bodies)
+    n = samples_per_packet
+    if (compression == 'none'):
+        return np.ascontiguousarray(bodies[:, :4 * n]).view('<i2').reshape(-1, 2)
+    shifts = np.asarray(exponents, dtype=np.int16).reshape(num, 1, 1)
+    if (compression == 'bfp8'):
+        iq = np.ascontiguousarray(bodies[:, :2 * n]).view(np.int8).reshape(num, n, 2).astype(np.int16)
+    else:
+        triples = bodies[:, :3 * n].reshape(num, n, 3).astype(np.int16)
+        iq = np.empty((num, n, 2), dtype=np.int16)
+        # Assemble each 12-bit value in the top of an int16, then shift back down to sign-extend it
+        iq[..., 0] = (triples[..., 0] << 4) | ((triples[..., 1] & 0xF) << 12)
+        iq[..., 1] = (triples[..., 1] & 0xF0) | (triples[..., 2] << 8)
+        iq >>= 4
+    iq <<= shifts
+    return iq.reshape(-1, 2)
+
+
+def benchmark(compression='bfp12', samples_per_packet=SAMPLES_PER_PACKET, seconds=1.0):
+    '''
+    Times the encoder one frame at a time and the decoder on a batch of frames, and measures the error on a tone
+
+    Returns:
+        encode_us (float): the CPU time to encode one frame (us)
+        decode_rate (float): the samples decoded per second of one core's time
+        snr (float): the tone's signal to compression noise ratio (dB)
+    '''
+    encoder = BfpEncoder(samples_per_packet, compression)
+    frames = 256
+    phase = 2 * np.pi * 1000 / 48828.125 * np.arange(frames * samples_per_packet)
+    iq = (np.stack([np.cos(phase), np.sin(phase)], axis=1) * 12000).astype('<i2')
+    words = iq.view(np.uint32).reshape(frames, samples_per_packet)
+    bodies = np.zeros((frames, encoder.body_bytes), dtype=np.uint8)
+    exponents = np.zeros(frames, dtype=np.uint8)
+    encoded = 0
+    start = time.process_time()
+    while (time.process_time() - start < seconds):
+        for k in range(frames):
+            exponents[k] = encoder.encode(words[k], bodies[k])
+        encoded += frames
+    encode_us = 1e6 * (time.process_time() - start) / encoded
+    decoded = 0
+    start = time.process_time()
+    while (time.process_time() - start < seconds):
+        out = decode_frames(bodies, samples_per_packet, compression, exponents)
+        decoded += len(out)
+    decode_rate = decoded / (time.process_time() - start)
+    error = out.astype(np.float64) - iq
+    snr = 10 * np.log10(np.sum(iq.astype(np.float64) ** 2) / max(np.sum(error ** 2), 1e-30))
+    return encode_us, decode_rate, snr
+
+
+if __name__ == '__main__':
+    description = "IQ frame compression - Times the block floating point encoder and decoder the readers and receivers use"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-z', '--compression', nargs='+', choices=COMPRESSIONS[1:], help='Formats to time', default=list(COMPRESSIONS[1:]))
+    parser.add_argument('-n', '--samples_per_packet', type=int, help='I/Q samples per frame', default=SAMPLES_PER_PACKET)
+    args = parser.parse_args()
+
+    for compression in args.compression:
+        encode_us, decode_rate, snr = benchmark(compression, args.samples_per_packet)
+        ratio = sample_bytes(args.samples_per_packet, compression) / sample_bytes(args.samples_per_packet)
+        print(f'{compression}: {100 * ratio:.0f} % of the sample bytes, encode {encode_us:.1f} us per'
+              f' {args.samples_per_packet}-sample frame, decode {decode_rate / 1e6:.1f} M samples/s,'
+              f' {snr:.1f} dB SNR on a tone at -8.7 dBFS')
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+### IQ capture recorder
+# Records the radio FIFO to disk as raw interleaved 16-bit I/Q with SigMF metadata
+#   Each capture file is preallocated to its full size and memory-mapped, so recording is a copy of each FIFO drain into
+#   the map with no per-sample work, and a full file is closed and the next one opened (rotation)
+#   Each <prefix>_<index>.sigmf-data file has a <prefix>_<index>.sigmf-meta sidecar holding the ADC and tuner
+#   frequencies, sample rate, the timer value at the start of the recording, and the ranges where samples were dropped
+#   load_capture() opens a capture as a NumPy view of the file itself, so captures of any size open instantly
+
+### Capture file format
+# SigMF ci16_le: interleaved 16-bit signed I/Q, little endian, 48828.125 Hz sample rate
+# Each FIFO word is Q in the upper and I in the lower 16 bits, so its little endian byte order is already ci16_le
+
+import argparse
+import glob
+import json
+import mmap
+import os
+import sys
+import time
+from array import array
+from registers import open_radio, freq_to_inc, inc_to_freq, DEFAULT_SIM_PATH, SIM_SOURCES, SAMP_FREQ, DECIMATION, \
+    ADC_OFFSET, TUNER_OFFSET, TIMER_OFFSET, FIFO_DATA_OFFSET, FIFO_COUNT_OFFSET
+from startup import load_bitstreams
+
+# Define constants
+SAMPLE_RATE = SAMP_FREQ / DECIMATION
+BYTES_PER_SAMPLE = 4
+DEFAULT_FILE_SAMPLES = 1 << 24
+SIGMF_VERSION = '1.0.0'
+
+
+def capture_files(prefix):
+    '''
+    Returns the data files of a recording, in recording order
+
+    Parameters:
+        prefix (str): the recording prefix given to CaptureWriter
+
+    Returns:
+        paths (list): the .sigmf-data paths
+    '''
+    return sorted(glob.glob(glob.escape(prefix) + '_[0-9]*.sigmf-data'))
+
+
+def load_capture(path):
+    '''
+    Opens a capture file as a read-only NumPy view of the file, without reading or copying the samples
+
+    Parameters:
+        path (str): the .sigmf-data or .sigmf-meta file, or the path without extension
+
+    Returns:
+        iq (ndarray): int16 samples with shape (num_samples, 2), column 0 is I and column 1 is Q
+        meta (dict): the SigMF metadata, or an empty dict if there is no sidecar
+    '''
+    import numpy as np
+    base = path.rsplit('.sigmf-', 1)[0] if '.sigmf-' in path else path
+    meta = {}
+    if os.path.exists(base + '.sigmf-meta'):
+        with open(base + '.sigmf-meta') as f:
+            meta = json.load(f)
+    data_path = base + '.sigmf-data'
+    if (os.path.getsize(data_path) == 0):
+        return np.zeros((0, 2), dtype='<i2'), meta
+    return np.memmap(data_path, dtype='<i2', mode='r').reshape(-1, 2), meta
+
+
+class CaptureWriter():
+    '''
+    Writes FIFO words to preallocated, memory-mapped SigMF capture files, rotating to a new file every file_samples
+    samples. With max_files, only the latest max_files files are kept
+    '''
+
+    def __init__(self, prefix, file_samples=DEFAULT_FILE_SAMPLES, max_files=0, adc_freq=None, tuner_freq=None,
+                 start_timer=None, hw='', description=''):
+        self.prefix = prefix
+        self.file_samples = file_samples
+        self.max_files = max_files
+        self.adc_freq = adc_freq
+        self.tuner_freq = tuner_freq
+        self.start_timer = start_timer
+        self.hw = hw
+        self.description = description
+        self.file_index = -1
+        self.paths = []
+        self.mem = None
+        self.file_written = 0
+        self.file_start = 0
+        self.samples_written = 0
+        self.dropped_samples = 0
+        self.annotations = []
+        self.datetime = None
+        self.open_next()
+
+
+    def open_next(self):
+        '''
+        Closes the current file, if any, and preallocates and maps the next one
+        '''
+        self.close_file()
+        self.file_index += 1
+        self.file_start = self.samples_written
+        self.file_written = 0
+        self.annotations = []
+        self.datetime = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        path = f'{self.prefix}_{self.file_index:04d}.sigmf-data'
+        size = self.file_samples * BYTES_PER_SAMPLE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                # Reserve the blocks up front so the disk cannot fill mid-recording
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                os.ftruncate(fd, size)
+            self.mem = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.paths.append(path)
+        self.write_meta()
+        while (self.max_files and len(self.paths) > self.max_files):
+            old = self.paths.pop(0)
+            os.remove(old)
+            os.remove(old.replace('.sigmf-data', '.sigmf-meta'))
+
+
+    def write(self, words, count):
+        '''
+        Appends samples, rotating files as they fill
+
+        Parameters:
+            words (array): FIFO words, array('I')
+            count (int): the number of words to write from the start of words
+
+        Returns:
+            None
+        '''
+        if (sys.byteorder != 'little'):
+            words = array('I', words[:count])
+            words.byteswap()
+        data = memoryview(words).cast('B')
+        pos = 0
+        end = count * BYTES_PER_SAMPLE
+        while (pos < end):
+            if (self.file_written == self.file_samples):
+                self.open_next()
+            offset = self.file_written * BYTES_PER_SAMPLE
+            take = min(end - pos, (self.file_samples - self.file_written) * BYTES_PER_SAMPLE)
+            self.mem[offset:offset + take] = data[pos:pos + take]
+            pos += take
+            self.file_written += take // BYTES_PER_SAMPLE
+            self.samples_written += take // BYTES_PER_SAMPLE
+
+
+    def mark_dropped(self, count):
+        '''
+        Records that count samples were dropped before the next sample written
+        '''
+        if (self.file_written == self.file_samples):
+            self.open_next()
+        self.dropped_samples += count
+        self.annotations.append({
+            'core:sample_start': self.file_written,
+            'core:comment': f'FIFO overflow, about {count} samples dropped before this sample',
+            'linux_sdr:dropped_samples': count,
+        })
+
+
+    def write_meta(self):
+        '''
+        Writes the SigMF sidecar of the current file, replacing it atomically
+        '''
+        capture = {'core:sample_start': 0, 'core:global_index': self.file_start, 'core:datetime': self.datetime}
+        if self.tuner_freq is not None:
+            capture['core:frequency'] = self.tuner_freq
+        meta = {
+            'global': {
+                'core:datatype': 'ci16_le',
+                'core:sample_rate': SAMPLE_RATE,
+                'core:version': SIGMF_VERSION,
+                'core:recorder': 'iq_recorder.py',
+                'core:hw': self.hw,
+                'core:description': self.description,
+                'linux_sdr:adc_freq': self.adc_freq,
+                'linux_sdr:tuner_freq': self.tuner_freq,
+                'linux_sdr:start_timer': self.start_timer,
+                'linux_sdr:file_index': self.file_index,
+                'linux_sdr:dropped_samples': sum(a['linux_sdr:dropped_samples'] for a in self.annotations),
+            },
+            'captures': [capture],
+            'annotations': self.annotations,
+        }
+        meta_path = self.paths[-1].replace('.sigmf-data', '.sigmf-meta')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(meta_path + '.tmp', meta_path)
+
+
+    def close_file(self):
+        '''
+        Unmaps the current file, trims it to the samples written, and writes its final metadata
+        '''
+        if self.mem is None:
+            return
+        self.mem.close()
+        self.mem = None
+        if (self.file_written < self.file_samples):
+            os.truncate(self.paths[-1], self.file_written * BYTES_PER_SAMPLE)
+        self.write_meta()
+
+
+    def close(self):
+        self.close_file()
+
+
+def record(radio, writer, num_samples=None, duration=None):
+    '''
+    Drains the radio FIFO into a CaptureWriter
+
+    FIFO overflows are found from reads of the FIFO count at capacity, and the number of samples dropped is estimated
+    from the 125 MHz timer (one sample every 2560 clocks) against the samples read, within a sample
+
+    Parameters:
+        radio (object): the register backend from open_radio()
+        writer (CaptureWriter): the capture files to write to
+        num_samples (int): stop after this many samples, or None
+        duration (float): stop after this many seconds, or None
+
+    Returns:
+        samples (int): the number of samples written
+    '''
+    fifo = radio.fifo
+    depth = radio.fifo_depth
+    buf = array('I', bytes(BYTES_PER_SAMPLE * depth))
+    # The samples already in the FIFO were produced before the start timer value
+    timer = radio.radio.read(TIMER_OFFSET)
+    initial = fifo.read(FIFO_COUNT_OFFSET)
+    writer.start_timer = timer
+    writer.write_meta()
+    ticks = 0
+    start = time.monotonic()
+    while ((num_samples is None or writer.samples_written < num_samples) and
+           (duration is None or time.monotonic() - start < duration)):
+        count = fifo.read(FIFO_COUNT_OFFSET)
+        # Unwrap the 32-bit timer, which wraps every 34 seconds
+        now = radio.radio.read(TIMER_OFFSET)
+        ticks += (now - timer) & 0xFFFFFFFF
+        timer = now
+        if (count >= depth):
+            missing = initial + ticks // DECIMATION - writer.samples_written - count - writer.dropped_samples
+            if (missing > 0):
+                writer.mark_dropped(missing)
+        elif (count < depth // 2):
+            time.sleep((depth // 2 - count) / SAMPLE_RATE)
+            continue
+        if num_samples is not None:
+            count = min(count, num_samples - writer.samples_written)
+        fifo.read_repeated(FIFO_DATA_OFFSET, buf, count)
+        writer.write(buf, count)
+    return writer.samples_written
+
+
+def main(prefix, adc_freq, tuner_freq, duration=None, num_samples=None, file_samples=DEFAULT_FILE_SAMPLES,
+         max_files=0, sim_path=None, sim_source='tone'):
+    radio = open_radio(sim_path, sim_source)
+    radio.radio.write(ADC_OFFSET, freq_to_inc(adc_freq))
+    radio.radio.write(TUNER_OFFSET, freq_to_inc(tuner_freq))
+    hw = 'SimulatedRadio' if sim_path is not None else 'Zybo radio peripheral'
+    writer = CaptureWriter(prefix, file_samples, max_files, inc_to_freq(freq_to_inc(adc_freq)),
+                           inc_to_freq(freq_to_inc(tuner_freq)), hw=hw)
+    print(f'Recording to {prefix}_*.sigmf-data, {file_samples} samples per file' + (f', keeping {max_files}' if max_files else ''))
+    start = time.monotonic()
+    try:
+        record(radio, writer, num_samples, duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+    elapsed = time.monotonic() - start
+    print(f'Recorded {writer.samples_written} samples in {elapsed:.1f} seconds to {writer.file_index + 1} file(s), '
+          f'about {writer.dropped_samples} samples dropped')
+    return writer
+
+
+if __name__ == '__main__':
+    description = "IQ capture recorder - Records the radio FIFO to memory-mapped SigMF capture files"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-o', '--output', help='Capture file prefix, files are <OUTPUT>_<index>.sigmf-data/-meta', default='capture')
+    parser.add_argument('-f', '--adc_freq', type=float, help='ADC frequency (Hz)', default=1001000)
+    parser.add_argument('-t', '--tuner_freq', type=float, help='Tuner frequency (Hz)', default=1000000)
+    parser.add_argument('-s', '--seconds', type=float, help='Seconds to record (default: until Ctrl-C)', default=None)
+    parser.add_argument('-n', '--num_samps', type=int, help='Number of samples to record', default=None)
+    parser.add_argument('--file_samples', type=int, help='Samples per capture file before rotating', default=DEFAULT_FILE_SAMPLES)
+    parser.add_argument('--max_files', type=int, help='Keep only the latest MAX_FILES files (default: keep all)', default=0)
+    parser.add_argument('--sim', nargs='?', const=DEFAULT_SIM_PATH, help='Run against a simulated radio backed by the given file instead of /dev/mem', default=None)
+    parser.add_argument('--sim_source', choices=SIM_SOURCES, help='Simulated sample source: tone, linear DDC model, or bit-accurate DDC model', default='tone')
+    parser.add_argument('--force', action='store_true', help='Reload the FPGA images even if they are already loaded')
+    args = parser.parse_args()
+
+    if (args.sim is None):
+        load_bitstreams(force=args.force)
+
+    main(args.output, args.adc_freq, args.tuner_freq, args.seconds, args.num_samps, args.file_samples, args.max_files,
+         args.sim, args.sim_source)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+### IQ decoding and plotting helpers
+# Vectorized conversion of radio samples to NumPy arrays, from any of the forms the samples take:
+#   FIFO words      32-bit words, Q in the upper and I in the lower 16 bits (array('I'), lists, fifo_data.pkl)
+#   UDP payloads    a header (the 2-byte sequence number, or the extended header) followed by interleaved 16-bit I/Q,
+#                   one or many datagrams of any of the frame formats in packet_ring.py, compressed samples are
+#                   decoded with iq_compression.py
+#   capture files   SigMF ci16_le files written by iq_recorder.py
+# Every decoder reinterprets the little endian bytes as int16 with view('<i2'), so I and Q are sign-extended with no
+# per-sample Python work, then converts to complex64 in a single pass
+# preview() and spectrogram() reduce a capture of any length to a fixed number of points or FFT rows, reading only what
+# they need from memory-mapped captures
+
+import numpy as np
+from packet_ring import SAMPLES_PER_PACKET, EXT_HEADER_BYTES, EXT_FLAGS_EXPONENT_MASK, parse_geometry, packet_geometry, \
+    frame_compression
+from iq_compression import decode_frames
+from registers import SAMP_FREQ, DECIMATION
+
+# Define constants
+SAMPLE_RATE = SAMP_FREQ / DECIMATION
+FULL_SCALE = 32768
+
+
+def packet_dtype(samples_per_packet=SAMPLES_PER_PACKET, extended_header=False):
+    '''
+    Returns the structured dtype of a UDP frame, whose fields are the header fields of packet_ring.py and 'iq', the
+    int16 I/Q pairs of shape (samples_per_packet, 2)
+    '''
+    if (extended_header):
+        header = [('seq', '<u2'), ('version', 'u1'), ('flags', 'u1'), ('header_bytes', '<u2'), ('samples', '<u2'),
+                  ('timer', '<u8'), ('tuner_inc', '<u4'), ('adc_inc', '<u4'), ('send_delay', '<u4')]
+    else:
+        header = [('seq', '<u2')]
+    return np.dtype(header + [('iq', '<i2', (samples_per_packet, 2))])
+
+
+PACKET_DTYPE = packet_dtype()
+
+
+def to_complex(iq, scale=1.0 / FULL_SCALE):
+    '''
+    Converts int16 I/Q pairs to complex samples
+
+    Parameters:
+        iq (ndarray): int16 array of shape (..., 2), I first
+        scale (float): multiplies each sample, full scale is 1.0 by default, 1.0 keeps ADC counts
+
+    Returns:
+        samples (ndarray): complex64 samples, shape iq.shape[:-1]
+    '''
+    # float32 pairs have the memory layout of complex64, always a new array so the caller's iq is never changed
+    if (scale != 1.0):
+        pairs = np.multiply(iq, np.float32(scale), dtype=np.float32, order='C')
+    else:
+        pairs = np.array(iq, dtype=np.float32, order='C')
+    return pairs.view(np.complex64)[..., 0]
+
+
+def words_to_iq(words):
+    '''
+    Splits FIFO words into sign-extended I/Q pairs without copying when possible
+
+    Parameters:
+        words (array): 32-bit FIFO words, an array('I'), a list of ints, or a uint32 ndarray
+
+    Returns:
+        iq (ndarray): int16 array of shape (num_words, 2), column 0 is I and column 1 is Q
+    '''
+    words = np.asarray(words, dtype=np.uint32)
+    return words.astype('<u4', copy=False).view('<i2').reshape(-1, 2)
+
+
+def words_to_complex(words, scale=1.0 / FULL_SCALE):
+    '''
+    Converts FIFO words to complex64 samples, see words_to_iq() and to_complex()
+    '''
+    return to_complex(words_to_iq(words), scale)
+
+
+def packets_to_iq(payloads, samples_per_packet=SAMPLES_PER_PACKET, extended_header=False, compression='none'):
+    '''
+    Decodes UDP payloads into their sequence numbers and I/Q pairs
+
+    Parameters:
+        payloads (bytes or list): one payload, several payloads back to back, or a list of payloads of one format,
+                                  whose format is then taken from the first payload
+        samples_per_packet (int): the samples in each frame of back to back payloads
+        extended_header (bool): whether back to back payloads have the extended header
+        compression (str): the sample format of back to back payloads, one of packet_ring.COMPRESSIONS
+
+    Returns:
+        seqs (ndarray): uint16 sequence numbers, one per packet
+        iq (ndarray): int16 array of shape (num_packets * samples_per_packet, 2), column 0 is I and column 1 is Q
+    '''
+    if isinstance(payloads, (list, tuple)):
+        geometry = parse_geometry(payloads[0]) if payloads else None
+        if geometry is not None:
+            samples_per_packet, header_bytes = geometry
+            extended_header = header_bytes == EXT_HEADER_BYTES
+            compression = frame_compression(payloads[0])
+        payloads = b''.join(payloads)
+    if (compression != 'none'):
+        # Each frame has its own block exponent, so the packets are decoded as rows of bytes
+        header_bytes, packet_bytes = packet_geometry(samples_per_packet, extended_header, compression)
+        packets = np.frombuffer(payloads, dtype=np.uint8).reshape(-1, packet_bytes)
+        iq = decode_frames(packets[:, header_bytes:], samples_per_packet, compression,
+                           packets[:, 3] & EXT_FLAGS_EXPONENT_MASK)
+        return np.ascontiguousarray(packets[:, :2]).view('<u2')[:, 0], iq
+    packets = np.frombuffer(payloads, dtype=packet_dtype(samples_per_packet, extended_header))
+    return packets['seq'], packets['iq'].reshape(-1, 2)
+
+
+def packets_to_complex(payloads, samples_per_packet=SAMPLES_PER_PACKET, extended_header=False, scale=1.0 / FULL_SCALE,
+                       compression='none'):
+    '''
+    Decodes UDP payloads into their sequence numbers and complex64 samples, see packets_to_iq()
+    '''
+    seqs, iq = packets_to_iq(payloads, samples_per_packet, extended_header, compression)
+    return seqs, to_complex(iq, scale)
+
+
+def capture_to_complex(path, start=0, count=None, scale=1.0 / FULL_SCALE):
+    '''
+    Reads part of a capture file as complex64 samples, only the requested samples are read from disk
+
+    Parameters:
+        path (str): the .sigmf-data or .sigmf-meta file, or the path without extension
+        start (int): the first sample
+        count (int): the number of samples, or None for the rest of the file
+        scale (float): see to_complex()
+
+    Returns:
+        samples (ndarray): complex64 samples
+        meta (dict): the SigMF metadata
+    '''
+    from iq_recorder import load_capture
+    iq, meta = load_capture(path)
+    stop = len(iq) if count is None else min(start + count, len(iq))
+    return to_complex(iq[start:stop], scale), meta
+
+
+def load_samples(path):
+    '''
+    Loads I/Q pairs from a capture file or a legacy fifo_data.pkl pickle of FIFO words
+
+    Parameters:
+        path (str): a .pkl file or a capture file, see iq_recorder.load_capture()
+
+    Returns:
+        iq (ndarray): int16 array of shape (num_samples, 2), a view of the file for captures
+        fs (float): the sample rate
+    '''
+    if path.endswith('.pkl'):
+        import pickle
+        with open(path, 'rb') as f:
+            return words_to_iq(pickle.load(f)), SAMPLE_RATE
+    from iq_recorder import load_capture
+    iq, meta = load_capture(path)
+    return iq, meta.get('global', {}).get('core:sample_rate', SAMPLE_RATE)
+
+
+def preview(iq, max_points=4096, chunk=1 << 22):
+    '''
+    Reduces I/Q pairs to a min/max envelope of at most max_points buckets, so the whole capture can be plotted
+
+    Parameters:
+        iq (ndarray): int16 array of shape (num_samples, 2), e.g. a capture view
+        max_points (int): the number of buckets
+        chunk (int): samples processed at a time, bounds the memory used
+
+    Returns:
+        index (ndarray): the first sample of each bucket
+        low (ndarray): the minimum of I and Q in each bucket, shape (buckets, 2)
+        high (ndarray): the maximum of I and Q in each bucket, shape (buckets, 2)
+    '''
+    step = max(1, -(-len(iq) // max_points))
+    buckets = -(-len(iq) // step)
+    low = np.empty((buckets, 2), dtype=iq.dtype)
+    high = np.empty((buckets, 2), dtype=iq.dtype)
+    chunk = max(step, chunk - chunk % step)
+    for pos in range(0, len(iq), chunk):
+        part = iq[pos:pos + chunk]
+        whole = len(part) - len(part) % step
+        first = pos // step
+        if whole:
+            blocks = part[:whole].reshape(-1, step, 2)
+            low[first:first + len(blocks)] = blocks.min(axis=1)
+            high[first:first + len(blocks)] = blocks.max(axis=1)
+        if (whole < len(part)):
+            low[-1] = part[whole:].min(axis=0)
+            high[-1] = part[whole:].max(axis=0)
+    return np.arange(buckets) * step, low, high
+
+
+def spectrogram(iq, nfft=1024, max_rows=1024, fs=SAMPLE_RATE):
+    '''
+    Power spectrogram of a capture with at most max_rows FFT rows, evenly spaced over the whole capture
+
+    Rows are taken from every hop samples, with hop at least nfft, so at most max_rows * nfft samples are read
+
+    Parameters:
+        iq (ndarray): int16 array of shape (num_samples, 2)
+        nfft (int): the FFT size of each row
+        max_rows (int): the maximum number of rows
+        fs (float): the sample rate
+
+    Returns:
+        times (ndarray): the start time of each row (s)
+        freqs (ndarray): the FFT bin frequencies, from -fs/2 to fs/2 (Hz)
+        power (ndarray): float32 power (dB full scale) of shape (rows, nfft)
+    '''
+    rows = min(max_rows, len(iq) // nfft)
+    if (rows == 0):
+        return np.zeros(0), np.fft.fftshift(np.fft.fftfreq(nfft, 1 / fs)), np.zeros((0, nfft), dtype=np.float32)
+    hop = max(nfft, (len(iq) - nfft) // max(rows - 1, 1))
+    starts = np.arange(rows) * hop
+    # Gather only the samples of each row: (rows, nfft) indices into the capture
+    segments = to_complex(iq[starts[:, None] + np.arange(nfft)])
+    window = np.hanning(nfft).astype(np.float32)
+    spectrum = np.fft.fftshift(np.fft.fft(segments * window, axis=1), axes=1)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    power /= float(np.sum(window)) ** 2
+    return starts / fs, np.fft.fftshift(np.fft.fftfreq(nfft, 1 / fs)), (10 * np.log10(power + 1e-20)).astype(np.float32)
@@ -7,48 +7,72 @@
 ### UDP Frame format
 # Bytes 0-1: 16-bit unsigned counter, increments by one in each transmitted UDP frame
 # Bytes 2-1025: 512 Interleaved 16-bit signed IQ, little endian, 48 kHz sample rate
+# This is the default. The samples per frame (up to jumbo frames) and an extended header carrying the radio timer and
+# frequencies can be configured, or changed with the JSON "format" command, see packet_ring.py for the layouts
+# Frames with the extended header can also carry block floating point compressed samples (--compression), for
+# constrained links, see iq_compression.py
+# In spectrum mode (--spectrum, or the JSON "spectrum" command) fifo_reader sends averaged power spectra it computes
+# instead of the samples, see spectrum_frames.py
 
 import argparse
-import os
+import asyncio
 import subprocess
-import mmap
-import struct
-import math
+from registers import open_radio, freq_to_inc, inc_to_freq, DECIMATION, RADIO_PERIPH_BASE_ADDR, FIFO_BASE_ADDR
+from reader_control import ReaderControl, DEFAULT_CONTROL_PATH
+from packet_ring import SAMPLES_PER_PACKET, MAX_SAMPLES_PER_PACKET, SPECTRUM_RATE, COMPRESSIONS, packet_geometry, \
+    spectrum_geometry, spectrum_averages
+from controller import Controller, DEFAULT_CONTROL_ADDR, DEFAULT_CONTROL_PORT
+from startup import load_bitstreams, build_reader
 
 
 class LinuxSDR():
     
-    # Define memory-mapped peripheral addresses and offsets
-    radio_periph_base_addr = 0x43c00000
+    # Define memory-mapped peripheral offsets, the base addresses are per instance
     adc_offset = 0x00
     tuner_offset = 0x04
     ctrl_offset = 0x08
     timer_offset = 0x0c
-    fifo_base_addr = 0x43c10000
     fifo_data_offset = 0x00
     fifo_count_offset = 0x04
 
     # Define constants
     SAMP_FREQ = 125000000
     PHASE_RESOLUTION_BITS = 27
-
-    # Open memory-mapped peripheral location
-    file = os.open('/dev/mem', os.O_RDWR, os.O_SYNC)
-    radio_ctrl_base = mmap.mmap(file, 4096, offset=radio_periph_base_addr)
-
-    # UDP
-    udp_enable = 1
-    
-    # Mute status
-    mute = 0
-
-    # Stop thread flag
-    stop_thread = 0
-
-    def __init__(self, udp_ip="127.0.0.1", udp_port=25344, adc_freq=0, tuner_freq=0):
+    SAMPLE_RATE = SAMP_FREQ / DECIMATION
+
+    def __init__(self, udp_ip="127.0.0.1", udp_port=25344, adc_freq=0, tuner_freq=0, radio=None, control_path=DEFAULT_CONTROL_PATH, wait_mode='sleep', uio_path=None,
+                 radio_base_addr=RADIO_PERIPH_BASE_ADDR, fifo_base_addr=FIFO_BASE_ADDR, samples_per_packet=SAMPLES_PER_PACKET,
+                 extended_header=False, spectrum_nfft=0, spectrum_rate=SPECTRUM_RATE, compression='none'):
+        # UDP enable, mute status, and the stop thread flag
+        self.udp_enable = 1
+        self.mute = 0
+        self.stop_thread = 0
+
+        # Open the radio registers at this instance's address, from /dev/mem unless a register backend is given
+        self.radio_periph_base_addr = radio_base_addr
+        self.fifo_base_addr = fifo_base_addr
+        self.radio = radio if radio is not None else open_radio(radio_base_addr=radio_base_addr, fifo_base_addr=fifo_base_addr)
+        self.radio_regs = self.radio.radio
         self.udp_ip = udp_ip
         self.udp_port = udp_port
-        self.udp_sender = subprocess.Popen(['./fifo_reader', udp_ip, str(udp_port)])
+        self.extra_destinations = []
+        # The reader is started once, later changes go through its control socket
+        self.control_path = control_path
+        self.wait_mode = wait_mode
+        self.uio_path = uio_path
+        packet_geometry(samples_per_packet, extended_header, compression)
+        self.samples_per_packet = samples_per_packet
+        self.extended_header = extended_header
+        self.compression = compression
+        if spectrum_nfft:
+            spectrum_geometry(spectrum_nfft)
+            spectrum_averages(spectrum_nfft, spectrum_rate, self.SAMPLE_RATE)
+        self.spectrum_nfft = spectrum_nfft
+        self.spectrum_rate = spectrum_rate
+        self.udp_sender = subprocess.Popen(self.reader_args())
+        self.reader = ReaderControl(control_path)
+        if not self.reader.wait_ready():
+            print(f'fifo_reader did not open its control socket {control_path}')
         self.adc_freq = adc_freq
         self.tuner_freq = tuner_freq
 
@@ -67,8 +91,7 @@ class LinuxSDR():
         Returns:
             None  
         '''
-        self.radio_ctrl_base.seek(offset)
-        self.radio_ctrl_base.write(struct.pack('i', int(val)))
+        self.radio_regs.write_cached(offset, val)
 
     
     def get_ctrl_reg(self, offset):
@@ -81,28 +104,32 @@ class LinuxSDR():
         Returns:
             val (int): the value from the specified register
         '''
-        self.radio_ctrl_base.seek(offset)
-        val = int.from_bytes(self.radio_ctrl_base.read(4), 'little')
+        val = self.radio_regs.read(offset)
         return val
     
 
-    def set_freq_reg(self, offset, freq):
+    def set_freq_reg(self, offset, freq, phase_inc=None, verbose=True):
         '''
         Updates the value in the given radio control frequency register
 
         Parameters:
             offset (hex): the specified register memory offset value, from {adc_offset, tuner_offset}
             freq (int): the new frequency value
+            phase_inc (int): the phase increment of freq if already known, e.g. from a precomputed sweep_table()
+            verbose (bool): print the update to the user
         
         Returns:
             None
         '''
-        self.set_ctrl_reg(offset, self.freq_to_inc(freq))
+        if phase_inc is None:
+            phase_inc = self.freq_to_inc(freq)
+        self.set_ctrl_reg(offset, phase_inc)
         if (offset == self.adc_offset):
             self.adc_freq = freq
         elif (offset == self.tuner_offset):
             self.tuner_freq = freq
-        self.print_freq_update(freq)
+        if (verbose):
+            self.print_freq_update(freq, phase_inc)
 
 
     def toggle_mute(self):
@@ -124,15 +151,15 @@ class LinuxSDR():
         self.udp_enable ^= 1
         if (self.udp_enable):
             print('    UDP streaming enabled')
-            self.send_packets(self.udp_ip, self.udp_port)
+            self.reader.resume()
         else:
             print('    UDP streaming disabled')
-            self.udp_sender.kill()
+            self.reader.pause()
 
 
-    def send_packets(self, udp_ip, udp_port):
+    def set_destination(self, udp_ip, udp_port):
         '''
-        Runs the C program to read from the radio FIFO as a subprocess
+        Retargets the primary destination of the running FIFO reader, keeping any added destinations
 
         Parameters:
             udp_ip (str): the destination UDP IP address
@@ -143,25 +170,208 @@ class LinuxSDR():
         '''
         self.udp_ip = udp_ip
         self.udp_port = udp_port
+        self.reader.set_destinations([(self.udp_ip, self.udp_port)] + self.extra_destinations)
+
+
+    def get_destinations(self):
+        '''
+        Returns the destinations of the running FIFO reader, as a list of (udp_ip, udp_port)
+        '''
+        return self.reader.destinations()
+
+
+    async def stream(self):
+        '''
+        Waits on the fifo_reader process, which streams on its own, and kills it when cancelled
+        '''
+        exited = asyncio.ensure_future(asyncio.to_thread(self.udp_sender.wait))
         try:
+            await asyncio.shield(exited)
+        finally:
             self.udp_sender.kill()
-        except Exception:
-            pass
-        self.udp_sender = subprocess.Popen(['./fifo_reader', self.udp_ip, str(self.udp_port)])
-        
+            await exited
+            self.reader.close()
 
-    def freq_to_inc(self, freq):
+
+    def reader_args(self):
+        '''
+        Returns the fifo_reader command line: the control socket, wait mode, radio and FIFO addresses, frame format, and
+        spectrum mode, then the primary destination and any added destinations
+        '''
+        args = ['./fifo_reader', '-c', self.control_path, '-w', self.wait_mode, '-a', hex(self.radio_periph_base_addr),
+                '-b', hex(self.fifo_base_addr), '-n', str(self.samples_per_packet)]
+        if (self.extended_header):
+            args += ['-x']
+        if (self.compression != 'none'):
+            args += ['-z', self.compression]
+        if (self.spectrum_nfft):
+            args += ['-s', str(self.spectrum_nfft), '-r', f'{self.spectrum_rate:g}']
+        if self.uio_path is not None:
+            args += ['-u', self.uio_path]
+        for udp_ip, udp_port in [(self.udp_ip, self.udp_port)] + self.extra_destinations:
+            args += [udp_ip, str(udp_port)]
+        return args
+
+
+    def add_destination(self, udp_ip, udp_port):
         '''
-        Converts a desired frequency to a phase increment value for the DDS
+        Adds a destination that receives the same packet stream, the FIFO is still read and packed only once
 
         Parameters:
-            freq (int): the input frequency value to convert
+            udp_ip (str): the destination IP address
+            udp_port (int): the destination port
 
         Returns:
-            phase_inc (int): the phase increment value
+            added (bool): False if the destination was already receiving the stream
         '''
-        phase_inc = math.floor((freq << self.PHASE_RESOLUTION_BITS) / self.SAMP_FREQ)
-        return phase_inc
+        dest = (udp_ip, int(udp_port))
+        if dest == (self.udp_ip, self.udp_port) or dest in self.extra_destinations:
+            return False
+        self.reader.add_destination(*dest)
+        self.extra_destinations.append(dest)
+        return True
+
+
+    def remove_destination(self, udp_ip, udp_port):
+        '''
+        Stops sending the packet stream to an added destination
+
+        Parameters:
+            udp_ip (str): the destination IP address
+            udp_port (int): the destination port
+
+        Returns:
+            removed (bool): False if the destination was not an added destination
+        '''
+        dest = (udp_ip, int(udp_port))
+        if dest not in self.extra_destinations:
+            return False
+        self.reader.remove_destination(*dest)
+        self.extra_destinations.remove(dest)
+        return True
+
+
+    def set_format(self, samples_per_packet=None, extended_header=None, compression=None):
+        '''
+        Changes the frame format, fifo_reader switches after the packet it is filling
+
+        Parameters:
+            samples_per_packet (int): the I/Q samples in each frame, None to keep the current number
+            extended_header (bool): send the extended header instead of the legacy sequence number, None to keep it
+            compression (str): the sample format, one of packet_ring.COMPRESSIONS, None to keep it. Turning the
+                               extended header off also turns compression off unless compression is given
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: if samples_per_packet is out of range, or the compression is unknown or without the extended
+                        header
+        '''
+        if samples_per_packet is None:
+            samples_per_packet = self.samples_per_packet
+        if extended_header is None:
+            extended_header = self.extended_header
+        if compression is None:
+            compression = self.compression if extended_header else 'none'
+        packet_geometry(samples_per_packet, extended_header, compression)
+        self.reader.set_format(samples_per_packet, extended_header, compression)
+        self.samples_per_packet = samples_per_packet
+        self.extended_header = bool(extended_header)
+        self.compression = compression
+
+
+    def packet_format(self):
+        '''
+        Returns the frame format as a dict of samples_per_packet, extended_header, compression, and packet_bytes
+        '''
+        return {'samples_per_packet': self.samples_per_packet, 'extended_header': self.extended_header,
+                'compression': self.compression,
+                'packet_bytes': packet_geometry(self.samples_per_packet, self.extended_header, self.compression)[1]}
+
+
+    def set_spectrum(self, nfft=0, rate=None):
+        '''
+        Switches fifo_reader to spectrum mode, or back to streaming the samples, from its next FIFO drain
+
+        Parameters:
+            nfft (int): the FFT size of the spectra, a power of 2 (see packet_ring.spectrum_geometry()), 0 to stream
+                        the samples
+            rate (float): the spectrum frames per second, None to keep the current rate
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: if nfft or rate is out of range
+        '''
+        if rate is None:
+            rate = self.spectrum_rate
+        if nfft:
+            spectrum_geometry(nfft)
+            spectrum_averages(nfft, rate, self.SAMPLE_RATE)
+        self.reader.set_spectrum(nfft, rate)
+        self.spectrum_nfft = nfft
+        self.spectrum_rate = rate
+
+
+    def spectrum_format(self):
+        '''
+        Returns the spectrum mode as a dict of nfft (0 when streaming samples), rate, averages, and packet_bytes
+        '''
+        nfft, rate = self.spectrum_nfft, self.spectrum_rate
+        if not nfft:
+            return {'nfft': 0, 'rate': rate, 'averages': 0, 'packet_bytes': 0}
+        return {'nfft': nfft, 'rate': rate, 'averages': spectrum_averages(nfft, rate, self.SAMPLE_RATE),
+                'packet_bytes': spectrum_geometry(nfft)[1]}
+
+
+    def stats(self):
+        '''
+        Returns the FIFO reader's counters, see ReaderControl.stats()
+        '''
+        return self.reader.stats()
+
+
+    def latency(self, reset=False):
+        '''
+        Returns the FIFO reader's drain to send latency histogram, see ReaderControl.latency()
+        '''
+        return self.reader.latency(reset)
+
+
+    def print_counters(self):
+        '''
+        Prints the FIFO reader's counters to the user
+        '''
+        stats = self.stats()
+        print(f"    Packets built: {stats['packets']}")
+        print(f"    Datagrams sent: {stats['datagrams']}")
+        print(f"    Samples read: {stats['samples']}")
+        print(f"    Sequence number: {stats['seq']}")
+        print(f"    Streaming: {'paused' if stats['paused'] else 'enabled'} to {stats['dests']} destination(s)")
+        print(f"    Reader CPU use: {stats['cpu']:.1f} %")
+        print(f"    FIFO high-water mark: {stats['hwm']} samples")
+        print(f"    FIFO overflows: {stats['overflows']}")
+        print(f"    Wakeups: {stats['wakeups']}")
+        if (stats['spectrum_nfft']):
+            print(f"    Spectrum frames sent: {stats['spectrum_frames']} ({stats['spectrum_nfft']}-point)")
+        if (stats['extended']):
+            print(f"    Drain to send latency: median {stats['latency_p50']} us, 99% {stats['latency_p99']} us,"
+                  f" max {stats['latency_max']} us")
+
+
+    def freq_to_inc(self, freq):
+        '''
+        Converts a desired frequency to a phase increment value for the DDS, exactly in integer arithmetic
+
+            Parameters:
+                freq (int): the input frequency value to convert, or an array of them
+
+            Returns:
+                phase_inc (int): the phase increment value, or an array of them
+        '''
+        return freq_to_inc(freq)
 
 
     def print_instructions(self):
@@ -175,28 +385,40 @@ class LinuxSDR():
         print("Enter 's' or 'stream' to toggle the UDP packet streaming")
         print("Enter 'i' or 'IP' to update the destination IP address")
         print("Enter 'p' or 'port' to update the destination UDP port")
+        print("Enter 'a' or 'add' to add another destination IP address and UDP port")
+        print("Enter 'r' or 'remove' to remove an added destination IP address and UDP port")
+        print("Enter 'l' or 'list' to list the destinations")
+        print("Enter 'c' or 'counters' to show the FIFO reader counters")
         print("Enter 'm' or 'mute' to toggle the speaker output")
         print("Enter 'h' or 'help' to repeat these instructions")
         print("Enter 'e' or 'exit' to terminate the program\n")
 
 
-    def print_freq_update(self, freq):
+    def print_freq_update(self, freq, phase_inc=None):
         '''
         Prints the ADC or tuner frequency change to the user
 
         Parameters:
             freq (int): the new frequency
+            phase_inc (int): the phase increment written for it, computed if not given
 
         Returns:
             None
         '''
+        if phase_inc is None:
+            phase_inc = self.freq_to_inc(freq)
         print(f'    Frequency: {freq}')
-        print(f'    Phase Increment: {self.freq_to_inc(freq)}')
+        print(f'    Phase Increment: {phase_inc}')
+        print(f'    Achieved Frequency: {inc_to_freq(phase_inc):.3f}')
 
 
-def main(udp_ip, udp_port, adc_freq, tuner_freq):
+def main(udp_ip, udp_port, adc_freq, tuner_freq, wait_mode='sleep', uio_path=None, control_addr=DEFAULT_CONTROL_ADDR, control_port=DEFAULT_CONTROL_PORT,
+         samples_per_packet=SAMPLES_PER_PACKET, extended_header=False, spectrum_nfft=0, spectrum_rate=SPECTRUM_RATE,
+         compression='none'):
     # Create SDR object
-    sdr = LinuxSDR(udp_ip=udp_ip, udp_port=udp_port, adc_freq=adc_freq, tuner_freq=tuner_freq)
+    sdr = LinuxSDR(udp_ip=udp_ip, udp_port=udp_port, adc_freq=adc_freq, tuner_freq=tuner_freq, wait_mode=wait_mode, uio_path=uio_path,
+                   samples_per_packet=samples_per_packet, extended_header=extended_header, spectrum_nfft=spectrum_nfft,
+                   spectrum_rate=spectrum_rate, compression=compression)
     
     print('\n------------------------------------')
     print('Linux SDR with Ethernet - Zach Hicks')
@@ -205,54 +427,7 @@ def main(udp_ip, udp_port, adc_freq, tuner_freq):
     sdr.print_instructions()
 
     # Control loop
-    while(1):
-        command = input("Enter a command: ")
-        print('')
-        if (command == 'f' or command == 'frequency'):
-            adc_freq = int(input('Enter an ADC frequency: '))
-            sdr.set_freq_reg(sdr.adc_offset, adc_freq)
-        elif (command == 't' or command == 'tune'):
-            tuner_freq = int(input('Enter a tuner frequency: '))
-            sdr.set_freq_reg(sdr.tuner_offset, tuner_freq)
-        elif (command == 'u'):
-            adc_freq = sdr.adc_freq + 100
-            sdr.set_freq_reg(sdr.adc_offset, adc_freq)
-        elif (command == 'U'):
-            adc_freq = sdr.adc_freq + 1000
-            sdr.set_freq_reg(sdr.adc_offset, adc_freq)
-        elif (command == 'd'):
-            if (sdr.adc_freq >= 100):
-                adc_freq = sdr.adc_freq - 100
-                sdr.set_freq_reg(sdr.adc_offset, adc_freq)
-            else:
-                print('Frequency cannot be decreased any further!')
-        elif (command == 'D'):
-            if (sdr.adc_freq >= 1000):
-                adc_freq = sdr.adc_freq - 1000
-                sdr.set_freq_reg(sdr.adc_offset, adc_freq)
-            else:
-                print('Frequency cannot be decreased any further!')
-        elif (command == 'm' or command == 'mute'):
-            sdr.toggle_mute()
-        elif (command == 's' or command == 'stream'):
-            sdr.toggle_udp()
-        elif (command == 'i' or command == 'IP'):
-            sdr.udp_ip = input('Enter a new destination IP address: ')
-            sdr.send_packets(sdr.udp_ip, sdr.udp_port)
-        elif (command == 'p' or command == 'port'):
-            sdr.udp_port = int(input('Enter a new destination UDP port: '))
-            sdr.send_packets(sdr.udp_ip, sdr.udp_port)
-        elif (command == 'h' or command == 'help'):
-            sdr.print_instructions()
-        elif (command == 'e' or command == 'exit'):
-            sdr.set_ctrl_reg(sdr.adc_offset, 0)
-            sdr.set_ctrl_reg(sdr.tuner_offset, 0)
-            sdr.udp_sender.kill()
-            print('Terminated UDP sender...')
-            print('Exiting...')
-            print('')
-            quit()
-        print('')
+    asyncio.run(Controller(sdr, control_addr, control_port).run())
 
 
 
@@ -263,24 +438,21 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--port', nargs='?', help='Destination UDP port', default=25344)
     parser.add_argument('-f', '--freq', nargs='?', help='Simulated ADC frequency (Hz)', default=0)
     parser.add_argument('-t', '--tuner_freq', nargs='?', help='Tuner frequency (Hz)', default=0)
+    parser.add_argument('-w', '--wait', choices=('poll', 'sleep', 'uio'), help='How fifo_reader waits for the FIFO to fill: spin on the count register, sleep for the expected fill time, or wait for a UIO interrupt', default='sleep')
+    parser.add_argument('--uio', help='UIO device of the FIFO interrupt, for --wait uio', default=None)
+    parser.add_argument('-n', '--samples_per_packet', type=int, help=f'I/Q samples per UDP frame, up to {MAX_SAMPLES_PER_PACKET} with a 9000-byte MTU', default=SAMPLES_PER_PACKET)
+    parser.add_argument('-x', '--extended_header', action='store_true', help='Send the extended frame header carrying the radio timer and frequencies')
+    parser.add_argument('-z', '--compression', choices=COMPRESSIONS, help='Sample format of extended-header frames: 16-bit, or block floating point packed to 12 or 8 bits per value', default='none')
+    parser.add_argument('-S', '--spectrum', type=int, metavar='NFFT', help='Send averaged NFFT-point power spectra computed by fifo_reader instead of the samples', default=0)
+    parser.add_argument('--spectrum_rate', type=float, help='Spectrum frames per second in spectrum mode', default=SPECTRUM_RATE)
+    parser.add_argument('--control_addr', help='Address the TCP command endpoint listens on', default=DEFAULT_CONTROL_ADDR)
+    parser.add_argument('--control_port', type=int, help='TCP port of the command endpoint, 0 to disable it', default=DEFAULT_CONTROL_PORT)
+    parser.add_argument('--force', action='store_true', help='Rebuild fifo_reader and reload the FPGA images even if they are up to date')
     args = parser.parse_args()
 
-    # Build C application
-    c_build_cmd = 'gcc fifo_reader.c -o fifo_reader'
-    print('')
-    print("Building fifo_reader.c ...")
-    subprocess.run(c_build_cmd, shell=True)
-
-    # Load FPGA images
-    codec_config_cmd = 'fpgautil -b config_codec.bit.bin'
-    radio_config_cmd = 'fpgautil -b design_1_wrapper.bit.bin'
-    print('')
-    print("Loading codec_config.bit.bin ...")
-    print('')
-    subprocess.run(codec_config_cmd, shell=True)
-    print('')
-    print("Loading design_1_wrapper.bit.bin ...")
-    print('')
-    subprocess.run(radio_config_cmd, shell=True)
-
-    main(args.dest_ip_addr, int(args.port), int(args.freq), int(args.tuner_freq))
\ No newline at end of file
+    # Build C application, and load FPGA images
+    build_reader(force=args.force)
+    load_bitstreams(force=args.force)
+
+    main(args.dest_ip_addr, int(args.port), int(args.freq), int(args.tuner_freq), args.wait, args.uio, args.control_addr, args.control_port or None,
+         args.samples_per_packet, args.extended_header, args.spectrum, args.spectrum_rate, args.compression)
\ No newline at end of file
@@ -7,56 +7,137 @@
 ### UDP Frame format
 # Bytes 0-1: 16-bit unsigned counter, increments by one in each transmitted UDP frame
 # Bytes 2-1025: 512 Interleaved 16-bit signed IQ, little endian, 48 kHz sample rate
+# This is the default. The samples per frame (up to jumbo frames) and an extended header carrying the radio timer and
+# frequencies can be configured, or changed with the JSON "format" command, see packet_ring.py for the layouts
+# Frames with the extended header can also carry block floating point compressed samples (--compression), for
+# constrained links, see iq_compression.py
+# In spectrum mode (--spectrum, or the JSON "spectrum" command) averaged power spectra computed here are sent instead
+# of the samples, see spectrum_frames.py
 
-import socket
 import argparse
-import os
-import subprocess
-import mmap
+import asyncio
+import multiprocessing
+import signal
 import struct
-import math
+import sys
+import os
+import select
+import time
+from array import array
 from threading import Thread
+from registers import open_radio, freq_to_inc, inc_to_freq, DEFAULT_SIM_PATH, SIM_SOURCES, DECIMATION, RADIO_PERIPH_BASE_ADDR, \
+    FIFO_BASE_ADDR
+from packet_ring import PacketRing, SEQ_MODULUS, EXT_HEADER, EXT_VERSION, EXT_TIMER, EXT_TIMER_OFFSET, \
+    EXT_SEND_DELAY, EXT_SEND_DELAY_OFFSET, MAX_SAMPLES_PER_PACKET, SPEC_HEADER, SPEC_VERSION, SPECTRUM_RATE, \
+    COMPRESSIONS, EXT_FLAGS_FORMAT_SHIFT, packet_geometry, spectrum_geometry, spectrum_averages
+from timestamps import TimerUnwrapper, LatencyHistogram, TIMER_HZ
+from sample_ring import SampleRing
+from controller import Controller, DEFAULT_CONTROL_ADDR, DEFAULT_CONTROL_PORT
+from startup import load_bitstreams, CODEC_BITSTREAM
 
 
 class LinuxSDR(Thread):
     
-    # Define memory-mapped peripheral addresses and offsets
-    radio_periph_base_addr = 0x43c00000
+    # Define memory-mapped peripheral offsets, the base addresses are per instance
     adc_offset = 0x00
     tuner_offset = 0x04
     ctrl_offset = 0x08
     timer_offset = 0x0c
-    fifo_base_addr = 0x43c10000
     fifo_data_offset = 0x00
     fifo_count_offset = 0x04
 
     # Define constants
     SAMP_FREQ = 125000000
     PHASE_RESOLUTION_BITS = 27
-
-    # Open memory-mapped peripheral location
-    file = os.open('/dev/mem', os.O_RDWR, os.O_SYNC)
-    radio_ctrl_base = mmap.mmap(file, 4096, offset=radio_periph_base_addr)
-    fifo_base = mmap.mmap(file, 4096, offset=fifo_base_addr)
-
-    # UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    seq_num = 0
-    udp_enable = 1
-
-    # Mute status
-    mute = 0
-
-    # Stop thread flag
-    stop_thread = 0
-
-    def __init__(self, udp_ip="127.0.0.1", udp_port=25344, adc_freq=0, tuner_freq=0):
-        super(LinuxSDR, self).__init__()
+    SAMPLES_PER_PACKET = 256
+    SAMPLE_RATE = SAMP_FREQ / DECIMATION
+
+    # Ways to wait for the FIFO: spin on the count register, sleep for the expected fill time, or wait for a UIO interrupt
+    WAIT_MODES = ('poll', 'sleep', 'uio')
+
+    # Where the FIFO is read: in this thread, or in a separate process that hands sample blocks to this thread through
+    # a shared-memory ring, so the reader does not share the interpreter lock with the sender and the controller
+    READER_MODES = ('thread', 'process')
+    RING_BLOCKS = 32
+    BLOCK_WORDS = 256
+
+    def __init__(self, udp_ip="127.0.0.1", udp_port=25344, adc_freq=0, tuner_freq=0, radio=None, wait_mode='sleep', uio_path=None,
+                 radio_base_addr=RADIO_PERIPH_BASE_ADDR, fifo_base_addr=FIFO_BASE_ADDR, name=None, reader_mode='thread',
+                 samples_per_packet=SAMPLES_PER_PACKET, extended_header=False, spectrum_nfft=0, spectrum_rate=SPECTRUM_RATE,
+                 compression='none'):
+        super(LinuxSDR, self).__init__(name=name)
         self.udp_ip = udp_ip
         self.udp_port = udp_port
         self.adc_freq = adc_freq
         self.tuner_freq = tuner_freq
 
+        # UDP packets, mute status, and the stop thread flag
+        self.seq_num = 0
+        self.udp_enable = 1
+        self.mute = 0
+        self.stop_thread = 0
+
+        # Open the radio and FIFO registers at this instance's addresses, from /dev/mem unless a register backend is given
+        self.radio_periph_base_addr = radio_base_addr
+        self.fifo_base_addr = fifo_base_addr
+        self.radio = radio if radio is not None else open_radio(radio_base_addr=radio_base_addr, fifo_base_addr=fifo_base_addr)
+        self.radio_regs = self.radio.radio
+        self.fifo_regs = self.radio.fifo
+
+        # Preallocated packet slots, filled in place once and sent to every destination in the subscriber table
+        # A packet may take several FIFO drains to fill, fill_pos is the number of samples already in the current one
+        # Compressed packets are filled in the staging buffer instead, and encoded into their slot once complete
+        self.samples_per_packet = samples_per_packet
+        self.extended_header = extended_header
+        self.compression = compression
+        header_bytes, packet_bytes = packet_geometry(samples_per_packet, extended_header, compression)
+        self.tx = PacketRing([(udp_ip, udp_port)], packet_bytes=packet_bytes, header_bytes=header_bytes)
+        self.fill_pos = 0
+        self.packet_timer = 0
+        self.pending_format = None
+        self.encoder = None
+        self.staging = None
+
+        # Extended headers carry the 64-bit timer at the drain of each packet's first sample and the ticks until it was
+        # sent, the drain to send latencies are also counted here
+        self.timer = TimerUnwrapper()
+        self.send_latency = LatencyHistogram()
+        self.tx.before_send = self.stamp_send if extended_header else None
+
+        # Spectrum mode: the SpectrumFramer the samples go to instead of packets, None when streaming samples. The
+        # thread reader drains the FIFO into spectrum_buf for it
+        self.spectrum = None
+        self.spectrum_rate = spectrum_rate
+        self.pending_spectrum = None
+        self.spectrum_frames = 0
+        self.spectrum_buf = array('I', bytes(4 * self.radio.fifo_depth))
+        if (compression != 'none'):
+            self.apply_format(samples_per_packet, extended_header, compression)
+        if spectrum_nfft:
+            self.apply_spectrum(spectrum_nfft, spectrum_rate)
+
+        # FIFO wakeups, and the counters reported by stats()
+        if wait_mode not in self.WAIT_MODES:
+            raise ValueError(f'wait_mode must be one of {self.WAIT_MODES}')
+        if (wait_mode == 'uio' and uio_path is None):
+            raise ValueError("wait_mode 'uio' needs the interrupt device, e.g. uio_path='/dev/uio0'")
+        self.wait_mode = wait_mode
+        self.uio_fd = os.open(uio_path, os.O_RDWR) if wait_mode == 'uio' else None
+        self.wake_latency = 0.0
+        self.wakeups = 0
+        self.fifo_high_water = 0
+        self.fifo_overflows = 0
+        self.cpu_time = 0.0
+        self.run_time = 0.0
+
+        # The reader process and its sample ring, created by start() in 'process' mode
+        if reader_mode not in self.READER_MODES:
+            raise ValueError(f'reader_mode must be one of {self.READER_MODES}')
+        self.reader_mode = reader_mode
+        self.ring = None
+        self.reader = None
+        self.reader_stop = None
+
         self.set_ctrl_reg(self.adc_offset, self.freq_to_inc(self.adc_freq))
         self.set_ctrl_reg(self.tuner_offset, self.freq_to_inc(self.tuner_freq))
        
@@ -71,8 +152,7 @@ class LinuxSDR(Thread):
         Returns:
             None  
         '''
-        self.radio_ctrl_base.seek(offset)
-        self.radio_ctrl_base.write(struct.pack('i', int(val)))
+        self.radio_regs.write_cached(offset, val)
 
     
     def get_ctrl_reg(self, offset):
@@ -85,8 +165,7 @@ class LinuxSDR(Thread):
         Returns:
             val (int): the value from the specified register
         '''
-        self.radio_ctrl_base.seek(offset)
-        val = int.from_bytes(self.radio_ctrl_base.read(4), 'little')
+        val = self.radio_regs.read(offset)
         return val
 
 
@@ -100,29 +179,32 @@ class LinuxSDR(Thread):
         Returns:
             val (int): the value from the specified register
         '''
-        self.fifo_base.seek(offset)
-        val = int.from_bytes(self.fifo_base.read(4), 'little')
+        val = self.fifo_regs.read(offset)
         return val
     
 
-    def set_freq_reg(self, offset, freq):
+    def set_freq_reg(self, offset, freq, phase_inc=None, verbose=True):
         '''
         Updates the value in the given radio control frequency register
 
         Parameters:
             offset (hex): the specified register memory offset value, from {adc_offset, tuner_offset}
             freq (int): the new frequency value
+            phase_inc (int): the phase increment of freq if already known, e.g. from a precomputed sweep_table()
+            verbose (bool): print the update to the user
         
         Returns:
             None
-            
         '''
-        self.set_ctrl_reg(offset, self.freq_to_inc(freq))
+        if phase_inc is None:
+            phase_inc = self.freq_to_inc(freq)
+        self.set_ctrl_reg(offset, phase_inc)
         if (offset == self.adc_offset):
             self.adc_freq = freq
         elif (offset == self.tuner_offset):
             self.tuner_freq = freq
-        self.print_freq_update(freq)
+        if (verbose):
+            self.print_freq_update(freq, phase_inc)
 
 
     def toggle_mute(self):
@@ -150,74 +232,656 @@ class LinuxSDR(Thread):
 
     def freq_to_inc(self, freq):
         '''
-        Converts a desired frequency to a phase increment value for the DDS
+        Converts a desired frequency to a phase increment value for the DDS, exactly in integer arithmetic
 
             Parameters:
-                freq (int): the input frequency value to convert
+                freq (int): the input frequency value to convert, or an array of them
 
             Returns:
-                phase_inc (int): the phase increment value
+                phase_inc (int): the phase increment value, or an array of them
+        '''
+        return freq_to_inc(freq)
+
+
+    def read_fifo(self, buf, num_words):
         '''
-        phase_inc = math.floor((freq << self.PHASE_RESOLUTION_BITS) / self.SAMP_FREQ)
-        return phase_inc
+        Reads a block of samples from the radio FIFO data register
+
+        Parameters:
+            buf (array): the preallocated array('I') to fill, must hold at least num_words entries
+            num_words (int): the number of 32-bit samples to read
+
+        Returns:
+            None
+        '''
+        self.fifo_regs.read_repeated(self.fifo_data_offset, buf, num_words)
+
+
+    def set_destination(self, udp_ip, udp_port):
+        '''
+        Retargets the primary destination of the packet stream, leaving any added destinations in place
+
+        Parameters:
+            udp_ip (str): the destination IP address
+            udp_port (int): the destination port
+
+        Returns:
+            None
+        '''
+        if (udp_ip, udp_port) != (self.udp_ip, self.udp_port):
+            self.tx.add_destination(udp_ip, udp_port)
+            self.tx.remove_destination(self.udp_ip, self.udp_port)
+        self.udp_ip = udp_ip
+        self.udp_port = udp_port
+
+
+    def add_destination(self, udp_ip, udp_port):
+        '''
+        Adds a destination that receives the same packet stream, without interrupting the stream
+
+        Parameters:
+            udp_ip (str): the destination IP address
+            udp_port (int): the destination port
+
+        Returns:
+            added (bool): False if the destination was already receiving the stream
+        '''
+        return self.tx.add_destination(udp_ip, udp_port)
+
+
+    def remove_destination(self, udp_ip, udp_port):
+        '''
+        Stops sending the packet stream to a destination
+
+        Parameters:
+            udp_ip (str): the destination IP address
+            udp_port (int): the destination port
+
+        Returns:
+            removed (bool): False if the destination was not receiving the stream
+        '''
+        return self.tx.remove_destination(udp_ip, udp_port)
+
+
+    def get_destinations(self):
+        '''
+        Returns the destinations of the packet stream, as a tuple of (udp_ip, udp_port)
+        '''
+        return self.tx.destinations
+
+
+    async def stream(self):
+        '''
+        Runs the streaming thread until cancelled, then stops it and waits for it to send what it has queued
+        '''
+        self.start()
+        joined = asyncio.ensure_future(asyncio.to_thread(self.join))
+        try:
+            await asyncio.shield(joined)
+        finally:
+            self.stop_thread = 1
+            await joined
 
 
     def create_packet(self):
         '''
-        Creates a UDP datagram from the radio FIFO output samples
+        Creates a UDP datagram from the radio FIFO output samples, in place in the next free packet slot
+
+        The slot is only kept if it is passed to send_packet(), otherwise the next call reuses it
 
         Parameters:
             None
 
         Returns:
-            payload_bytes (bytes): if the packet is valid, the UDP datagram payload, otherwise None
+            payload (memoryview): if the packet is valid, the UDP datagram payload, otherwise None
         '''
         fifo_count = self.get_fifo_reg(self.fifo_count_offset)
-        samples = []
-        if (fifo_count > 256):
-            for i in range(0, 256):
-                sample = self.get_fifo_reg(self.fifo_data_offset)
-                samples.append(sample)
-            payload_bytes = self.seq_num.to_bytes(2, "little")
-            for samp in samples:
-                samp_I = samp & 0x0000FFFF
-                samp_Q = (samp & 0xFFFF0000) >> 16
-                payload_bytes += samp_I.to_bytes(2, "little")
-                payload_bytes += samp_Q.to_bytes(2, "little") 
-            self.seq_num += 1
-            if (self.seq_num >= 32767):
-                self.seq_num = 0
-            return payload_bytes
+        if (fifo_count >= self.samples_per_packet):
+            return self.fill_packet()
         else:
             return None
 
 
+    def fill_packet(self, block=None):
+        '''
+        Reads one packet of samples from the FIFO into the next free packet slot, the caller has checked the FIFO count
+
+        Parameters:
+            block (memoryview): a packet of samples already read from the FIFO to copy instead of reading the FIFO
+
+        Returns:
+            payload (memoryview): the UDP datagram payload
+        '''
+        self.start_packet()
+        samples = self.packet_words()
+        if block is None:
+            self.read_fifo(samples, self.samples_per_packet)
+        else:
+            samples[:] = block
+        return self.finish_packet()
+
+
+    def pack_samples(self, count, block=None, timer=None):
+        '''
+        Adds samples to the packet being filled, queueing each packet for transmission as it fills. The last packet
+        may be left partly filled for the next call
+
+        Parameters:
+            count (int): the number of samples to add, the caller has checked the FIFO count
+            block (memoryview): samples already read from the FIFO, e.g. by the reader process, to copy instead of
+                                reading the FIFO
+            timer (int): the 64-bit timer at the FIFO drain the samples come from, for the extended header
+
+        Returns:
+            None
+        '''
+        done = 0
+        while (done < count):
+            if (self.fill_pos == 0):
+                self.start_packet(timer)
+            take = min(count - done, self.samples_per_packet - self.fill_pos)
+            samples = self.packet_words()[self.fill_pos:self.fill_pos + take]
+            if block is None:
+                self.read_fifo(samples, take)
+            else:
+                samples[:] = block[done:done + take]
+            self.fill_pos += take
+            done += take
+            if (self.fill_pos == self.samples_per_packet):
+                self.fill_pos = 0
+                payload = self.finish_packet()
+                if (self.udp_enable):
+                    self.send_packet(payload)
+
+
+    def take_samples(self, count, block=None, timer=None):
+        '''
+        Adds drained samples to the stream: packs them into packets, or in spectrum mode adds them to the spectrum.
+        A pending spectrum mode change is made once the packet being filled is complete, a partly computed spectrum
+        is dropped
+
+        Parameters:
+            count (int): the number of samples to add, the caller has checked the FIFO count
+            block (memoryview): samples already read from the FIFO, e.g. by the reader process, to use instead of
+                                reading the FIFO
+            timer (int): the 64-bit timer at the FIFO drain the samples come from
+
+        Returns:
+            None
+        '''
+        if self.pending_spectrum is not None:
+            if (self.spectrum is None and self.fill_pos > 0):
+                take = min(count, self.samples_per_packet - self.fill_pos)
+                self.pack_samples(take, block[:take] if block is not None else None, timer)
+                count -= take
+                block = block[take:] if block is not None else None
+                if (self.fill_pos > 0):
+                    return
+            self.tx.flush()
+            # Take the change and clear it in one step, so a newer one stored meanwhile is kept for the next drain
+            spectrum, self.pending_spectrum = self.pending_spectrum, None
+            self.apply_spectrum(*spectrum)
+            if (count == 0):
+                return
+        if self.spectrum is None:
+            self.pack_samples(count, block, timer)
+            return
+        if block is None:
+            self.read_fifo(self.spectrum_buf, count)
+            block = memoryview(self.spectrum_buf)[:count]
+        self.spectrum.add(block, timer if timer is not None else self.read_timer())
+
+
+    def send_spectrum(self, codes, ref_db, timer):
+        '''
+        Called by the SpectrumFramer with each completed frame: splits its bins over datagrams in the packet slots and
+        queues them for transmission
+
+        Parameters:
+            codes (array): the frame's uint8 bins, from -fs/2 to fs/2
+            ref_db (float): the dB/Hz of code 0
+            timer (int): the 64-bit timer at the drain that completed the frame
+
+        Returns:
+            None
+        '''
+        framer = self.spectrum
+        header_bytes = self.tx.header_bytes
+        bins = self.tx.packet_bytes - header_bytes
+        shadow = self.radio_regs.shadow
+        for first in range(0, framer.nfft, bins):
+            payload = self.tx.acquire()
+            SPEC_HEADER.pack_into(payload, 0, self.seq_num, SPEC_VERSION, 0, header_bytes, bins, timer,
+                                  shadow.get(self.tuner_offset, 0), shadow.get(self.adc_offset, 0),
+                                  framer.frames & 0xFFFFFFFF, framer.nfft, first, framer.averages,
+                                  round(100 * framer.db_step), ref_db)
+            payload[header_bytes:] = codes[first:first + bins].data
+            self.seq_num = (self.seq_num + 1) % SEQ_MODULUS
+            if (self.udp_enable):
+                self.send_packet(payload)
+        self.spectrum_frames += 1
+
+
+    def start_packet(self, timer=None):
+        '''
+        Starts a packet in the next free slot: applies a pending format change, then notes the drain time for the
+        extended header, reading the timer now if it is not given
+        '''
+        if self.pending_format is not None:
+            self.tx.flush()
+            # Take the change and clear it in one step, so a newer one stored meanwhile is kept for the next packet
+            packet_format, self.pending_format = self.pending_format, None
+            self.apply_format(*packet_format)
+        if (self.extended_header):
+            self.packet_timer = timer if timer is not None else self.read_timer()
+
+
+    def read_timer(self):
+        '''
+        Returns the radio timer extended to 64 bits, see timestamps.py. Only for the streaming thread, or the reader
+        process, which keep reading it often enough to see every wrap. In 'process' reader mode the streaming thread
+        follows the reader's timestamps instead, see send_blocks()
+        '''
+        return self.timer.extend(self.get_ctrl_reg(self.timer_offset))
+
+
+    def stamp_send(self, first, count):
+        '''
+        Called by the packet ring just before it sends the queued slots: writes the ticks since each packet's drain
+        into its extended header, and counts them in the drain to send latency histogram
+        '''
+        now = self.read_timer()
+        slots = self.tx.slots
+        for i in range(first, first + count):
+            slot = slots[i % len(slots)]
+            # Clamped to the field, so a bad timer reading can never stop the sender
+            delay = max(0, min(now - EXT_TIMER.unpack_from(slot, EXT_TIMER_OFFSET)[0], 0xFFFFFFFF))
+            EXT_SEND_DELAY.pack_into(slot, EXT_SEND_DELAY_OFFSET, delay)
+            self.send_latency.add(delay * 1e6 / TIMER_HZ)
+
+
+    def packet_words(self):
+        '''
+        Returns the FIFO words (memoryview) of the packet being filled: its slot's samples, or the staging buffer
+        when compressing
+        '''
+        if self.encoder is not None:
+            return self.staging
+        return self.tx.sample_words[self.tx.head]
+
+
+    def finish_packet(self):
+        '''
+        Writes the header of the packet in the current slot, whose samples are all in place, encoding them into the
+        slot first when compressing
+
+        Returns:
+            payload (memoryview): the UDP datagram payload
+        '''
+        payload = self.tx.acquire()
+        # Each FIFO word is Q in the upper and I in the lower 16 bits, so its little endian
+        # byte order already matches the interleaved I/Q frame layout
+        if (sys.byteorder != 'little'):
+            swapped = array('I', self.packet_words())
+            swapped.byteswap()
+            if self.encoder is None:
+                payload[self.tx.header_bytes:] = memoryview(swapped).cast('B')
+            else:
+                self.staging[:] = memoryview(swapped)
+        flags = 0
+        if self.encoder is not None:
+            exponent = self.encoder.encode(self.staging, payload[self.tx.header_bytes:])
+            flags = self.encoder.code << EXT_FLAGS_FORMAT_SHIFT | exponent
+        if (self.extended_header):
+            shadow = self.radio_regs.shadow
+            EXT_HEADER.pack_into(payload, 0, self.seq_num, EXT_VERSION, flags, self.tx.header_bytes, self.samples_per_packet,
+                                 self.packet_timer, shadow.get(self.tuner_offset, 0), shadow.get(self.adc_offset, 0), 0)
+        else:
+            struct.pack_into('<H', payload, 0, self.seq_num)
+        self.seq_num = (self.seq_num + 1) % SEQ_MODULUS
+        return payload
+
+
+    def set_format(self, samples_per_packet=None, extended_header=None, compression=None):
+        '''
+        Changes the frame format, from the next packet on once streaming
+
+        Parameters:
+            samples_per_packet (int): the I/Q samples in each frame, None to keep the current number
+            extended_header (bool): send the extended header instead of the legacy sequence number, None to keep it
+            compression (str): the sample format, one of packet_ring.COMPRESSIONS, None to keep it. Turning the
+                               extended header off also turns compression off unless compression is given
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: if samples_per_packet is out of range, or the compression is unknown or without the extended
+                        header
+        '''
+        if samples_per_packet is None:
+            samples_per_packet = self.samples_per_packet
+        if extended_header is None:
+            extended_header = self.extended_header
+        if compression is None:
+            compression = self.compression if extended_header else 'none'
+        packet_geometry(samples_per_packet, extended_header, compression)
+        if self.is_alive():
+            # The streaming thread switches between packets
+            self.pending_format = (samples_per_packet, bool(extended_header), compression)
+        else:
+            self.pending_format = None
+            self.apply_format(samples_per_packet, bool(extended_header), compression)
+
+
+    def apply_format(self, samples_per_packet, extended_header, compression='none'):
+        header_bytes, packet_bytes = packet_geometry(samples_per_packet, extended_header, compression)
+        if self.spectrum is None:
+            self.tx.set_geometry(packet_bytes, header_bytes)
+            self.tx.before_send = self.stamp_send if extended_header else None
+        if (compression != 'none'):
+            # NumPy is only needed when compressing
+            from iq_compression import BfpEncoder
+            self.encoder = BfpEncoder(samples_per_packet, compression)
+            self.staging = memoryview(array('I', bytes(4 * samples_per_packet)))
+        else:
+            self.encoder = None
+            self.staging = None
+        self.samples_per_packet = samples_per_packet
+        self.extended_header = extended_header
+        self.compression = compression
+        self.fill_pos = 0
+
+
+    def packet_format(self):
+        '''
+        Returns the frame format as a dict of samples_per_packet, extended_header, compression, and packet_bytes
+        '''
+        samples_per_packet, extended_header, compression = self.pending_format or (
+            self.samples_per_packet, self.extended_header, self.compression)
+        return {'samples_per_packet': samples_per_packet, 'extended_header': extended_header, 'compression': compression,
+                'packet_bytes': packet_geometry(samples_per_packet, extended_header, compression)[1]}
+
+
+    def set_spectrum(self, nfft=0, rate=None):
+        '''
+        Switches to spectrum mode, or back to streaming samples, from the next FIFO drain once streaming
+
+        Parameters:
+            nfft (int): the FFT size of the spectra, a power of 2 (see packet_ring.spectrum_geometry()), 0 to stream
+                        the samples
+            rate (float): the spectrum frames per second, None to keep the current rate
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: if nfft or rate is out of range
+        '''
+        if rate is None:
+            rate = self.spectrum_rate
+        if nfft:
+            spectrum_geometry(nfft)
+            spectrum_averages(nfft, rate, self.SAMPLE_RATE)
+        if self.is_alive():
+            # The streaming thread switches between drains
+            self.pending_spectrum = (nfft, rate)
+        else:
+            self.pending_spectrum = None
+            self.apply_spectrum(nfft, rate)
+
+
+    def apply_spectrum(self, nfft, rate):
+        if nfft:
+            # NumPy is only needed in spectrum mode
+            from spectrum_frames import SpectrumFramer
+            header_bytes, packet_bytes = spectrum_geometry(nfft)
+            self.spectrum = SpectrumFramer(nfft, rate, self.SAMPLE_RATE, sink=self.send_spectrum)
+            self.tx.set_geometry(packet_bytes, header_bytes)
+            self.tx.before_send = None
+        else:
+            self.spectrum = None
+            self.apply_format(self.samples_per_packet, self.extended_header, self.compression)
+        self.spectrum_rate = rate
+        self.fill_pos = 0
+
+
+    def spectrum_format(self):
+        '''
+        Returns the spectrum mode as a dict of nfft (0 when streaming samples), rate, averages, and packet_bytes
+        '''
+        nfft, rate = self.pending_spectrum or (self.spectrum.nfft if self.spectrum is not None else 0, self.spectrum_rate)
+        if not nfft:
+            return {'nfft': 0, 'rate': rate, 'averages': 0, 'packet_bytes': 0}
+        return {'nfft': nfft, 'rate': rate, 'averages': spectrum_averages(nfft, rate, self.SAMPLE_RATE),
+                'packet_bytes': spectrum_geometry(nfft)[1]}
+
+
     def send_packet(self, payload):
         '''
-        Transmits a UDP datagram of radio output samples to the provided UDP port
+        Queues the UDP datagram from create_packet() for transmission, queued datagrams are sent in batches
 
         Parameters:
-            sock (socket): the socket object
-            payload (bytes): the data payload of radio samples
-            udp_ip (str): the destination IP address
-            udp_port (int): the destination port
+            payload (memoryview): the datagram returned by create_packet()
 
         Returns:
             None
         '''
-        self.sock.sendto(payload, (self.udp_ip, self.udp_port))
+        self.tx.commit()
+
+
+    def start(self):
+        '''
+        Starts the streaming thread, and in 'process' reader mode first forks the reader process, from the calling
+        thread so that no other thread of this process is running mid-operation when it forks
+        '''
+        if (self.reader_mode == 'process'):
+            # fork so the reader process inherits the open radio registers and the shared ring
+            context = multiprocessing.get_context('fork')
+            self.ring = SampleRing(context, self.RING_BLOCKS, self.BLOCK_WORDS)
+            self.reader_stop = context.Event()
+            self.reader = context.Process(target=self.read_blocks, name=f'{self.name} reader', daemon=True)
+            self.reader.start()
+        super().start()
+
+
+    def read_blocks(self):
+        '''
+        Runs in the reader process: drains the FIFO in whole blocks into the sample ring, each stamped with the timer
+        at its drain, waiting between drains as set by wait_mode. When the ring is full the samples stay in the FIFO
+        until the sender frees a block
+        '''
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.set_wakeup_fd(-1)
+        ring = self.ring
+        block_time = self.BLOCK_WORDS / self.SAMPLE_RATE
+        start_cpu = time.process_time_ns()
+        start_time = time.monotonic_ns()
+        blocks = 0
+        backpressure = 0
+        while not self.reader_stop.is_set():
+            fifo_count = self.get_fifo_reg(self.fifo_count_offset)
+            timer = self.read_timer()
+            self.fifo_high_water = max(self.fifo_high_water, fifo_count)
+            if (fifo_count >= self.radio.fifo_depth):
+                self.fifo_overflows += 1
+            for _ in range(fifo_count // self.BLOCK_WORDS):
+                block = ring.put(block_time)
+                if block is None:
+                    # The sender is behind, leave the rest in the FIFO
+                    backpressure += 1
+                    break
+                self.read_fifo(block, self.BLOCK_WORDS)
+                ring.stamps[ring.head] = timer
+                ring.commit()
+                blocks += 1
+            for name, val in (('blocks', blocks), ('hwm', self.fifo_high_water), ('overflows', self.fifo_overflows),
+                              ('wakeups', self.wakeups), ('backpressure', backpressure),
+                              ('cpu_ns', time.process_time_ns() - start_cpu), ('run_ns', time.monotonic_ns() - start_time)):
+                ring.set_counter(name, val)
+            self.wait_for_samples(self.BLOCK_WORDS - fifo_count % self.BLOCK_WORDS)
+
+
+    def send_blocks(self):
+        '''
+        Runs in the streaming thread in 'process' reader mode: packs the blocks from the reader process into packets
+        and transmits them, sending queued packets whenever the ring runs empty
+        '''
+        ring = self.ring
+        start_cpu = time.thread_time()
+        start_time = time.monotonic()
+        while not self.stop_thread:
+            block = ring.get(0)
+            if block is None:
+                self.tx.flush()
+                block = ring.get(0.1)
+                if block is None:
+                    continue
+            # Follow the reader's extended timer on every block, whatever the frame format, so this thread's own
+            # readings for the send delays never miss a wrap
+            stamp = ring.stamps[ring.tail]
+            self.timer.follow(stamp)
+            self.take_samples(len(block), block, stamp)
+            ring.release()
+            self.cpu_time = time.thread_time() - start_cpu
+            self.run_time = time.monotonic() - start_time
+        self.tx.flush()
+        self.reader_stop.set()
+        self.reader.join(1.0)
+        if self.reader.is_alive():
+            self.reader.terminate()
 
 
     def run(self):
         '''
-        Overrides Thread run() function to create and transmit a UDP packet whenever enough data is available
+        Overrides Thread run() function to drain the FIFO into packets and transmit them, waiting between drains for
+        the rest of the current packet (at most half the FIFO) as set by wait_mode. In 'process' reader mode the reader
+        process drains the FIFO and this thread only packs and sends
         '''
+        if (self.reader_mode == 'process'):
+            self.send_blocks()
+            self.tx.close()
+            if self.uio_fd is not None:
+                os.close(self.uio_fd)
+            return
+        start_cpu = time.thread_time()
+        start_time = time.monotonic()
         while(1):
             if (self.stop_thread):
                 break
-            payload = self.create_packet()
-            if payload is not None and self.udp_enable:
-                self.send_packet(payload)
+            # Read the count once, then every sample it covers. The drain time is for extended headers, and is read on
+            # every drain so no timer wrap is missed
+            fifo_count = self.get_fifo_reg(self.fifo_count_offset)
+            timer = self.read_timer()
+            self.fifo_high_water = max(self.fifo_high_water, fifo_count)
+            if (fifo_count >= self.radio.fifo_depth):
+                # The radio has been dropping samples since the last drain
+                self.fifo_overflows += 1
+            if (fifo_count > 0):
+                self.take_samples(fifo_count, timer=timer)
+            # FIFO drained, send anything still queued and wait for the rest of the packet, a jumbo packet takes
+            # several drains so the FIFO never fills. Spectrum mode has no packet to wait for and drains half the FIFO
+            self.tx.flush()
+            if self.spectrum is not None:
+                self.wait_for_samples(self.radio.fifo_depth // 2)
+            else:
+                self.wait_for_samples(min(self.samples_per_packet - self.fill_pos, self.radio.fifo_depth // 2))
+            self.cpu_time = time.thread_time() - start_cpu
+            self.run_time = time.monotonic() - start_time
+        self.tx.close()
+        if self.uio_fd is not None:
+            os.close(self.uio_fd)
+
+
+    def wait_for_samples(self, needed):
+        '''
+        Waits until about needed more samples are in the FIFO
+
+        'sleep' sleeps for the expected fill time, shortened by the measured wakeup latency so the FIFO never overflows
+        'uio' blocks on the UIO interrupt, with twice the fill time as a timeout in case an interrupt is missed
+
+        Parameters:
+            needed (int): the number of samples to wait for
+
+        Returns:
+            None
+        '''
+        if (self.wait_mode == 'poll'):
+            return
+        fill_time = needed / self.SAMPLE_RATE
+        self.wakeups += 1
+        if (self.wait_mode == 'uio'):
+            # Unmask the interrupt, wait for it, and acknowledge it by reading the interrupt count
+            os.write(self.uio_fd, struct.pack('I', 1))
+            ready, _, _ = select.select([self.uio_fd], [], [], 2 * fill_time)
+            if ready:
+                os.read(self.uio_fd, 4)
+        else:
+            delay = max(fill_time - self.wake_latency, 0)
+            before = time.monotonic()
+            time.sleep(delay)
+            # Track how much later than asked the sleep ends, as a running average
+            self.wake_latency += (time.monotonic() - before - delay - self.wake_latency) / 8
+
+
+    def stats(self):
+        '''
+        Returns the reader counters
+
+        Returns:
+            stats (dict): packets built, datagrams sent, the reader thread CPU use (% of one core), the FIFO high-water
+            mark (samples), the number of drains that found the FIFO full, the number of wakeups, and the median, 99th
+            percentile and largest drain to send latency (us) of packets with the extended header, and the spectrum
+            frames sent in spectrum mode. In 'process'
+            reader mode, cpu is the reader process and sender thread together, also given as reader_cpu and
+            sender_cpu, and backpressure counts the times the reader found the sample ring full
+        '''
+        cpu = 100 * self.cpu_time / self.run_time if self.run_time > 0 else 0.0
+        latency = self.send_latency
+        stats = {'packets': self.tx.packets_sent, 'datagrams': self.tx.datagrams_sent, 'cpu': cpu,
+                 'hwm': self.fifo_high_water, 'overflows': self.fifo_overflows, 'wakeups': self.wakeups, 'seq': self.seq_num,
+                 'latency_p50': latency.percentile(50), 'latency_p99': latency.percentile(99), 'latency_max': latency.max_us,
+                 'spectrum_frames': self.spectrum_frames}
+        if self.ring is not None:
+            counters = self.ring.counters()
+            reader_cpu = 100 * counters['cpu_ns'] / counters['run_ns'] if counters['run_ns'] > 0 else 0.0
+            stats.update({'cpu': reader_cpu + cpu, 'reader_cpu': reader_cpu, 'sender_cpu': cpu, 'hwm': counters['hwm'],
+                          'overflows': counters['overflows'], 'wakeups': counters['wakeups'],
+                          'backpressure': counters['backpressure']})
+        return stats
+
+
+    def latency(self, reset=False):
+        '''
+        Returns the drain to send latency histogram (LatencyHistogram) of packets with the extended header, starting a
+        new one if reset
+        '''
+        if (reset):
+            latency, self.send_latency = self.send_latency, LatencyHistogram()
+            return latency
+        return self.send_latency
+
+
+    def print_counters(self):
+        '''
+        Prints the reader counters to the user
+        '''
+        stats = self.stats()
+        print(f"    Packets sent: {stats['packets']}")
+        print(f"    Datagrams sent: {stats['datagrams']}")
+        print(f"    Reader CPU use: {stats['cpu']:.1f} %")
+        print(f"    FIFO high-water mark: {stats['hwm']} of {self.radio.fifo_depth} samples")
+        print(f"    FIFO overflows: {stats['overflows']}")
+        print(f"    Wakeups: {stats['wakeups']}")
+        if self.spectrum is not None:
+            print(f"    Spectrum frames sent: {stats['spectrum_frames']} ({self.spectrum.nfft}-point,"
+                  f" {self.spectrum.averages} averages)")
+        if (self.send_latency.count):
+            print(f"    Drain to send latency: median {stats['latency_p50']:.0f} us, 99% {stats['latency_p99']:.0f} us,"
+                  f" max {stats['latency_max']:.0f} us")
+        if 'backpressure' in stats:
+            print(f"    Reader process CPU use: {stats['reader_cpu']:.1f} %, sender thread: {stats['sender_cpu']:.1f} %")
+            print(f"    Sample ring full: {stats['backpressure']} times")
 
 
     def print_instructions(self):
@@ -231,79 +895,46 @@ class LinuxSDR(Thread):
         print("Enter 's' or 'stream' to toggle the UDP packet streaming")
         print("Enter 'i' or 'IP' to update the destination IP address")
         print("Enter 'p' or 'port' to update the destination UDP port")
+        print("Enter 'a' or 'add' to add another destination IP address and UDP port")
+        print("Enter 'r' or 'remove' to remove a destination IP address and UDP port")
+        print("Enter 'l' or 'list' to list the destinations")
+        print("Enter 'c' or 'counters' to show the reader counters")
         print("Enter 'm' or 'mute' to toggle the speaker output")
         print("Enter 'h' or 'help' to repeat these instructions")
         print("Enter 'e' or 'exit' to terminate the program\n")
 
 
-    def print_freq_update(self, freq):
+    def print_freq_update(self, freq, phase_inc=None):
         '''
         Prints the ADC or tuner frequency change to the user
 
         Parameters:
             freq (int): the new frequency
+            phase_inc (int): the phase increment written for it, computed if not given
+
+        Returns:
+            None
         '''
+        if phase_inc is None:
+            phase_inc = self.freq_to_inc(freq)
         print(f'    Frequency: {freq}')
-        print(f'    Phase Increment: {self.freq_to_inc(freq)}')
+        print(f'    Phase Increment: {phase_inc}')
+        print(f'    Achieved Frequency: {inc_to_freq(phase_inc):.3f}')
 
 
-def main(udp_ip, udp_port, adc_freq, tuner_freq):
-    # TODO: add multithreading for reading FIFO and creating UDP packets
-    sdr = LinuxSDR(udp_ip=udp_ip, udp_port=udp_port, adc_freq=adc_freq, tuner_freq=tuner_freq)
-    sdr.start()
+def main(udp_ip, udp_port, adc_freq, tuner_freq, sim_path=None, sim_source='tone', wait_mode='sleep', uio_path=None, control_addr=DEFAULT_CONTROL_ADDR, control_port=DEFAULT_CONTROL_PORT, reader_mode='thread', samples_per_packet=LinuxSDR.SAMPLES_PER_PACKET, extended_header=False,
+         spectrum_nfft=0, spectrum_rate=SPECTRUM_RATE, compression='none'):
+    sdr = LinuxSDR(udp_ip=udp_ip, udp_port=udp_port, adc_freq=adc_freq, tuner_freq=tuner_freq, radio=open_radio(sim_path, sim_source), wait_mode=wait_mode, uio_path=uio_path, reader_mode=reader_mode,
+                   samples_per_packet=samples_per_packet, extended_header=extended_header, spectrum_nfft=spectrum_nfft,
+                   spectrum_rate=spectrum_rate, compression=compression)
     print('\n------------------------------------')
     print('Linux SDR with Ethernet - Zach Hicks')
     print('------------------------------------\n')
     print(f'Initially configured to transmit UDP packets to {sdr.udp_ip}:{str(sdr.udp_port)}')
     sdr.print_instructions()
 
-    # Control loop
-    while(1):
-        command = input("Enter a command: ")
-        print('')
-        if (command == 'f' or command == 'frequency'):
-            adc_freq = int(input('Enter an ADC frequency: '))
-            sdr.set_freq_reg(sdr.adc_offset, adc_freq)
-        elif (command == 't' or command == 'tune'):
-            tuner_freq = int(input('Enter a tuner frequency: '))
-            sdr.set_freq_reg(sdr.tuner_offset, tuner_freq)
-        elif (command == 'u'):
-            adc_freq = sdr.adc_freq + 100
-            sdr.set_freq_reg(sdr.adc_offset, adc_freq)
-        elif (command == 'U'):
-            adc_freq = sdr.adc_freq + 1000
-            sdr.set_freq_reg(sdr.adc_offset, adc_freq)
-        elif (command == 'd'):
-            if (sdr.adc_freq >= 100):
-                adc_freq = sdr.adc_freq - 100
-                sdr.set_freq_reg(sdr.adc_offset, adc_freq)
-            else:
-                print('Frequency cannot be decreased any further!')
-        elif (command == 'D'):
-            if (sdr.adc_freq >= 1000):
-                adc_freq = sdr.adc_freq - 1000
-                sdr.set_freq_reg(sdr.adc_offset, adc_freq)
-            else:
-                print('Frequency cannot be decreased any further!')
-        elif (command == 'm' or command == 'mute'):
-            sdr.toggle_mute()
-        elif (command == 's' or command == 'stream'):
-            sdr.toggle_udp()
-        elif (command == 'i' or command == 'IP'):
-            sdr.udp_ip = input('Enter a new destination IP address: ')
-        elif (command == 'p' or command == 'port'):
-            sdr.udp_port = int(input('Enter a new destination UDP port: '))
-        elif (command == 'h' or command == 'help'):
-            sdr.print_instructions()
-        elif (command == 'e' or command == 'exit'):
-            sdr.set_ctrl_reg(sdr.adc_offset, 0)
-            sdr.set_ctrl_reg(sdr.tuner_offset, 0)
-            sdr.stop_thread = 1
-            print('Terminated UDP sender...')
-            print('Exiting...')
-            print('')
-            quit()
-        print('')
+    # Control loop, the streaming thread is started and stopped by the controller
+    asyncio.run(Controller(sdr, control_addr, control_port).run())
 
 
 
@@ -314,18 +945,24 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--port', nargs='?', help='Destination UDP port', default=25344)
     parser.add_argument('-f', '--freq', nargs='?', help='Simulated ADC frequency (Hz)', default=0)
     parser.add_argument('-t', '--tuner_freq', nargs='?', help='Tuner frequency (Hz)', default=0)
+    parser.add_argument('-w', '--wait', choices=LinuxSDR.WAIT_MODES, help='How to wait for the FIFO to fill: spin on the count register, sleep for the expected fill time, or wait for a UIO interrupt', default='sleep')
+    parser.add_argument('--uio', help='UIO device of the FIFO interrupt, for --wait uio', default=None)
+    parser.add_argument('-r', '--reader', choices=LinuxSDR.READER_MODES, help='Read the FIFO in the streaming thread, or in a separate process feeding it through a shared-memory ring', default='thread')
+    parser.add_argument('-n', '--samples_per_packet', type=int, help=f'I/Q samples per UDP frame, up to {MAX_SAMPLES_PER_PACKET} with a 9000-byte MTU', default=LinuxSDR.SAMPLES_PER_PACKET)
+    parser.add_argument('-x', '--extended_header', action='store_true', help='Send the extended frame header carrying the radio timer and frequencies')
+    parser.add_argument('-z', '--compression', choices=COMPRESSIONS, help='Sample format of extended-header frames: 16-bit, or block floating point packed to 12 or 8 bits per value', default='none')
+    parser.add_argument('-S', '--spectrum', type=int, metavar='NFFT', help='Send averaged NFFT-point power spectra computed on the board instead of the samples', default=0)
+    parser.add_argument('--spectrum_rate', type=float, help='Spectrum frames per second in spectrum mode', default=SPECTRUM_RATE)
+    parser.add_argument('--control_addr', help='Address the TCP command endpoint listens on', default=DEFAULT_CONTROL_ADDR)
+    parser.add_argument('--control_port', type=int, help='TCP port of the command endpoint, 0 to disable it', default=DEFAULT_CONTROL_PORT)
+    parser.add_argument('--sim', nargs='?', const=DEFAULT_SIM_PATH, help='Run against a simulated radio backed by the given file instead of /dev/mem', default=None)
+    parser.add_argument('--sim_source', choices=SIM_SOURCES, help='Simulated sample source: tone, linear DDC model, or bit-accurate DDC model', default='tone')
+    parser.add_argument('--force', action='store_true', help='Reload the FPGA images even if they are already loaded')
     args = parser.parse_args()
 
-    # Load FPGA images
-    codec_config_cmd = 'fpgautil -b config_codec.bit.bin'
-    radio_config_cmd = 'fpgautil -b design_1_wrapper_ila.bit.bin'
-    print('')
-    print("Loading codec_config.bit.bin ...")
-    print('')
-    subprocess.run(codec_config_cmd, shell=True)
-    print('')
-    print("Loading design_1_wrapper.bit.bin ...")
-    print('')
-    subprocess.run(radio_config_cmd, shell=True)
-
-    main(args.dest_ip_addr, int(args.port), int(args.freq), int(args.tuner_freq))
\ No newline at end of file
+    if (args.sim is None):
+        # Load FPGA images
+        load_bitstreams((CODEC_BITSTREAM, 'design_1_wrapper_ila.bit.bin'), force=args.force)
+
+    main(args.dest_ip_addr, int(args.port), int(args.freq), int(args.tuner_freq), args.sim, args.sim_source, args.wait, args.uio, args.control_addr, args.control_port or None, args.reader,
+         args.samples_per_packet, args.extended_header, args.spectrum, args.spectrum_rate, args.compression)
\ No newline at end of file
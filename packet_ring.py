@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+### Packet ring transmitter
+# Preallocated UDP datagram slots that are filled in place and sent on connected sockets
+# Several queued datagrams go out in one sendmmsg() call where the C library provides it
+# Every datagram is built once and sent to each destination in the subscriber table, which can change at any time
+
+### UDP Frame formats
+# Legacy (the default): a 2-byte sequence number followed by the samples, 256 of them in 1026 bytes unless configured
+# Extended: a 28-byte header (EXT_HEADER) followed by the samples
+#   Bytes 0-1:   16-bit sequence number, as in the legacy format
+#   Byte 2:      header version, EXT_VERSION
+#   Byte 3:      flags: bits 4-5 the sample format, an index into COMPRESSIONS, and bits 0-3 its block exponent
+#   Bytes 4-5:   header length in bytes, the samples start here
+#   Bytes 6-7:   samples in the frame
+#   Bytes 8-15:  radio timer (125 MHz, extended to 64 bits, see timestamps.py) when the first sample of the frame was
+#                read from the FIFO
+#   Bytes 16-19: tuner phase increment
+#   Bytes 20-23: ADC phase increment
+#   Bytes 24-27: timer ticks from that FIFO read until the frame was handed to the socket
+# Samples are interleaved 16-bit signed I/Q, little endian, as are the header fields. A legacy frame is 2 bytes over
+# a multiple of 4 long and an extended one a multiple of 4, which is how receivers tell them apart
+# Up to MAX_SAMPLES_PER_PACKET samples fit a 9000-byte (jumbo) MTU
+# Compressed (extended header only): block floating point, each frame's I/Q shifted right by the frame's block
+# exponent, the fewest bits that fit its largest sample, with rounding, then packed into fewer bits per value:
+#   bfp12: each sample in 3 bytes, I in the low 12 bits and Q in the high 12 bits of a little endian 24-bit word
+#   bfp8:  each sample in 2 bytes, I then Q
+# The samples are the packed values shifted back left by the exponent, exact whenever the frame's samples fit the
+# packed bits. The samples end zero-padded to a multiple of 4 bytes (sample_bytes())
+# Spectrum: in spectrum mode the board sends averaged power spectra instead of samples, each frame of nfft bins split
+# over datagrams of a 40-byte header (SPEC_HEADER) and up to SPEC_BINS_PER_DATAGRAM bins
+#   Bytes 0-7:   as the extended header, with header version SPEC_VERSION and the bins in the datagram in bytes 6-7
+#   Bytes 8-15:  radio timer at the FIFO read that completed the frame
+#   Bytes 16-23: tuner and ADC phase increments
+#   Bytes 24-27: frame counter
+#   Bytes 28-29: FFT size
+#   Bytes 30-31: index of the datagram's first bin, bins run from -fs/2 to fs/2
+#   Bytes 32-33: FFT segments averaged into the frame
+#   Bytes 34-35: dB per code step, in hundredths of a dB
+#   Bytes 36-39: float32 dB/Hz (full scale = 1.0) of code 0
+# Each bin is one unsigned byte, ref_db + code * step, code 0 also standing for anything below ref_db. The length is a
+# multiple of 4 as for the extended header, receivers tell them apart by the version
+
+import socket
+import struct
+import ctypes
+import ctypes.util
+import errno
+from threading import Lock
+
+# Define constants
+SAMPLES_PER_PACKET = 256
+HEADER_BYTES = 2
+PACKET_BYTES = HEADER_BYTES + 4 * SAMPLES_PER_PACKET
+SEQ_MODULUS = 1 << 16
+EXT_HEADER = struct.Struct('<HBBHHQIII')
+EXT_HEADER_BYTES = EXT_HEADER.size
+EXT_VERSION = 2
+EXT_TIMER = struct.Struct('<Q')
+EXT_TIMER_OFFSET = 8
+EXT_SEND_DELAY = struct.Struct('<I')
+EXT_SEND_DELAY_OFFSET = 24
+MAX_DATAGRAM_BYTES = 9000 - 28
+MAX_SAMPLES_PER_PACKET = (MAX_DATAGRAM_BYTES - EXT_HEADER_BYTES) // 4
+COMPRESSIONS = ('none', 'bfp12', 'bfp8')
+COMPRESSION_BITS = (16, 12, 8)
+EXT_FLAGS_FORMAT_SHIFT = 4
+EXT_FLAGS_EXPONENT_MASK = 0x0F
+SPEC_HEADER = struct.Struct('<HBBHHQIIIHHHHf')
+SPEC_HEADER_BYTES = SPEC_HEADER.size
+SPEC_VERSION = 3
+SPEC_BINS_PER_DATAGRAM = 1024
+SPEC_DB_STEP = 0.5
+MIN_SPECTRUM_NFFT = 64
+MAX_SPECTRUM_NFFT = 32768
+SPECTRUM_RATE = 2.0
+
+
+def sample_bytes(samples_per_packet, compression='none'):
+    '''
+    Returns the bytes the samples of a frame take, 4 per sample uncompressed, padded to a multiple of 4 compressed
+
+    Raises:
+        ValueError: if compression is not one of COMPRESSIONS
+    '''
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'compression must be one of {COMPRESSIONS}')
+    bits = COMPRESSION_BITS[COMPRESSIONS.index(compression)]
+    return -(-samples_per_packet * 2 * bits // 32) * 4
+
+
+def packet_geometry(samples_per_packet=SAMPLES_PER_PACKET, extended_header=False, compression='none'):
+    '''
+    Returns the header and datagram sizes of a frame format
+
+    Parameters:
+        samples_per_packet (int): the I/Q samples in each frame, 1 to MAX_SAMPLES_PER_PACKET
+        extended_header (bool): use the extended header instead of the legacy sequence number
+        compression (str): the sample format, one of COMPRESSIONS, compression needs the extended header
+
+    Returns:
+        header_bytes (int): the bytes before the samples
+        packet_bytes (int): the datagram length
+
+    Raises:
+        ValueError: if samples_per_packet is out of range, or the compression is unknown or without extended_header
+    '''
+    if not (1 <= samples_per_packet <= MAX_SAMPLES_PER_PACKET):
+        raise ValueError(f'samples_per_packet must be 1 to {MAX_SAMPLES_PER_PACKET}')
+    if (compression != 'none' and not extended_header):
+        raise ValueError('compression needs the extended header')
+    header_bytes = EXT_HEADER_BYTES if extended_header else HEADER_BYTES
+    return header_bytes, header_bytes + sample_bytes(samples_per_packet, compression)
+
+
+def parse_geometry(payload):
+    '''
+    Works out the frame format of a received datagram from its length, and its header for the extended format
+
+    Parameters:
+        payload (bytes-like): the datagram
+
+    Returns:
+        geometry (tuple): (samples_per_packet, header_bytes), or None if the datagram is not a radio frame. The sample
+                          format of an extended-header frame is in its flags, see frame_compression()
+    '''
+    length = len(payload)
+    if (length % 4 == HEADER_BYTES and length > HEADER_BYTES):
+        return (length - HEADER_BYTES) // 4, HEADER_BYTES
+    if (length % 4 == 0 and length > EXT_HEADER_BYTES):
+        _, version, flags, header_bytes, samples, _, _, _, _ = EXT_HEADER.unpack_from(payload)
+        code = flags >> EXT_FLAGS_FORMAT_SHIFT
+        if (version == EXT_VERSION and header_bytes == EXT_HEADER_BYTES and code < len(COMPRESSIONS) and
+                length == header_bytes + sample_bytes(samples, COMPRESSIONS[code])):
+            return samples, header_bytes
+    return None
+
+
+def frame_compression(payload):
+    '''
+    Returns the sample format (one of COMPRESSIONS) of a radio frame that parse_geometry() recognized
+    '''
+    if (len(payload) % 4 != 0):
+        return 'none'
+    return COMPRESSIONS[payload[3] >> EXT_FLAGS_FORMAT_SHIFT]
+
+
+def spectrum_geometry(nfft):
+    '''
+    Returns the header and datagram sizes of spectrum frames
+
+    Parameters:
+        nfft (int): the FFT size, a power of 2 from MIN_SPECTRUM_NFFT to MAX_SPECTRUM_NFFT
+
+    Returns:
+        header_bytes (int): the bytes before the bins
+        packet_bytes (int): the datagram length, every datagram of a frame has the same
+
+    Raises:
+        ValueError: if nfft is not a power of 2 or out of range
+    '''
+    if not (MIN_SPECTRUM_NFFT <= nfft <= MAX_SPECTRUM_NFFT and nfft & (nfft - 1) == 0):
+        raise ValueError(f'nfft must be a power of 2 from {MIN_SPECTRUM_NFFT} to {MAX_SPECTRUM_NFFT}')
+    return SPEC_HEADER_BYTES, SPEC_HEADER_BYTES + min(nfft, SPEC_BINS_PER_DATAGRAM)
+
+
+def spectrum_averages(nfft, rate, fs):
+    '''
+    Returns the FFT segments averaged into each spectrum frame, so frames go out at about rate per second, 1 to 65535
+
+    Parameters:
+        nfft (int): the FFT size
+        rate (float): the spectrum frames per second wanted
+        fs (float): the sample rate (Hz)
+    '''
+    if (rate <= 0):
+        raise ValueError('rate must be positive')
+    return min(max(1, round(fs / (rate * nfft))), 0xFFFF)
+
+
+def parse_spectrum(payload):
+    '''
+    Reads the header of a spectrum datagram
+
+    Parameters:
+        payload (bytes-like): the datagram
+
+    Returns:
+        header (tuple): the SPEC_HEADER fields (seq, version, flags, header_bytes, bins, timer, tuner_inc, adc_inc,
+                        frame, nfft, first_bin, averages, db_step, ref_db), or None if the datagram is not a spectrum
+                        datagram
+    '''
+    length = len(payload)
+    if (length % 4 != 0 or length <= SPEC_HEADER_BYTES):
+        return None
+    header = SPEC_HEADER.unpack_from(payload)
+    version, header_bytes, bins, nfft, first_bin = header[1], header[3], header[4], header[9], header[10]
+    if (version == SPEC_VERSION and header_bytes == SPEC_HEADER_BYTES and length == header_bytes + bins and
+            first_bin + bins <= nfft):
+        return header
+    return None
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+def load_sendmmsg():
+    '''
+    Returns the C library sendmmsg() function, or None where it is not available
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    func.restype = ctypes.c_int
+    return func
+
+
+def load_recvmmsg():
+    '''
+    Returns the C library recvmmsg() function, or None where it is not available
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.recvmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    func.restype = ctypes.c_int
+    return func
+
+
+class PacketRing():
+    '''
+    A ring of preallocated datagram slots sent to a table of destinations, each with its own connected UDP socket
+
+    Usage:
+        slot = ring.acquire()         # memoryview of the next free datagram, header_bytes of header then the samples
+        ... write the header and samples into slot, e.g. through ring.sample_words[ring.head] ...
+        ring.commit()                 # queue it, a full batch is sent right away
+        ring.flush()                  # send whatever is queued, e.g. once the FIFO is drained
+
+    The destination table may be changed from another thread while the ring is being filled and sent: changes build a
+    new table and swap it in, and sockets of removed destinations are closed by the sending thread
+
+    before_send, if set, is called as before_send(first, count) with the queued slots just before they are sent, e.g.
+    to stamp the send time into their headers
+    '''
+
+    def __init__(self, destinations=(), num_slots=8, batch=8, packet_bytes=PACKET_BYTES, header_bytes=HEADER_BYTES):
+        self.num_slots = num_slots
+        self.batch = min(batch, num_slots)
+        self.sendmmsg = load_sendmmsg()
+        self.set_geometry(packet_bytes, header_bytes)
+        self.before_send = None
+        self.head = 0
+        self.packets_sent = 0
+        self.datagrams_sent = 0
+        self.send_calls = 0
+
+        # Subscriber table: tuple of ((udp_ip, udp_port), socket), replaced as a whole on every change
+        self.table = ()
+        self.retired = []
+        self.lock = Lock()
+        for udp_ip, udp_port in destinations:
+            self.add_destination(udp_ip, udp_port)
+
+
+    def set_geometry(self, packet_bytes, header_bytes=HEADER_BYTES):
+        '''
+        Reallocates the slots for another datagram size, anything queued and not yet sent is discarded, so flush()
+        first
+
+        Parameters:
+            packet_bytes (int): the datagram length
+            header_bytes (int): the bytes before the samples in each datagram, a multiple of 2
+
+        Returns:
+            None
+        '''
+        num_slots = self.num_slots
+        self.packet_bytes = packet_bytes
+        self.header_bytes = header_bytes
+        self.buf = bytearray(num_slots * packet_bytes)
+        view = memoryview(self.buf)
+        self.slots = [view[i * packet_bytes:(i + 1) * packet_bytes] for i in range(num_slots)]
+        self.sample_words = [slot[header_bytes:].cast('I') for slot in self.slots]
+        self.pending = 0
+
+        # One iovec/mmsghdr per slot, pointing at the slot buffers, so a batch is sent without building anything
+        self.buf_ref = ctypes.c_char.from_buffer(self.buf)
+        base = ctypes.addressof(self.buf_ref)
+        self.iovecs = (iovec * num_slots)()
+        self.msgs = (mmsghdr * num_slots)()
+        for i in range(num_slots):
+            self.iovecs[i].iov_base = base + i * packet_bytes
+            self.iovecs[i].iov_len = packet_bytes
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+
+    @property
+    def destinations(self):
+        '''
+        The current destinations, as a tuple of (udp_ip, udp_port)
+        '''
+        return tuple(dest for dest, _ in self.table)
+
+
+    def add_destination(self, udp_ip, udp_port):
+        '''
+        Adds a destination to the subscriber table, starting with the next datagram sent
+
+        Returns:
+            added (bool): False if the destination was already in the table
+
+        Raises:
+            OSError: if the destination cannot be connected to, e.g. an unresolvable host
+        '''
+        dest = (udp_ip, int(udp_port))
+        with self.lock:
+            if dest in self.destinations:
+                return False
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.connect(dest)
+            except OSError:
+                sock.close()
+                raise
+            self.table = self.table + ((dest, sock),)
+        return True
+
+
+    def remove_destination(self, udp_ip, udp_port):
+        '''
+        Removes a destination from the subscriber table
+
+        Returns:
+            removed (bool): False if the destination was not in the table
+        '''
+        dest = (udp_ip, int(udp_port))
+        with self.lock:
+            kept = tuple(entry for entry in self.table if entry[0] != dest)
+            if (len(kept) == len(self.table)):
+                return False
+            self.retired.extend(sock for entry_dest, sock in self.table if entry_dest == dest)
+            self.table = kept
+        return True
+
+
+    def set_destinations(self, destinations):
+        '''
+        Replaces the subscriber table, keeping the sockets of destinations that stay
+        '''
+        wanted = [(udp_ip, int(udp_port)) for udp_ip, udp_port in destinations]
+        for dest in self.destinations:
+            if dest not in wanted:
+                self.remove_destination(*dest)
+        for dest in wanted:
+            self.add_destination(*dest)
+
+
+    def acquire(self):
+        '''
+        Returns the next free slot (memoryview of packet_bytes bytes), the slot is not queued until commit()
+        '''
+        return self.slots[self.head]
+
+
+    def commit(self):
+        '''
+        Queues the acquired slot for sending, sending the queue once a full batch is ready
+        '''
+        self.head = (self.head + 1) % self.num_slots
+        self.pending += 1
+        if (self.pending >= self.batch):
+            self.flush()
+
+
+    def flush(self):
+        '''
+        Sends all queued datagrams to every destination
+
+        Returns:
+            sent (int): the number of queued datagrams sent
+        '''
+        if self.retired:
+            with self.lock:
+                retired, self.retired = self.retired, []
+            for sock in retired:
+                sock.close()
+        table = self.table
+        first = (self.head - self.pending) % self.num_slots
+        count = self.pending
+        if (count > 0 and self.before_send is not None and table):
+            self.before_send(first, count)
+        while (count > 0):
+            run = min(count, self.num_slots - first)
+            for _, sock in table:
+                self.send_slots(sock, first, run)
+            first = (first + run) % self.num_slots
+            count -= run
+        sent = self.pending
+        self.pending = 0
+        self.packets_sent += sent
+        self.datagrams_sent += sent * len(table)
+        return sent
+
+
+    def send_slots(self, sock, first, count):
+        '''
+        Sends count consecutive slots starting at first on a connected socket, datagrams the socket refuses (e.g.
+        ECONNREFUSED from an earlier ICMP port unreachable) are dropped as sendto() would have dropped them
+        '''
+        while (count > 0):
+            self.send_calls += 1
+            if self.sendmmsg is not None and count > 1:
+                num = self.sendmmsg(sock.fileno(), ctypes.addressof(self.msgs) + first * ctypes.sizeof(mmsghdr), count, 0)
+                if (num <= 0):
+                    err = ctypes.get_errno()
+                    if (err == errno.ENOSYS):
+                        self.sendmmsg = None
+                    num = 0 if err in (errno.ENOSYS, errno.EINTR) else 1
+            else:
+                try:
+                    sock.send(self.slots[first])
+                except ConnectionRefusedError:
+                    pass
+                num = 1
+            first += num
+            count -= num
+
+
+    def close(self):
+        self.flush()
+        for _, sock in self.table:
+            sock.close()
+        self.table = ()
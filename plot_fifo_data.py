@@ -1,15 +1,82 @@
-import pickle
+#!/usr/bin/env python3
+
+### Plot FIFO data
+# Plots samples read from the radio FIFO, from a capture file written by iq_recorder.py or a fifo_data.pkl pickle of
+# FIFO words:
+#   a window of I and Q against the sample index (the default, samples 1000 to 1300 as before)
+#   --preview, the min/max envelope of I and Q over the whole capture
+#   --spectrogram, the power spectrogram over the whole capture
+# Decoding is vectorized (iq_tools.py) and captures are memory-mapped, so captures of tens of millions of samples plot
+# in seconds
+
+import argparse
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
+from iq_tools import load_samples, preview, spectrogram
+
+
+def plot_window(iq, start, count, output):
+    '''
+    Plots I and Q of count samples from start against the sample index
+    '''
+    stop = min(start + count, len(iq))
+    n = np.arange(start, stop)
+    plt.figure()
+    plt.plot(n, iq[start:stop, 0], n, iq[start:stop, 1])
+    plt.legend(['I', 'Q'])
+    plt.xlabel('Sample')
+    plt.savefig(output)
+    plt.close()
+
+
+def plot_preview(iq, fs, points, output):
+    '''
+    Plots the min/max envelope of I and Q over the whole capture in points buckets
+    '''
+    index, low, high = preview(iq, points)
+    t = index / fs
+    plt.figure()
+    plt.fill_between(t, low[:, 0], high[:, 0], step='post', alpha=0.6, label='I')
+    plt.fill_between(t, low[:, 1], high[:, 1], step='post', alpha=0.6, label='Q')
+    plt.legend()
+    plt.xlabel('Time (s)')
+    plt.savefig(output)
+    plt.close()
+
+
+def plot_spectrogram(iq, fs, nfft, rows, output):
+    '''
+    Plots the power spectrogram of the whole capture, at most rows FFTs of nfft samples
+    '''
+    times, freqs, power = spectrogram(iq, nfft, rows, fs)
+    plt.figure()
+    plt.pcolormesh(freqs, times, power, shading='auto')
+    plt.colorbar(label='dBFS')
+    plt.xlabel('Frequency (Hz)')
+    plt.ylabel('Time (s)')
+    plt.savefig(output)
+    plt.close()
+
+
+if __name__ == '__main__':
+    description = "Plot FIFO data - Plots I/Q samples from a capture file or fifo_data.pkl"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('input', nargs='?', help='Capture file (.sigmf-data/.sigmf-meta) or pickle of FIFO words (.pkl)', default='fifo_data.pkl')
+    parser.add_argument('-s', '--start', type=int, help='First sample of the plotted window', default=1000)
+    parser.add_argument('-n', '--count', type=int, help='Number of samples in the plotted window', default=300)
+    parser.add_argument('-o', '--output', help='Output image of the plotted window', default='fifo_data.png')
+    parser.add_argument('--preview', nargs='?', const='fifo_preview.png', help='Also plot the envelope of the whole capture to this image', default=None)
+    parser.add_argument('--points', type=int, help='Envelope buckets in the preview', default=4096)
+    parser.add_argument('--spectrogram', nargs='?', const='fifo_spectrogram.png', help='Also plot the spectrogram of the whole capture to this image', default=None)
+    parser.add_argument('--nfft', type=int, help='FFT size of the spectrogram', default=1024)
+    parser.add_argument('--rows', type=int, help='Maximum number of spectrogram rows', default=512)
+    args = parser.parse_args()
 
-with open('fifo_data.pkl', 'rb') as file:
-    samples = pickle.load(file)
-I = []
-Q = []
-for samp in samples:
-    I.append(samp & 0x0000FFFF)
-    Q.append((samp & 0xFFFF0000) >> 16)
-
-n = np.arange(0, len(samples))
-plt.plot(n[1000:1300], I[1000:1300], n[1000:1300], Q[1000:1300])
-plt.savefig('fifo_data.png')
+    iq, fs = load_samples(args.input)
+    plot_window(iq, args.start, args.count, args.output)
+    if args.preview is not None:
+        plot_preview(iq, fs, args.points, args.preview)
+    if args.spectrogram is not None:
+        plot_spectrogram(iq, fs, args.nfft, args.rows, args.spectrogram)
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+
+### Radio manager
+# Runs several radios from one host process, with one control and status surface for all of them
+#   local radios    each runs in its own process with its own LinuxSDR, reader, destinations, counters, and controller,
+#                   pinned to its own core so N radios scale across the cores; the peripheral addresses are per radio,
+#                   for bitstreams that carry several radio cores
+#   remote radios   boards running linux_sdr.py or linux_sdr_python.py, reached through their JSON control port
+# The radios are listed in a JSON file, one object per radio (see RADIO_DEFAULTS), e.g.
+#   [{"name": "rx0", "udp_port": 25344},
+#    {"name": "rx1", "radio_base_addr": "0x43c20000", "fifo_base_addr": "0x43c30000", "udp_port": 25346},
+#    {"name": "board2", "remote": "192.168.1.12:25345"}]
+
+### JSON control API
+# Requests use the JSON control API of controller.py, over TCP (one request per line) or UDP datagrams to the manager's
+# control port, or typed at the terminal. A "radio" value picks the radio a command goes to:
+#   {"radio": "rx0", "cmd": "set_freq", "target": "tuner", "hz": 1000}   answered as that radio answers, plus "radio"
+#   {"cmd": "mute", "on": true}                                          no "radio", or "all": sent to every radio at
+#                                                                         once, answered {"ok": ..., "radios": {...}}
+#   {"cmd": "status"}                                                    every radio's status, plus "totals"
+#   {"cmd": "radios"}                                                    the radio names and where they run
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+from registers import open_radio, RADIO_PERIPH_BASE_ADDR, FIFO_BASE_ADDR, DEFAULT_SIM_PATH, SIM_SOURCES
+from controller import Controller
+from startup import load_bitstreams, build_reader
+
+# Define constants
+DEFAULT_MANAGER_PORT = 25340
+RADIO_DEFAULTS = {
+    'name': None,
+    'reader': 'python',                     # 'python' (LinuxSDR) or 'c' (fifo_reader process)
+    'reader_mode': 'thread',                # for 'python', read the FIFO in the LinuxSDR thread or in its own process
+    'radio_base_addr': RADIO_PERIPH_BASE_ADDR,
+    'fifo_base_addr': FIFO_BASE_ADDR,
+    'udp_ip': '127.0.0.1',
+    'udp_port': 25344,
+    'adc_freq': 0,
+    'tuner_freq': 0,
+    'wait_mode': 'sleep',
+    'uio_path': None,
+    'samples_per_packet': 256,              # I/Q samples per UDP frame, up to jumbo frames, see packet_ring.py
+    'extended_header': False,               # send the extended frame header with the radio timer and frequencies
+    'spectrum_nfft': 0,                     # send on-board NFFT-point power spectra instead of samples, see spectrum_frames.py
+    'spectrum_rate': 2.0,                   # spectrum frames per second in spectrum mode
+    'compression': 'none',                  # sample format of extended-header frames, see iq_compression.py
+    'control_path': None,                   # fifo_reader control socket, /tmp/fifo_reader_<name>.ctl by default
+    'sim_path': None,                       # run against a SimulatedRadio backed by this file
+    'sim_source': 'tone',
+    'remote': None,                         # 'ip:port' of a board's JSON control port instead of a local radio
+}
+SUMMED_COUNTERS = ('packets', 'datagrams', 'overflows', 'cpu')
+
+
+def radio_config(config, index):
+    '''
+    Fills in the defaults of one radio's configuration
+
+    Parameters:
+        config (dict): the radio's settings, see RADIO_DEFAULTS, addresses may be strings such as "0x43c20000"
+        index (int): the radio's position in the list, used for the default name
+
+    Returns:
+        config (dict): the complete configuration
+
+    Raises:
+        ValueError: if a setting is unknown
+    '''
+    unknown = set(config) - set(RADIO_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown radio settings {sorted(unknown)}")
+    config = {**RADIO_DEFAULTS, **config}
+    if config['name'] is None:
+        config['name'] = f'radio{index}'
+    for key in ('radio_base_addr', 'fifo_base_addr'):
+        config[key] = int(config[key], 0) if isinstance(config[key], str) else int(config[key])
+    if config['control_path'] is None:
+        config['control_path'] = f"/tmp/fifo_reader_{config['name']}.ctl"
+    if (config['reader'] == 'c' and config['sim_path'] is not None):
+        raise ValueError(f"{config['name']}: the C reader needs the hardware, use reader 'python' with sim_path")
+    return config
+
+
+def run_radio(config, pipe, core=None):
+    '''
+    Runs one radio in this process until the manager closes the pipe, answering the JSON requests sent over it
+
+    Parameters:
+        config (dict): the radio's configuration, see radio_config()
+        pipe (Connection): the radio's end of the manager's pipe
+        core (int): the core to pin this process, and its fifo_reader, to, or None
+
+    Returns:
+        None
+    '''
+    if core is not None:
+        os.sched_setaffinity(0, {core})
+    # The manager handles Ctrl-C and shuts the radios down through their pipes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    settings = {'radio_base_addr': config['radio_base_addr'], 'fifo_base_addr': config['fifo_base_addr'],
+             'samples_per_packet': config['samples_per_packet'], 'extended_header': config['extended_header'],
+             'spectrum_nfft': config['spectrum_nfft'], 'spectrum_rate': config['spectrum_rate'],
+             'compression': config['compression']}
+    if (config['reader'] == 'c'):
+        from linux_sdr import LinuxSDR
+        sdr = LinuxSDR(config['udp_ip'], config['udp_port'], config['adc_freq'], config['tuner_freq'],
+                       control_path=config['control_path'], wait_mode=config['wait_mode'], uio_path=config['uio_path'],
+                       **settings)
+    else:
+        from linux_sdr_python import LinuxSDR
+        radio = open_radio(config['sim_path'], config['sim_source']) if config['sim_path'] is not None else None
+        sdr = LinuxSDR(config['udp_ip'], config['udp_port'], config['adc_freq'], config['tuner_freq'], radio=radio,
+                       wait_mode=config['wait_mode'], uio_path=config['uio_path'], name=config['name'],
+                       reader_mode=config['reader_mode'], **settings)
+    asyncio.run(Controller(sdr, control_port=None, interactive=False, pipe=pipe).run())
+
+
+class LocalRadio():
+    '''
+    A radio run by run_radio() in a child process, commands go over a pipe one at a time
+    '''
+
+    def __init__(self, config, core=None):
+        self.config = config
+        self.name = config['name']
+        self.core = core
+        self.pipe, child_pipe = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=run_radio, args=(config, child_pipe, core), name=self.name)
+        self.process.start()
+        child_pipe.close()
+        self.lock = asyncio.Lock()
+
+
+    def describe(self):
+        where = f"pid {self.process.pid}" + (f", core {self.core}" if self.core is not None else '')
+        return {'where': where, 'reader': self.config['reader'], 'radio_base_addr': hex(self.config['radio_base_addr']),
+                'fifo_base_addr': hex(self.config['fifo_base_addr'])}
+
+
+    async def request(self, command):
+        '''
+        Sends one JSON command to the radio and returns its result object
+        '''
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            if not self.process.is_alive():
+                return {'ok': False, 'error': 'The radio process has exited'}
+            reply = loop.create_future()
+
+            def receive():
+                loop.remove_reader(self.pipe.fileno())
+                try:
+                    reply.set_result(self.pipe.recv_bytes())
+                except (EOFError, OSError) as e:
+                    reply.set_exception(ConnectionError(f'The radio process has exited: {e}'))
+
+            try:
+                # The process can exit after the check above, which breaks the pipe
+                self.pipe.send_bytes(json.dumps(command).encode())
+            except OSError as e:
+                return {'ok': False, 'error': f'The radio process has exited: {e}'}
+            loop.add_reader(self.pipe.fileno(), receive)
+            try:
+                return json.loads(await reply)
+            except ConnectionError as e:
+                return {'ok': False, 'error': str(e)}
+
+
+    async def close(self, timeout=5.0):
+        '''
+        Closes the pipe, which shuts the radio down and zeroes its frequencies, and waits for the process to exit
+        '''
+        self.pipe.close()
+        await asyncio.to_thread(self.process.join, timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class RemoteRadio():
+    '''
+    A radio on another board, reached through the JSON control port of its linux_sdr.py or linux_sdr_python.py
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.name = config['name']
+        host, _, port = config['remote'].rpartition(':')
+        self.addr = (host, int(port))
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+
+    def describe(self):
+        return {'where': f'{self.addr[0]}:{self.addr[1]}', 'reader': 'remote'}
+
+
+    async def request(self, command):
+        '''
+        Sends one JSON command to the board and returns its result object, reconnecting if needed
+        '''
+        async with self.lock:
+            try:
+                if self.writer is None:
+                    self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.addr), 2.0)
+                self.writer.write(json.dumps(command).encode() + b'\n')
+                await self.writer.drain()
+                line = await asyncio.wait_for(self.reader.readline(), 2.0)
+                if not line:
+                    raise ConnectionError('Connection closed')
+                return json.loads(line)
+            except (OSError, asyncio.TimeoutError) as e:
+                if self.writer is not None:
+                    self.writer.close()
+                self.reader, self.writer = None, None
+                return {'ok': False, 'error': f'{self.addr[0]}:{self.addr[1]} unreachable: {e or type(e).__name__}'}
+
+
+    async def close(self, timeout=5.0):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ManagerDatagramProtocol(asyncio.DatagramProtocol):
+    '''
+    Answers each JSON request datagram with a JSON reply datagram
+    '''
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.transport = None
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def datagram_received(self, data, addr):
+        async def reply():
+            self.transport.sendto((await self.manager.execute_json(data)).encode(), addr)
+        asyncio.ensure_future(reply())
+
+
+class RadioManager():
+    '''
+    Starts the radios, routes commands to them, and aggregates their status
+    '''
+
+    def __init__(self, configs, control_addr='127.0.0.1', control_port=DEFAULT_MANAGER_PORT, pin_cores=True):
+        self.configs = [radio_config(config, i) for i, config in enumerate(configs)]
+        names = [config['name'] for config in self.configs]
+        if len(set(names)) != len(names):
+            raise ValueError('Radio names must be unique')
+        self.control_addr = control_addr
+        self.control_port = control_port
+        self.pin_cores = pin_cores
+        self.radios = {}
+        self.stopping = None
+
+
+    def start(self):
+        '''
+        Starts a process for each local radio, spreading them over the cores this process may run on
+        '''
+        cores = sorted(os.sched_getaffinity(0))
+        local = 0
+        for config in self.configs:
+            if config['remote'] is not None:
+                self.radios[config['name']] = RemoteRadio(config)
+            else:
+                core = cores[local % len(cores)] if self.pin_cores else None
+                self.radios[config['name']] = LocalRadio(config, core)
+                local += 1
+
+
+    async def execute_command(self, command):
+        '''
+        Runs one JSON command on the radio it names, or on every radio
+
+        Returns:
+            result (dict): the result object, see the JSON control API above
+        '''
+        command = dict(command)
+        target = command.pop('radio', None)
+        if (command.get('cmd') == 'radios'):
+            return {'ok': True, 'radios': {name: radio.describe() for name, radio in self.radios.items()}}
+        if target is not None and target != 'all':
+            if target not in self.radios:
+                return {'ok': False, 'error': f"Unknown radio '{target}'"}
+            return {**await self.radios[target].request(command), 'radio': target}
+        names = list(self.radios)
+        results = await asyncio.gather(*(self.radios[name].request(command) for name in names))
+        reply = {'ok': all(result.get('ok') for result in results), 'radios': dict(zip(names, results))}
+        if (command.get('cmd') == 'status'):
+            totals = {key: 0 for key in SUMMED_COUNTERS}
+            for result in results:
+                for key in SUMMED_COUNTERS:
+                    totals[key] += result.get('counters', {}).get(key, 0)
+            totals['radios'] = len(names)
+            totals['running'] = sum(1 for result in results if result.get('ok'))
+            reply['totals'] = totals
+        return reply
+
+
+    async def execute_json(self, text):
+        '''
+        Runs a JSON request, a command object or a list of them run in order
+
+        Returns:
+            reply (str): the JSON result object, or list of result objects
+        '''
+        try:
+            request = json.loads(text)
+        except ValueError as e:
+            return json.dumps({'ok': False, 'error': f'Invalid JSON: {e}'})
+        results = []
+        for command in (request if isinstance(request, list) else [request]):
+            if not isinstance(command, dict):
+                results.append({'ok': False, 'error': 'A command must be a JSON object'})
+                continue
+            result = await self.execute_command(command)
+            if 'id' in command:
+                result['id'] = command['id']
+            results.append(result)
+        return json.dumps(results if isinstance(request, list) else results[0])
+
+
+    async def handle_client(self, reader, writer):
+        '''
+        Answers each JSON request line of one network client with a JSON line
+        '''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write((await self.execute_json(line)).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def read_stdin(self):
+        '''
+        Runs JSON requests typed at the terminal, 'status' for the aggregate status, or 'exit'
+        '''
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            text = line.decode().strip()
+            if (text == 'exit' or text == 'e'):
+                self.stop()
+                return
+            if (text == 'status' or text == 's'):
+                self.print_status(await self.execute_command({'cmd': 'status'}))
+            elif text:
+                print(await self.execute_json(text))
+
+
+    def print_status(self, status):
+        '''
+        Prints one line per radio and the totals
+        '''
+        for name, result in status['radios'].items():
+            if not result.get('ok'):
+                print(f"    {name}: {result.get('error')}")
+                continue
+            counters = result['counters']
+            dests = ', '.join(f'{ip}:{port}' for ip, port in result['destinations'])
+            print(f"    {name}: tuner {result['tuner_freq']} Hz, adc {result['adc_freq']} Hz, {counters['packets']} packets"
+                  f" to {dests}, {counters['overflows']} overflows, {counters['cpu']:.1f} % CPU")
+        totals = status['totals']
+        print(f"    {totals['running']} of {totals['radios']} radios running, {totals['packets']} packets,"
+              f" {totals['overflows']} overflows, {totals['cpu']:.1f} % CPU")
+
+
+    def stop(self):
+        if not self.stopping.done():
+            self.stopping.set_result(None)
+
+
+    async def run(self):
+        '''
+        Serves the control API until 'exit', SIGINT, or SIGTERM, then shuts every radio down, the radios are started
+        with start() beforehand so they are not forked from a running event loop
+        '''
+        loop = asyncio.get_running_loop()
+        self.stopping = loop.create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        tasks = []
+        server = None
+        udp_transport = None
+        if self.control_port is not None:
+            server = await asyncio.start_server(self.handle_client, self.control_addr, self.control_port)
+            udp_transport, _ = await loop.create_datagram_endpoint(lambda: ManagerDatagramProtocol(self),
+                                                                   local_addr=(self.control_addr, self.control_port))
+            tasks.append(asyncio.create_task(server.serve_forever(), name='network'))
+            print(f'Managing {len(self.radios)} radios, listening for JSON commands on {self.control_addr}:{self.control_port} (TCP and UDP)\n')
+        if sys.stdin is not None and not sys.stdin.closed:
+            tasks.append(asyncio.create_task(self.read_stdin(), name='stdin'))
+
+        await self.stopping
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+            udp_transport.close()
+        await asyncio.gather(*(radio.close() for radio in self.radios.values()))
+        print('All radios stopped')
+
+
+def main(configs, control_addr='127.0.0.1', control_port=DEFAULT_MANAGER_PORT, pin_cores=True):
+    manager = RadioManager(configs, control_addr, control_port, pin_cores)
+    print('\n------------------------------------')
+    print('Linux SDR radio manager')
+    print('------------------------------------\n')
+    for config in manager.configs:
+        where = config['remote'] or f"{hex(config['radio_base_addr'])}/{hex(config['fifo_base_addr'])}" + \
+            (f" simulated in {config['sim_path']}" if config['sim_path'] else '')
+        print(f"{config['name']}: {where}, streaming to {config['udp_ip']}:{config['udp_port']}")
+    print("\nEnter a JSON command, 's' or 'status' for the status of every radio, or 'e' or 'exit' to terminate\n")
+    manager.start()
+    asyncio.run(manager.run())
+
+
+if __name__ == '__main__':
+    description = "Radio manager - Runs several radios from one process, each in its own process pinned to a core, with one JSON control and status endpoint"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-c', '--config', help='JSON file listing the radios', default=None)
+    parser.add_argument('-n', '--num_radios', type=int, help='Without --config, run this many radios with consecutive destination ports', default=1)
+    parser.add_argument('-d', '--dest_ip_addr', help='Without --config, the destination IP address of every radio', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, help='Without --config, the destination UDP port of the first radio', default=25344)
+    parser.add_argument('--control_addr', help='Address the JSON command endpoint listens on', default='127.0.0.1')
+    parser.add_argument('--control_port', type=int, help='TCP and UDP port of the JSON command endpoint, 0 to disable it', default=DEFAULT_MANAGER_PORT)
+    parser.add_argument('--no_pin', action='store_true', help='Do not pin each radio process to its own core')
+    parser.add_argument('--sim', nargs='?', const=DEFAULT_SIM_PATH, help='Run every local radio against its own simulated radio, backed by <SIM>_<name>', default=None)
+    parser.add_argument('--sim_source', choices=SIM_SOURCES, help='Simulated sample source: tone, linear DDC model, or bit-accurate DDC model', default='tone')
+    parser.add_argument('--force', action='store_true', help='Rebuild fifo_reader and reload the FPGA images even if they are up to date')
+    args = parser.parse_args()
+
+    if args.config is not None:
+        with open(args.config) as f:
+            configs = json.load(f)
+    else:
+        configs = [{'udp_ip': args.dest_ip_addr, 'udp_port': args.port + i} for i in range(args.num_radios)]
+    if (args.sim is not None):
+        for i, config in enumerate(configs):
+            if config.get('remote') is None:
+                config['sim_path'] = f"{args.sim}_{config.get('name') or f'radio{i}'}"
+                config['sim_source'] = args.sim_source
+    elif any(config.get('remote') is None for config in configs):
+        # Load FPGA images once, every local radio core is in the same bitstream
+        load_bitstreams(force=args.force)
+        if any(config.get('reader') == 'c' for config in configs):
+            build_reader(force=args.force)
+
+    main(configs, args.control_addr, args.control_port or None, not args.no_pin)
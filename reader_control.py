@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+### FIFO reader control
+# Client for the control socket of a running fifo_reader, started as ./fifo_reader -c CONTROL_PATH [ip port ...]
+# Commands change the destinations, the frame format and the spectrum mode, pause or resume streaming, and read the counters without
+# restarting the reader, so the FIFO contents and the packet sequence numbers carry on across changes
+
+import os
+import socket
+import time
+from timestamps import LatencyHistogram
+
+# Define constants
+DEFAULT_CONTROL_PATH = '/tmp/fifo_reader.ctl'
+
+
+class ReaderControl():
+    '''
+    Sends text commands to fifo_reader over its Unix datagram control socket and returns the replies
+    '''
+
+    def __init__(self, path=DEFAULT_CONTROL_PATH, timeout=1.0):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # Bind to an autobound abstract address so the reader can reply
+        self.sock.bind('')
+        self.sock.settimeout(timeout)
+        # Sent with each command and echoed by the reader, replies with an older token answer commands that timed out
+        self.token = 0
+
+
+    def wait_ready(self, timeout=2.0):
+        '''
+        Waits for the reader to create its control socket
+
+        Returns:
+            ready (bool): True if the control socket answered within the timeout
+        '''
+        deadline = time.monotonic() + timeout
+        while (time.monotonic() < deadline):
+            if os.path.exists(self.path):
+                try:
+                    self.command('stats')
+                    return True
+                except OSError:
+                    pass
+            time.sleep(0.01)
+        return False
+
+
+    def command(self, text):
+        '''
+        Sends one command and waits for its reply
+
+        Parameters:
+            text (str): the command, e.g. 'add 192.168.1.10 25344'
+
+        Returns:
+            reply (str): the reply text after 'ok'
+
+        Raises:
+            RuntimeError: if the reader rejected the command
+            socket.timeout: if the reply did not arrive within the timeout
+        '''
+        self.token += 1
+        token = f'#{self.token}'
+        self.sock.sendto(f'{token} {text}'.encode(), self.path)
+        while True:
+            reply_token, _, reply = self.sock.recv(1024).decode().partition(' ')
+            if (reply_token == token):
+                break
+        status, _, rest = reply.partition(' ')
+        if (status != 'ok'):
+            raise RuntimeError(f'fifo_reader rejected {text!r}')
+        return rest
+
+
+    def add_destination(self, udp_ip, udp_port):
+        self.command(f'add {udp_ip} {udp_port}')
+
+
+    def remove_destination(self, udp_ip, udp_port):
+        self.command(f'remove {udp_ip} {udp_port}')
+
+
+    def set_destinations(self, destinations):
+        '''
+        Replaces the reader's destinations with a list of (udp_ip, udp_port)
+        '''
+        self.command(' '.join(['set'] + [f'{udp_ip} {udp_port}' for udp_ip, udp_port in destinations]))
+
+
+    def destinations(self):
+        '''
+        Returns the reader's destinations as a list of (udp_ip, udp_port)
+        '''
+        fields = self.command('list').split()
+        return [(fields[i], int(fields[i + 1])) for i in range(0, len(fields), 2)]
+
+
+    def set_format(self, samples_per_packet, extended_header=False, compression='none'):
+        '''
+        Changes the frame format from the packet after the one being filled, see packet_ring.py
+        '''
+        self.command(f"format {samples_per_packet} {'ext' if extended_header else 'legacy'} {compression}")
+
+
+    def set_spectrum(self, nfft, rate):
+        '''
+        Switches to spectrum mode with nfft-point spectra at about rate frames per second, or back to streaming the
+        samples when nfft is 0, see spectrum_frames.py
+        '''
+        self.command(f'spectrum {nfft} {rate:g}')
+
+
+    def pause(self):
+        self.command('pause')
+
+
+    def resume(self):
+        self.command('resume')
+
+
+    def stats(self):
+        '''
+        Returns the reader's counters as a dict: packets, datagrams, samples, seq, paused, dests, hwm (FIFO high-water
+        mark), overflows (drains that found the FIFO full), wakeups, samples_per_packet, extended (1 for the extended
+        header), sample_bits (16, or 12 or 8 when compressing), latency_p50, latency_p99 and latency_max (drain to send, us), spectrum_nfft (0 when streaming the
+        samples) and spectrum_frames as ints, and cpu (% of one core) as a float
+        '''
+        fields = (field.split('=') for field in self.command('stats').split())
+        return {key: float(val) if '.' in val else int(val) for key, val in fields}
+
+
+    def latency(self, reset=False):
+        '''
+        Returns the reader's drain to send latency histogram as a LatencyHistogram, clearing the reader's if reset
+        '''
+        fields = self.command('latency reset' if reset else 'latency').split()
+        latency = LatencyHistogram()
+        counts = dict(tuple(int(val) for val in field.split(':')) for field in fields[1:])
+        latency.add_bins(counts, float(fields[0].partition('=')[2]))
+        return latency
+
+
+    def close(self):
+        self.sock.close()
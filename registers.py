@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+
+### Radio register backends
+# Register access for the radio peripheral (ADC/tuner phase increments, control, timer) and the radio FIFO (data, count)
+# DevMemRadio maps the real peripherals through /dev/mem on the Zybo
+# SimulatedRadio models the same registers in a memory-mapped file so the software runs on any Linux machine
+
+import os
+import mmap
+import math
+import numbers
+import struct
+import time
+from array import array
+
+# Define memory-mapped peripheral addresses and offsets
+RADIO_PERIPH_BASE_ADDR = 0x43c00000
+ADC_OFFSET = 0x00
+TUNER_OFFSET = 0x04
+CTRL_OFFSET = 0x08
+TIMER_OFFSET = 0x0c
+FIFO_BASE_ADDR = 0x43c10000
+FIFO_DATA_OFFSET = 0x00
+FIFO_COUNT_OFFSET = 0x04
+
+# Define constants
+PAGE_SIZE = 4096
+SAMP_FREQ = 125000000
+PHASE_RESOLUTION_BITS = 27
+DECIMATION = 40 * 64
+FIFO_DEPTH = 512
+DEFAULT_SIM_PATH = '/dev/shm/linux_sdr_sim'
+SIM_SOURCES = ('tone', 'ddc', 'ddc_exact')
+
+
+def freq_to_inc(freq):
+    '''
+    Converts a desired frequency to a DDS phase increment with exact integer arithmetic, floor((freq << 27) / 125 MHz)
+
+    Parameters:
+        freq (int or array of int): the frequency, or frequencies, to convert (Hz)
+
+    Returns:
+        phase_inc (int or array of int): the phase increment, or a NumPy int64 array of them
+    '''
+    if isinstance(freq, numbers.Integral):
+        return (int(freq) << PHASE_RESOLUTION_BITS) // SAMP_FREQ
+    try:
+        import numpy as np
+    except ImportError:
+        return [(int(f) << PHASE_RESOLUTION_BITS) // SAMP_FREQ for f in freq]
+    return (np.asarray(freq, dtype=np.int64) << PHASE_RESOLUTION_BITS) // SAMP_FREQ
+
+
+def inc_to_freq(phase_inc):
+    '''
+    Converts a DDS phase increment back to the frequency it actually produces, phase_inc * 125 MHz / 2^27
+
+    Parameters:
+        phase_inc (int or array of int): the phase increment, or increments
+
+    Returns:
+        freq (float or array of float): the achieved frequency (Hz), or a NumPy float64 array of them
+    '''
+    if isinstance(phase_inc, numbers.Integral):
+        return int(phase_inc) * SAMP_FREQ / (1 << PHASE_RESOLUTION_BITS)
+    try:
+        import numpy as np
+    except ImportError:
+        return [int(inc) * SAMP_FREQ / (1 << PHASE_RESOLUTION_BITS) for inc in phase_inc]
+    return np.asarray(phase_inc, dtype=np.int64) * (SAMP_FREQ / (1 << PHASE_RESOLUTION_BITS))
+
+
+def sweep_table(freqs):
+    '''
+    Precomputes a frequency sweep, so it can be replayed with one register write per step
+
+    Parameters:
+        freqs (list of int): the sweep frequencies (Hz)
+
+    Returns:
+        phase_incs (array): the register values, array('I') in two's complement
+        achieved (list of float): the frequency each step actually produces (Hz)
+    '''
+    incs = [int(inc) for inc in freq_to_inc(list(freqs))]
+    return array('I', (inc & 0xFFFFFFFF for inc in incs)), [inc_to_freq(inc) for inc in incs]
+
+
+class ShadowedRegisters():
+    '''
+    Keeps a shadow copy of the values written to a window of write-only registers, so writes of an unchanged value can
+    be skipped. If something else writes the registers (e.g. another process on the same simulated radio), call
+    invalidate() before relying on the shadow again
+    '''
+
+    def __init__(self):
+        self.shadow = {}
+
+
+    def write_cached(self, offset, val):
+        '''
+        Writes the register unless it already holds val
+
+        Parameters:
+            offset (hex): the register memory offset value
+            val (int): the value to write, negative values are written in two's complement
+
+        Returns:
+            written (bool): False if the write was skipped
+        '''
+        val = int(val) & 0xFFFFFFFF
+        if (self.shadow.get(offset) == val):
+            return False
+        self.write(offset, val)
+        self.shadow[offset] = val
+        return True
+
+
+    def invalidate(self):
+        self.shadow.clear()
+
+
+class MmapRegisters(ShadowedRegisters):
+    '''
+    A window of 32-bit registers in a memory map
+    '''
+
+    def __init__(self, mem):
+        super().__init__()
+        self.mem = mem
+        self.words = memoryview(mem).cast('I')
+
+
+    def read(self, offset):
+        '''
+        Returns the value of the 32-bit register at the given offset
+
+        Parameters:
+            offset (hex): the register memory offset value
+
+        Returns:
+            val (int): the value from the specified register
+        '''
+        return self.words[offset >> 2]
+
+
+    def write(self, offset, val):
+        '''
+        Sets the value of the 32-bit register at the given offset
+
+        Parameters:
+            offset (hex): the register memory offset value
+            val (int): the value to write, negative values are written in two's complement
+
+        Returns:
+            None
+        '''
+        self.words[offset >> 2] = int(val) & 0xFFFFFFFF
+
+
+    def read_repeated(self, offset, buf, num_words):
+        '''
+        Reads the same register num_words times, as needed to drain a FIFO data register
+
+        Parameters:
+            offset (hex): the register memory offset value
+            buf (array): the preallocated array('I') to fill, must hold at least num_words entries
+            num_words (int): the number of reads
+
+        Returns:
+            None
+        '''
+        words = self.words
+        idx = offset >> 2
+        for i in range(num_words):
+            buf[i] = words[idx]
+
+
+    def close(self):
+        self.words.release()
+        self.mem.close()
+
+
+class DevMemRadio():
+    '''
+    The radio peripheral and radio FIFO registers mapped from /dev/mem
+    '''
+
+    def __init__(self, radio_base_addr=RADIO_PERIPH_BASE_ADDR, fifo_base_addr=FIFO_BASE_ADDR):
+        fd = os.open('/dev/mem', os.O_RDWR | os.O_SYNC)
+        try:
+            self.radio = MmapRegisters(mmap.mmap(fd, PAGE_SIZE, offset=radio_base_addr))
+            self.fifo = MmapRegisters(mmap.mmap(fd, PAGE_SIZE, offset=fifo_base_addr))
+        finally:
+            os.close(fd)
+        self.fifo_depth = FIFO_DEPTH
+
+
+    def close(self):
+        self.radio.close()
+        self.fifo.close()
+
+
+class ToneSource():
+    '''
+    Default simulated sample source: the baseband tone the DDC produces for the current ADC and tuner settings
+
+    The tone is a pure function of the sample index, so every process sharing a simulation file sees the same samples
+    '''
+
+    def __init__(self, amplitude=8192):
+        self.amplitude = amplitude
+
+
+    def generate(self, adc_inc, tuner_inc, ctrl, start_index, num_samples):
+        '''
+        Generates packed FIFO words (Q in the upper and I in the lower 16 bits)
+
+        Parameters:
+            adc_inc (int): the ADC DDS phase increment register value
+            tuner_inc (int): the tuner DDS phase increment register value
+            ctrl (int): the control register value, bit 0 holds the DDSs in reset
+            start_index (int): the output sample index of the first generated sample
+            num_samples (int): the number of samples to generate
+
+        Returns:
+            words (array): array('I') of packed samples
+        '''
+        if (ctrl & 1):
+            return array('I', bytes(4 * num_samples))
+        # Mixing cos(adc) with exp(j*tuner) leaves exp(-j*(adc - tuner)) after the lowpass filters
+        mask = (1 << PHASE_RESOLUTION_BITS) - 1
+        step = (-DECIMATION * (adc_inc - tuner_inc)) & mask
+        phase = (step * start_index) & mask
+        scale = 2 * math.pi / (1 << PHASE_RESOLUTION_BITS)
+        amp = self.amplitude
+        words = array('I', bytes(4 * num_samples))
+        for i in range(num_samples):
+            samp_I = round(amp * math.cos(phase * scale)) & 0xFFFF
+            samp_Q = round(amp * math.sin(phase * scale)) & 0xFFFF
+            words[i] = (samp_Q << 16) | samp_I
+            phase = (phase + step) & mask
+        return words
+
+
+class SimulatedRegisters(ShadowedRegisters):
+    '''
+    A window of simulated 32-bit registers, reads of the timer and FIFO registers are computed by the SimulatedRadio
+    '''
+
+    def __init__(self, sim, page):
+        super().__init__()
+        self.sim = sim
+        self.page = page
+        self.words = sim.words
+
+
+    def read(self, offset):
+        return self.sim.read_reg(self.page, offset)
+
+
+    def write(self, offset, val):
+        self.words[(self.page * PAGE_SIZE + offset) >> 2] = int(val) & 0xFFFFFFFF
+
+
+    def read_repeated(self, offset, buf, num_words):
+        if (self.page == SimulatedRadio.FIFO_PAGE and offset == FIFO_DATA_OFFSET):
+            self.sim.pop_fifo(buf, num_words)
+        else:
+            for i in range(num_words):
+                buf[i] = self.read(offset)
+
+
+    def close(self):
+        pass
+
+
+class SimulatedRadio():
+    '''
+    File-backed model of the radio peripheral and radio FIFO
+
+    The file holds the register pages, the simulation state and the FIFO contents, so several processes can open the
+    same simulated radio (e.g. a controller writing frequencies and a reader draining the FIFO), but only one process
+    should drain the FIFO at a time. Time runs from the moment the file is created:
+        timer_offset counts at 125 MHz and wraps at 32 bits
+        the DDC produces one sample every 2560 clocks (48828.125 Hz) into a 512-word FIFO, samples are dropped while it is full
+
+    File layout:
+        page 0: radio registers {adc_offset, tuner_offset, ctrl_offset, timer_offset}
+        page 1: FIFO registers {fifo_data_offset, fifo_count_offset}
+        page 2: state {magic, version, fifo_depth, head, fill, start_ns, produced, dropped}
+        page 3+: FIFO contents
+    '''
+
+    RADIO_PAGE = 0
+    FIFO_PAGE = 1
+    STATE_PAGE = 2
+    DATA_PAGE = 3
+
+    MAGIC = 0x53445253
+    VERSION = 1
+    STATE_FORMAT = '<IIIIIIQQQ'
+    # Indices in the state page of the fields that change after creation, in 32-bit words for head and fill and in
+    # 64-bit words for start_ns, produced and dropped, see put_state()
+    HEAD_WORD = 3
+    FILL_WORD = 4
+    START_NS_QWORD = 3
+    PRODUCED_QWORD = 4
+    DROPPED_QWORD = 5
+    NS_PER_CLOCK = 1e9 / SAMP_FREQ
+    NS_PER_SAMPLE = DECIMATION * 1e9 / SAMP_FREQ
+
+    def __init__(self, path=DEFAULT_SIM_PATH, source=None, fifo_depth=FIFO_DEPTH, reset=False):
+        self.path = path
+        self.source = source if source is not None else ToneSource()
+        size = (self.DATA_PAGE * PAGE_SIZE) + 4 * fifo_depth
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            new_file = reset or os.fstat(fd).st_size != size
+            if new_file:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.mem = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.words = memoryview(self.mem).cast('I')
+        self.qwords = memoryview(self.mem).cast('Q')
+        self.state_offset = self.STATE_PAGE * PAGE_SIZE
+        self.state_idx = self.state_offset >> 2
+        self.state_qidx = self.state_offset >> 3
+        self.data_idx = (self.DATA_PAGE * PAGE_SIZE) >> 2
+        if new_file or self.get_state()[0] != self.MAGIC:
+            struct.pack_into(self.STATE_FORMAT, self.mem, self.state_offset, self.MAGIC, self.VERSION, fifo_depth,
+                             0, 0, 0, time.monotonic_ns(), 0, 0)
+        self.fifo_depth = self.get_state()[2]
+
+        self.radio = SimulatedRegisters(self, self.RADIO_PAGE)
+        self.fifo = SimulatedRegisters(self, self.FIFO_PAGE)
+
+
+    def get_state(self):
+        '''
+        Returns the state tuple (magic, version, fifo_depth, head, fill, reserved, start_ns, produced, dropped)
+        '''
+        return struct.unpack_from(self.STATE_FORMAT, self.mem, self.state_offset)
+
+
+    def put_state(self, head, fill, produced, dropped):
+        '''
+        Stores the FIFO fields of the state one at a time. The page is never packed as a whole after creation, since
+        struct.pack_into() clears its target first and another process could read magic or start_ns as 0
+        '''
+        self.words[self.state_idx + self.HEAD_WORD] = head
+        self.words[self.state_idx + self.FILL_WORD] = fill
+        self.qwords[self.state_qidx + self.PRODUCED_QWORD] = produced
+        self.qwords[self.state_qidx + self.DROPPED_QWORD] = dropped
+
+
+    def advance(self, num_samples):
+        '''
+        Runs the simulated DDC num_samples samples ahead of real time, e.g. so a benchmark can drain a FIFO that is
+        ready without waiting for it. The timer jumps ahead by the same time, so only do this on a simulated radio no
+        other process is streaming from
+        '''
+        self.qwords[self.state_qidx + self.START_NS_QWORD] -= int(num_samples * self.NS_PER_SAMPLE)
+
+
+    def get_timer(self):
+        start_ns = self.qwords[self.state_qidx + self.START_NS_QWORD]
+        return int((time.monotonic_ns() - start_ns) / self.NS_PER_CLOCK) & 0xFFFFFFFF
+
+
+    def update_fifo(self):
+        '''
+        Moves the samples the DDC has produced since the last update into the FIFO
+
+        Returns:
+            state (tuple): the updated state, see get_state()
+        '''
+        state = self.get_state()
+        _, _, depth, head, fill, _, start_ns, produced, dropped = state
+        total = int((time.monotonic_ns() - start_ns) / self.NS_PER_SAMPLE)
+        new = total - produced
+        if (new <= 0):
+            return state
+        accepted = min(new, depth - fill)
+        if (accepted > 0):
+            radio_idx = (self.RADIO_PAGE * PAGE_SIZE) >> 2
+            adc_inc = self.words[radio_idx + (ADC_OFFSET >> 2)]
+            tuner_inc = self.words[radio_idx + (TUNER_OFFSET >> 2)]
+            ctrl = self.words[radio_idx + (CTRL_OFFSET >> 2)]
+            # Samples that arrive while the FIFO is full are never generated
+            samples = memoryview(self.source.generate(adc_inc, tuner_inc, ctrl, total - accepted, accepted))
+            tail = (head + fill) % depth
+            first = min(accepted, depth - tail)
+            self.words[self.data_idx + tail:self.data_idx + tail + first] = samples[:first]
+            self.words[self.data_idx:self.data_idx + accepted - first] = samples[first:]
+            fill += accepted
+        dropped += new - accepted
+        self.put_state(head, fill, total, dropped)
+        return (self.MAGIC, self.VERSION, depth, head, fill, 0, start_ns, total, dropped)
+
+
+    def pop_fifo(self, buf, num_words):
+        '''
+        Reads num_words samples from the FIFO into buf, reads from an empty FIFO return 0 as in hardware
+        '''
+        _, _, depth, head, fill, _, start_ns, produced, dropped = self.update_fifo()
+        popped = min(num_words, fill)
+        first = min(popped, depth - head)
+        view = memoryview(buf)
+        view[:first] = self.words[self.data_idx + head:self.data_idx + head + first]
+        view[first:popped] = self.words[self.data_idx:self.data_idx + popped - first]
+        for i in range(popped, num_words):
+            buf[i] = 0
+        self.put_state((head + popped) % depth, fill - popped, produced, dropped)
+
+
+    def read_reg(self, page, offset):
+        '''
+        Returns the value of a simulated register
+
+        Parameters:
+            page (int): RADIO_PAGE or FIFO_PAGE
+            offset (hex): the register memory offset value
+
+        Returns:
+            val (int): the value from the specified register
+        '''
+        if (page == self.RADIO_PAGE and offset == TIMER_OFFSET):
+            return self.get_timer()
+        if (page == self.FIFO_PAGE):
+            if (offset == FIFO_COUNT_OFFSET):
+                return self.update_fifo()[4]
+            if (offset == FIFO_DATA_OFFSET):
+                buf = array('I', [0])
+                self.pop_fifo(buf, 1)
+                return buf[0]
+        return self.words[(page * PAGE_SIZE + offset) >> 2]
+
+
+    def get_dropped(self):
+        '''
+        Returns the number of samples the simulated DDC has dropped because the FIFO was full
+        '''
+        return self.update_fifo()[8]
+
+
+    def close(self):
+        self.words.release()
+        self.qwords.release()
+        self.mem.close()
+
+
+def make_source(name):
+    '''
+    Creates a simulated sample source
+
+    Parameters:
+        name (str): one of SIM_SOURCES, 'tone' for ToneSource, 'ddc' for the linear response DDC model, 'ddc_exact' for
+                    the bit-accurate DDC model (the DDC models need NumPy)
+
+    Returns:
+        source: an object with the generate() interface of ToneSource
+    '''
+    if (name == 'tone'):
+        return ToneSource()
+    from ddc_model import DDCModel
+    return DDCModel(exact=(name == 'ddc_exact'))
+
+
+def open_radio(sim_path=None, sim_source='tone', **kwargs):
+    '''
+    Opens the radio registers
+
+    Parameters:
+        sim_path (str): if given, the file backing a SimulatedRadio, otherwise the hardware is mapped through /dev/mem
+        sim_source (str): the simulated sample source, see make_source()
+        kwargs: passed on to the backend constructor
+
+    Returns:
+        radio (DevMemRadio or SimulatedRadio): the backend, with .radio and .fifo register windows
+    '''
+    if sim_path:
+        return SimulatedRadio(sim_path, source=make_source(sim_source), **kwargs)
+    return DevMemRadio(**kwargs)
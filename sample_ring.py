@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+### Shared-memory sample ring
+# Hands blocks of FIFO samples from a reader process to a packer/sender in another process, so the FIFO reader never
+# waits on the interpreter lock of the process running the sender and the controller
+#   The blocks live in an anonymous shared memory map inherited across fork(), so handing one over is a write into
+#   the map and a semaphore post, with no pickling or copying through a pipe
+#   'filled' counts the blocks ready for the sender and 'free' the blocks the reader may fill; the reader waits on
+#   'free' when the sender falls behind (back-pressure), which leaves the samples in the FIFO
+#   A header page of 64-bit counters carries the reader's statistics back to the sender's process, followed by one
+#   64-bit stamp per block, which the reader sets to the radio timer at the drain that filled the block
+# One reader and one sender: each side keeps its own block index, and the semaphores order the accesses
+
+import mmap
+from array import array
+
+# Define constants
+PAGE_SIZE = 4096
+COUNTERS = ('blocks', 'hwm', 'overflows', 'wakeups', 'backpressure', 'cpu_ns', 'run_ns')
+
+
+class SampleRing():
+    '''
+    Fixed-size blocks of 32-bit FIFO words in shared memory, passed from one producer process to one consumer process
+    '''
+
+    def __init__(self, context, num_blocks=32, block_words=256):
+        '''
+        Parameters:
+            context (multiprocessing context): the 'fork' context the reader process is started from
+            num_blocks (int): the number of blocks in the ring
+            block_words (int): the number of FIFO words in a block
+        '''
+        self.num_blocks = num_blocks
+        self.block_words = block_words
+        header_bytes = -(-8 * (len(COUNTERS) + num_blocks) // PAGE_SIZE) * PAGE_SIZE
+        self.mem = mmap.mmap(-1, header_bytes + 4 * num_blocks * block_words)
+        view = memoryview(self.mem)
+        self.counter_words = view[:8 * len(COUNTERS)].cast('Q')
+        self.stamps = view[8 * len(COUNTERS):8 * (len(COUNTERS) + num_blocks)].cast('Q')
+        self.blocks = [view[header_bytes + 4 * block_words * i:header_bytes + 4 * block_words * (i + 1)].cast('I')
+                       for i in range(num_blocks)]
+        self.filled = context.Semaphore(0)
+        self.free = context.Semaphore(num_blocks)
+        self.head = 0
+        self.tail = 0
+
+
+    def set_counter(self, name, val):
+        self.counter_words[COUNTERS.index(name)] = int(val)
+
+
+    def counters(self):
+        '''
+        Returns the reader's counters as a dict, see COUNTERS
+        '''
+        return dict(zip(COUNTERS, array('Q', self.counter_words)))
+
+
+    def put(self, timeout=None):
+        '''
+        Returns the next free block for the producer to fill, waiting up to timeout seconds, or None if the ring stays
+        full. Its stamp is stamps[head]
+        '''
+        if not self.free.acquire(timeout=timeout):
+            return None
+        return self.blocks[self.head]
+
+
+    def commit(self):
+        '''
+        Passes the block from put() to the consumer
+        '''
+        self.head = (self.head + 1) % self.num_blocks
+        self.filled.release()
+
+
+    def get(self, timeout=None):
+        '''
+        Returns the oldest filled block, waiting up to timeout seconds (0 to not wait), or None if there is none. Its
+        stamp is stamps[tail]
+        '''
+        if not self.filled.acquire(timeout=timeout):
+            return None
+        return self.blocks[self.tail]
+
+
+    def release(self):
+        '''
+        Returns the block from get() to the producer
+        '''
+        self.tail = (self.tail + 1) % self.num_blocks
+        self.free.release()
+
+
+    def close(self):
+        self.counter_words.release()
+        self.stamps.release()
+        for block in self.blocks:
+            block.release()
+        self.mem.close()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+### Band scanner
+# Finds signals across a span by stepping the tuner, instead of typing tuner changes at the prompt and watching a plot
+#   Each step retunes with LinuxSDR.set_freq_reg(tuner_offset, ...) from a precomputed sweep_table(), then discards
+#   the samples already in the FIFO at the retune and the DDC filters' memory (settle_samples()), so every sample
+#   analyzed was produced entirely at the new frequency
+#   The power spectrum of the step is the average of averages Hann-windowed FFTs. Only its central step Hz are kept,
+#   where the DDC's passband is flat, and steps are spaced by step, about 80 % of the 48.8 kHz output bandwidth, so
+#   the kept parts tile the span
+#   Peaks are local maxima more than threshold dB above the step's noise floor (the median bin) and above min_power,
+#   away from the DC bin, where the DDC's truncation leaves an offset in every step
+# Results go to an OccupancyCache keyed by step frequency, which can be saved to a JSON file and reused by later runs.
+# Steps seen recently and quiet are skipped; a step is scanned again once it is older than max_age, or older than
+# active_age if it had signals. Each entry keeps a running occupancy (the fraction of recent visits with signals), and
+# entries not seen for expire_age are dropped, so after the first survey a rescan only visits stale and active steps
+#
+# The baseband of the DDC is exp(-j(adc - tuner)), so a baseband bin at f is the input frequency tuner - f
+
+import argparse
+import json
+import os
+import time
+from array import array
+import numpy as np
+from registers import open_radio, sweep_table, DEFAULT_SIM_PATH, SIM_SOURCES, SAMP_FREQ, DECIMATION
+from startup import load_bitstreams
+from linux_sdr_python import LinuxSDR
+from iq_tools import SAMPLE_RATE, FULL_SCALE, words_to_complex
+
+# Define constants
+FILTER_1_TAPS = 177
+FILTER_2_TAPS = 724
+FILTER_2_DECIMATION = 64
+SETTLE_MARGIN = 4
+DEFAULT_STEP = 0.8 * SAMPLE_RATE
+MAX_TUNER_FREQ = SAMP_FREQ / 2
+NFFT = 1024
+AVERAGES = 8
+THRESHOLD_DB = 10.0
+MIN_POWER_DB = -100.0
+DC_BINS = 2
+MAX_PEAKS = 8
+MAX_AGE = 60.0
+ACTIVE_AGE = 5.0
+EXPIRE_AGE = 3600.0
+OCCUPANCY_WEIGHT = 0.25
+
+
+def settle_samples(margin=SETTLE_MARGIN):
+    '''
+    Returns the number of output samples that still depend on inputs from before a retune: the length of filter_2 and
+    filter_1 in output samples, plus a margin
+    '''
+    filter_1 = -(-FILTER_1_TAPS // DECIMATION)
+    filter_2 = -(-FILTER_2_TAPS // FILTER_2_DECIMATION)
+    return filter_1 + filter_2 + margin
+
+
+def step_freqs(start, stop, step=DEFAULT_STEP):
+    '''
+    Returns the tuner frequencies (Hz, integers) of the steps covering start to stop, each covering step Hz around it
+    '''
+    count = max(int(np.ceil((stop - start) / step)), 1)
+    return [int(round(start + step * (i + 0.5))) for i in range(count)]
+
+
+class OccupancyCache():
+    '''
+    Scan results by step frequency, with the time each step was last scanned, see the module notes
+
+    Each entry is a dict: time (time.time() of the last scan), floor (noise floor, dBFS per bin), peaks (list of
+    [frequency, dBFS]), active (peaks were found), occupancy (running fraction of visits with peaks), visits
+    '''
+
+    def __init__(self, path=None, max_age=MAX_AGE, active_age=ACTIVE_AGE, expire_age=EXPIRE_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.active_age = active_age
+        self.expire_age = expire_age
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.entries = {int(freq): entry for freq, entry in json.load(f).get('steps', {}).items()}
+
+
+    def due(self, freq, now=None):
+        '''
+        Returns True if the step at freq should be scanned: never scanned, stale, or active and older than active_age
+        '''
+        entry = self.entries.get(freq)
+        if entry is None:
+            return True
+        age = (time.time() if now is None else now) - entry['time']
+        return age >= self.max_age or (entry['active'] and age >= self.active_age)
+
+
+    def update(self, freq, floor, peaks, now=None):
+        '''
+        Records the scan of the step at freq
+        '''
+        entry = self.entries.get(freq, {'occupancy': 0.0, 'visits': 0})
+        active = len(peaks) > 0
+        entry.update({'time': time.time() if now is None else now, 'floor': floor, 'peaks': peaks, 'active': active,
+                      'occupancy': entry['occupancy'] + OCCUPANCY_WEIGHT * (active - entry['occupancy']),
+                      'visits': entry['visits'] + 1})
+        self.entries[freq] = entry
+
+
+    def expire(self, now=None):
+        '''
+        Drops the entries not scanned for expire_age
+
+        Returns:
+            expired (int): the number of entries dropped
+        '''
+        now = time.time() if now is None else now
+        stale = [freq for freq, entry in self.entries.items() if now - entry['time'] >= self.expire_age]
+        for freq in stale:
+            del self.entries[freq]
+        return len(stale)
+
+
+    def peaks(self, start=None, stop=None):
+        '''
+        Returns the cached peaks between start and stop (Hz) as (frequency, dBFS, age in seconds), strongest first
+        '''
+        now = time.time()
+        found = [(freq, power, now - entry['time']) for entry in self.entries.values() for freq, power in entry['peaks']
+                 if (start is None or freq >= start) and (stop is None or freq < stop)]
+        return sorted(found, key=lambda peak: -peak[1])
+
+
+    def save(self):
+        '''
+        Writes the cache to its file, replacing it atomically
+        '''
+        if self.path is None:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'saved': time.time(), 'steps': {str(freq): entry for freq, entry in sorted(self.entries.items())}},
+                      f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Scanner():
+    '''
+    Steps a LinuxSDR's tuner across spans and measures the power spectrum at each step, see the module notes
+
+    The scanner reads the FIFO itself, so the LinuxSDR's streaming thread must not be running
+    '''
+
+    def __init__(self, sdr, cache=None, step=DEFAULT_STEP, nfft=NFFT, averages=AVERAGES, threshold=THRESHOLD_DB,
+                 min_power=MIN_POWER_DB, max_peaks=MAX_PEAKS):
+        '''
+        Parameters:
+            sdr (LinuxSDR): the radio, not streaming
+            cache (OccupancyCache): the results, a new one without a file if not given
+            step (float): the spacing of the steps (Hz), up to the 48.8 kHz output bandwidth
+            nfft (int): the FFT size
+            averages (int): the number of FFTs averaged at each step
+            threshold (float): how far above the noise floor a peak must be (dB)
+            min_power (float): the weakest peak recorded (dBFS)
+            max_peaks (int): the most peaks recorded per step
+        '''
+        if not 0 < step <= SAMPLE_RATE:
+            raise ValueError(f'step must be between 0 and the {SAMPLE_RATE:.1f} Hz output bandwidth')
+        self.sdr = sdr
+        self.cache = cache if cache is not None else OccupancyCache()
+        self.step = step
+        self.nfft = nfft
+        self.averages = averages
+        self.threshold = threshold
+        self.min_power = min_power
+        self.max_peaks = max_peaks
+        self.settle = settle_samples()
+        self.window = np.hanning(nfft).astype(np.float32)
+        self.window_power = float(np.sum(self.window)) ** 2
+        baseband = np.fft.fftshift(np.fft.fftfreq(nfft, 1 / SAMPLE_RATE))
+        # The bins kept from each step, and their offset from the tuner in input frequency
+        self.keep = np.flatnonzero(np.abs(baseband) <= step / 2)
+        self.offsets = -baseband[self.keep]
+        self.peak_bins = np.abs(self.offsets) > DC_BINS * SAMPLE_RATE / nfft
+        self.buf = array('I', bytes(4 * sdr.radio.fifo_depth))
+        self.overflows = 0
+
+
+    def collect(self, num_samples, discard=0):
+        '''
+        Reads num_samples samples from the FIFO after discarding discard samples, sleeping while it fills
+
+        Returns:
+            words (ndarray): uint32 FIFO words
+        '''
+        sdr = self.sdr
+        depth = sdr.radio.fifo_depth
+        words = np.empty(num_samples, dtype=np.uint32)
+        got = -discard
+        while (got < num_samples):
+            count = sdr.get_fifo_reg(sdr.fifo_count_offset)
+            if (count >= depth and got >= 0):
+                self.overflows += 1
+            wanted = num_samples - got
+            if (count < min(wanted, depth // 2)):
+                time.sleep((min(wanted, depth // 2) - count) / SAMPLE_RATE)
+                continue
+            take = min(count, wanted)
+            sdr.read_fifo(self.buf, take)
+            if (got + take > 0):
+                first = max(-got, 0)
+                words[got + first:got + take] = np.frombuffer(self.buf, dtype=np.uint32, count=take)[first:]
+            got += take
+        return words
+
+
+    def measure(self, freq, phase_inc=None):
+        '''
+        Tunes to freq and returns the averaged power spectrum of the kept bins
+
+        Returns:
+            freqs (ndarray): the input frequency of each bin (Hz)
+            power (ndarray): the power in each bin (dBFS)
+        '''
+        sdr = self.sdr
+        sdr.set_freq_reg(sdr.tuner_offset, freq, phase_inc, verbose=False)
+        # Everything in the FIFO now was produced before the retune
+        stale = sdr.get_fifo_reg(sdr.fifo_count_offset)
+        words = self.collect(self.nfft * self.averages, stale + self.settle)
+        segments = words_to_complex(words, 1.0).reshape(self.averages, self.nfft) * self.window
+        spectrum = np.fft.fftshift(np.fft.fft(segments, axis=1), axes=1)
+        power = np.mean(spectrum.real ** 2 + spectrum.imag ** 2, axis=0) / (self.window_power * FULL_SCALE ** 2)
+        return freq + self.offsets, 10 * np.log10(power[self.keep] + 1e-20)
+
+
+    def find_peaks(self, freqs, power):
+        '''
+        Returns the noise floor (dBFS) and the peaks, [frequency, dBFS] of the strongest local maxima more than
+        threshold above the floor and above min_power, outside the DC bins
+        '''
+        floor = float(np.median(power))
+        level = max(floor + self.threshold, self.min_power)
+        local = (power[1:-1] >= power[:-2]) & (power[1:-1] > power[2:]) & (power[1:-1] > level) & self.peak_bins[1:-1]
+        index = np.flatnonzero(local) + 1
+        index = index[np.argsort(-power[index])][:self.max_peaks]
+        return floor, [[round(float(freqs[i]), 1), round(float(power[i]), 1)] for i in index]
+
+
+    def scan(self, start, stop, force=False):
+        '''
+        Scans the steps from start to stop that the cache has due (every step if force), recording the results
+
+        Returns:
+            scanned (int): the number of steps scanned
+            skipped (int): the number of steps skipped as fresh in the cache
+        '''
+        freqs = step_freqs(start, stop, self.step)
+        if not (0 <= min(freqs) and max(freqs) < MAX_TUNER_FREQ):
+            raise ValueError(f'the tuner covers 0 to {MAX_TUNER_FREQ:.0f} Hz')
+        phase_incs, _ = sweep_table(freqs)
+        original = self.sdr.tuner_freq
+        now = time.time()
+        self.cache.expire(now)
+        scanned = 0
+        try:
+            for freq, phase_inc in zip(freqs, phase_incs):
+                if not force and not self.cache.due(freq, now):
+                    continue
+                floor, peaks = self.find_peaks(*self.measure(freq, phase_inc))
+                self.cache.update(freq, floor, peaks)
+                scanned += 1
+        finally:
+            self.sdr.set_freq_reg(self.sdr.tuner_offset, original, verbose=False)
+        self.cache.save()
+        return scanned, len(freqs) - scanned
+
+
+def main(start, stop, step=DEFAULT_STEP, nfft=NFFT, averages=AVERAGES, threshold=THRESHOLD_DB, min_power=MIN_POWER_DB,
+         cache_path=None, max_age=MAX_AGE, active_age=ACTIVE_AGE, passes=1, interval=0.0, force=False, adc_freq=0, sim_path=None,
+         sim_source='tone'):
+    sdr = LinuxSDR(adc_freq=adc_freq, radio=open_radio(sim_path, sim_source))
+    cache = OccupancyCache(cache_path, max_age, active_age)
+    scanner = Scanner(sdr, cache, step, nfft, averages, threshold, min_power)
+    step_time = (nfft * averages + scanner.settle) / SAMPLE_RATE
+    print(f'Scanning {start:.0f} to {stop:.0f} Hz in {step:.0f} Hz steps, {nfft}-point FFT averaged {averages} times '
+          f'({step_time * 1e3:.0f} ms a step)' + (f', cache {cache_path}' if cache_path else ''))
+    try:
+        for scan_pass in range(passes):
+            if (scan_pass > 0):
+                time.sleep(interval)
+            begin = time.monotonic()
+            scanned, skipped = scanner.scan(start, stop, force)
+            print(f'Pass {scan_pass + 1}: scanned {scanned} steps, skipped {skipped} fresh ones, '
+                  f'in {time.monotonic() - begin:.1f} s')
+            for freq, power, age in cache.peaks(start, stop):
+                print(f'    {freq:12.1f} Hz  {power:6.1f} dBFS  (seen {age:.0f} s ago)')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sdr.tx.close()
+        sdr.radio.close()
+    if scanner.overflows:
+        print(f'The FIFO overflowed {scanner.overflows} times, samples were dropped within steps')
+    return cache
+
+
+if __name__ == '__main__':
+    description = "Band scanner - Steps the tuner across a span, finds the signals in each step, and caches the results"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('start', type=float, help='Start of the span (Hz)')
+    parser.add_argument('stop', type=float, help='End of the span (Hz)')
+    parser.add_argument('-s', '--step', type=float, help='Tuner step (Hz), at most the output bandwidth', default=DEFAULT_STEP)
+    parser.add_argument('-n', '--nfft', type=int, help='FFT size', default=NFFT)
+    parser.add_argument('-a', '--averages', type=int, help='FFTs averaged at each step', default=AVERAGES)
+    parser.add_argument('-t', '--threshold', type=float, help='Peak threshold above the noise floor (dB)', default=THRESHOLD_DB)
+    parser.add_argument('-m', '--min_power', type=float, help='Weakest peak recorded (dBFS)', default=MIN_POWER_DB)
+    parser.add_argument('-c', '--cache', help='JSON file keeping the results between runs', default=None)
+    parser.add_argument('--max_age', type=float, help='Seconds before a quiet step is scanned again', default=MAX_AGE)
+    parser.add_argument('--active_age', type=float, help='Seconds before a step with signals is scanned again', default=ACTIVE_AGE)
+    parser.add_argument('-p', '--passes', type=int, help='Number of passes over the span', default=1)
+    parser.add_argument('-i', '--interval', type=float, help='Seconds between passes', default=0.0)
+    parser.add_argument('--full', action='store_true', help='Scan every step, even fresh ones in the cache')
+    parser.add_argument('-f', '--freq', type=float, help='Simulated ADC frequency (Hz)', default=0)
+    parser.add_argument('--sim', nargs='?', const=DEFAULT_SIM_PATH, help='Run against a simulated radio backed by the given file instead of /dev/mem', default=None)
+    parser.add_argument('--sim_source', choices=SIM_SOURCES, help='Simulated sample source: tone, linear DDC model, or bit-accurate DDC model', default='tone')
+    parser.add_argument('--force', action='store_true', help='Reload the FPGA images even if they are already loaded')
+    args = parser.parse_args()
+
+    if (args.sim is None):
+        load_bitstreams(force=args.force)
+
+    main(args.start, args.stop, args.step, args.nfft, args.averages, args.threshold, args.min_power, args.cache, args.max_age,
+         args.active_age, args.passes, args.interval, args.full, int(args.freq), args.sim, args.sim_source)
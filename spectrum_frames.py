@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+### On-device spectrum frames
+# Spectrum mode of the readers: instead of streaming the samples, the board computes averaged power spectra of them and
+# sends one compact frame (see packet_ring.py) at a configurable rate, a few kB/s instead of 195 kB/s per radio
+#   SpectrumFramer     the board side, fed the FIFO words as they are drained. Every nfft samples are Hann-windowed
+#                      (as they are copied in, so there is no separate pass) and transformed, and the power of
+#                      averages consecutive segments is summed, then scaled to dB/Hz as udp_receiver.SpectrumAnalyzer
+#                      does and quantized to one byte per bin in SPEC_DB_STEP steps below the frame's peak
+#   SpectrumAssembler  the receiver side, puts each frame back together from its datagrams and decodes it to dB/Hz
+# All the framer's buffers are allocated once for its FFT size, and NumPy keeps the FFT plan of the size it last used,
+# so a frame costs no allocation; with NumPy 2 the FFT also writes into its preallocated output. The segments do not
+# overlap, which keeps the CPU use on the board at one FFT per nfft samples
+# fifo_reader.c implements the same framer in C (-s NFFT -r RATE), with its own precomputed radix-2 FFT plan
+#
+# python3 spectrum_frames.py times the framer on a tone at several FFT sizes, e.g. on the board
+
+import argparse
+import time
+import numpy as np
+from packet_ring import SPEC_DB_STEP, SPECTRUM_RATE, spectrum_geometry, spectrum_averages
+from registers import SAMP_FREQ, DECIMATION
+
+# Define constants
+SAMPLE_RATE = SAMP_FREQ / DECIMATION
+DEFAULT_NFFT = 4096
+FULL_SCALE = 32768.0
+CODES = 255
+FFT_OUT = int(np.__version__.split('.')[0]) >= 2
+
+
+def decode_spectrum(codes, ref_db, db_step=SPEC_DB_STEP):
+    '''
+    Returns the dB/Hz values of the one-byte bins of a spectrum frame
+
+    Parameters:
+        codes (array): uint8 bins
+        ref_db (float): the dB/Hz of code 0
+        db_step (float): the dB per code step
+
+    Returns:
+        psd (array): float32 dB/Hz, in the order of the codes
+    '''
+    return (ref_db + db_step * codes.astype(np.float32)).astype(np.float32)
+
+
+class SpectrumFramer():
+    '''
+    Averaged, quantized power spectra of the radio's I/Q stream, computed in preallocated buffers
+
+    add() takes FIFO words in any amount; each completed frame goes to sink(codes, ref_db, timer), where codes are the
+    nfft uint8 bins from -fs/2 to fs/2 (valid until the next frame) and timer the radio timer passed with the words
+    that completed it. frames counts the frames completed
+    '''
+
+    def __init__(self, nfft=DEFAULT_NFFT, rate=SPECTRUM_RATE, fs=SAMPLE_RATE, db_step=SPEC_DB_STEP, sink=None):
+        '''
+        Parameters:
+            nfft (int): the FFT size, a power of 2, see packet_ring.spectrum_geometry()
+            rate (float): the frames per second wanted, which sets the segments averaged into each
+            fs (float): the sample rate (Hz)
+            db_step (float): the dB per code step
+            sink (callable): called with each completed frame
+
+        Raises:
+            ValueError: if nfft or rate is out of range
+        '''
+        spectrum_geometry(nfft)
+        self.nfft = nfft
+        self.rate = rate
+        self.fs = fs
+        self.db_step = db_step
+        self.averages = spectrum_averages(nfft, rate, fs)
+        self.sink = sink
+        window = np.hanning(nfft)
+        # PSD scaling of the averaged periodogram, per Hz with int16 full scale = 1.0
+        self.scale = 1.0 / (fs * float(np.sum(window ** 2)) * self.averages * FULL_SCALE ** 2)
+        # The window for each I/Q pair, so windowing is part of the copy of the samples into the segment
+        self.window = np.repeat(window.astype(np.float32), 2).reshape(nfft, 2)
+        self.segment = np.zeros(nfft, dtype=np.complex64)
+        self.segment_pairs = self.segment.view(np.float32).reshape(nfft, 2)
+        self.spectrum = np.zeros(nfft, dtype=np.complex64)
+        self.spectrum_pairs = self.spectrum.view(np.float32).reshape(nfft, 2)
+        self.squares = np.zeros((nfft, 2), dtype=np.float32)
+        self.power = np.zeros(nfft, dtype=np.float32)
+        self.accum = np.zeros(nfft, dtype=np.float32)
+        self.db = np.zeros(nfft, dtype=np.float32)
+        self.codes = np.zeros(nfft, dtype=np.uint8)
+        # fftshift as a gather, from -fs/2 to fs/2
+        self.order = np.fft.fftshift(np.arange(nfft))
+        self.fill = 0
+        self.segments = 0
+        self.frames = 0
+        self.ref_db = 0.0
+
+
+    def reset(self):
+        '''
+        Drops the partly filled segment and frame
+        '''
+        self.fill = 0
+        self.segments = 0
+        self.accum.fill(0)
+
+
+    def add(self, words, timer=0):
+        '''
+        Adds FIFO words (Q in the upper and I in the lower 16 bits, little endian), completing a frame every averages
+        segments
+
+        Parameters:
+            words (buffer): the FIFO words, e.g. an array('I') or a memoryview of one
+            timer (int): the 64-bit radio timer at the drain the words come from
+
+        Returns:
+            frames (int): the number of frames completed
+        '''
+        iq = np.frombuffer(words, dtype='<i2').reshape(-1, 2)
+        frames = 0
+        pos = 0
+        while (pos < len(iq)):
+            take = min(self.nfft - self.fill, len(iq) - pos)
+            np.multiply(iq[pos:pos + take], self.window[self.fill:self.fill + take],
+                        out=self.segment_pairs[self.fill:self.fill + take])
+            self.fill += take
+            pos += take
+            if (self.fill == self.nfft):
+                self.fill = 0
+                self.add_segment()
+                if (self.segments == self.averages):
+                    self.finish_frame(timer)
+                    frames += 1
+        return frames
+
+
+    def add_segment(self):
+        '''
+        Transforms the full (windowed) segment and adds its power spectrum to the frame
+        '''
+        if FFT_OUT:
+            np.fft.fft(self.segment, out=self.spectrum)
+        else:
+            self.spectrum[:] = np.fft.fft(self.segment)
+        np.square(self.spectrum_pairs, out=self.squares)
+        np.add(self.squares[:, 0], self.squares[:, 1], out=self.power)
+        self.accum += self.power
+        self.segments += 1
+
+
+    def finish_frame(self, timer):
+        '''
+        Quantizes the summed power spectra into codes, the top code at the peak rounded up to a whole step, and hands
+        the frame to the sink
+        '''
+        db = self.db
+        np.take(self.accum, self.order, out=db)
+        db *= self.scale
+        db += 1e-30
+        np.log10(db, out=db)
+        db *= 10
+        step = self.db_step
+        self.ref_db = float(np.ceil(db.max() / step) * step - CODES * step)
+        db -= self.ref_db
+        db *= 1 / step
+        np.rint(db, out=db)
+        np.clip(db, 0, CODES, out=db)
+        self.codes[:] = db
+        if self.sink is not None:
+            self.sink(self.codes, self.ref_db, timer)
+        self.frames += 1
+        self.segments = 0
+        self.accum.fill(0)
+
+
+    def freqs(self):
+        '''
+        Returns the bin frequencies (Hz) relative to the tuner, from -fs/2 to fs/2
+        '''
+        return np.fft.fftshift(np.fft.fftfreq(self.nfft, 1 / self.fs))
+
+
+class SpectrumAssembler():
+    '''
+    Puts spectrum frames back together from their datagrams
+
+    psd is the latest complete frame in dB/Hz from -fs/2 to fs/2 and header that frame's SPEC_HEADER fields (see
+    packet_ring.parse_spectrum()). frames counts the complete frames, and incomplete the frames dropped for a missing
+    datagram
+    '''
+
+    def __init__(self):
+        self.codes = None
+        self.frame = None
+        self.filled = 0
+        self.frames = 0
+        self.incomplete = 0
+        self.psd = None
+        self.header = None
+
+
+    def add(self, payload, header):
+        '''
+        Adds one spectrum datagram
+
+        Parameters:
+            payload (bytes-like): the datagram
+            header (tuple): its header, from packet_ring.parse_spectrum()
+
+        Returns:
+            complete (bool): True if the datagram completed a frame
+        '''
+        header_bytes, bins, frame, nfft, first_bin, db_step, ref_db = (header[3], header[4], header[8], header[9],
+                                                                       header[10], header[12], header[13])
+        if (frame != self.frame or self.codes is None or len(self.codes) != nfft):
+            if self.filled:
+                self.incomplete += 1
+            if self.codes is None or len(self.codes) != nfft:
+                self.codes = np.zeros(nfft, dtype=np.uint8)
+            self.frame = frame
+            self.filled = 0
+        self.codes[first_bin:first_bin + bins] = np.frombuffer(payload, dtype=np.uint8, count=bins, offset=header_bytes)
+        self.filled += bins
+        if (self.filled < nfft):
+            return False
+        self.psd = decode_spectrum(self.codes, ref_db, db_step / 100)
+        self.header = header
+        self.frames += 1
+        self.frame = None
+        self.filled = 0
+        return True
+
+
+def benchmark(nfft=DEFAULT_NFFT, rate=SPECTRUM_RATE, block=256, seconds=2.0):
+    '''
+    Times the framer on a tone, fed block FIFO words at a time as the FIFO is drained
+
+    Returns:
+        realtime (float): the stream seconds processed per second of one core's time
+    '''
+    framer = SpectrumFramer(nfft, rate)
+    phase = 2 * np.pi * 1000 / SAMPLE_RATE * np.arange(block * 256)
+    iq = np.stack([np.cos(phase), np.sin(phase)], axis=1) * 8000
+    words = iq.astype('<i2').view(np.uint32).reshape(-1, block)
+    processed = 0
+    start = time.process_time()
+    while (time.process_time() - start < seconds):
+        for row in words:
+            framer.add(row)
+        processed += words.size
+    elapsed = time.process_time() - start
+    return processed / SAMPLE_RATE / elapsed
+
+
+if __name__ == '__main__':
+    description = "On-device spectrum frames - Times the spectrum framer the readers run in spectrum mode"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-n', '--nfft', nargs='+', type=int, help='FFT sizes to time', default=[1024, 4096, 16384])
+    parser.add_argument('-r', '--rate', type=float, help='Spectrum frames per second', default=SPECTRUM_RATE)
+    parser.add_argument('-b', '--block', type=int, help='FIFO words per call, as drained', default=256)
+    args = parser.parse_args()
+
+    for nfft in args.nfft:
+        realtime = benchmark(nfft, args.rate, args.block)
+        print(f'{nfft}-point spectrum, {spectrum_averages(nfft, args.rate, SAMPLE_RATE)} averages: '
+              f'{realtime:.1f}x real time, {100 / realtime:.2f} % of one core per radio')
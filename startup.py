@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+### Startup fast path
+# Skips the slow startup steps when their results are already in place:
+#   build_reader()      rebuilds fifo_reader only when the content hash of fifo_reader.c and the build command differ
+#                       from the ones recorded next to the binary
+#   load_bitstreams()   loads the FPGA images through fpgautil only when the images (by content hash) differ from the
+#                       ones recorded as loaded, or the radio peripheral does not answer. The record lives in /tmp,
+#                       which is cleared at power-up along with the FPGA configuration
+# The radio peripheral has no ID register, so a recorded load is checked by the radio's 125 MHz timer register counting
+# Both take force=True (--force in the scripts) to redo the work regardless
+
+import hashlib
+import json
+import os
+import subprocess
+import time
+
+# Define constants
+READER_SOURCE = 'fifo_reader.c'
+READER_BINARY = 'fifo_reader'
+CODEC_BITSTREAM = 'config_codec.bit.bin'
+RADIO_BITSTREAM = 'design_1_wrapper.bit.bin'
+FPGA_STATE_PATH = '/tmp/linux_sdr_fpga.json'
+FPGA_MANAGER_STATE = '/sys/class/fpga_manager/fpga0/state'
+
+
+def file_hash(path):
+    '''
+    Returns the SHA-256 hex digest of a file's contents
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_reader(source=READER_SOURCE, output=READER_BINARY, force=False):
+    '''
+    Builds the C FIFO reader with gcc, unless the binary was already built from the same source and command
+
+    Parameters:
+        source (str): the C source file
+        output (str): the executable to build
+        force (bool): build even if the binary is up to date
+
+    Returns:
+        built (bool): True if gcc was run
+    '''
+    build_cmd = ['gcc', '-O2', source, '-o', output, '-lm']
+    key = file_hash(source) + ' ' + ' '.join(build_cmd)
+    stamp = output + '.build'
+    if not force and os.path.exists(output) and os.path.exists(stamp):
+        with open(stamp) as f:
+            if (f.read() == key):
+                print(f'{output} is up to date, skipping the build')
+                return False
+    print('')
+    print(f'Building {source} ...')
+    result = subprocess.run(build_cmd)
+    if (result.returncode == 0):
+        with open(stamp, 'w') as f:
+            f.write(key)
+    elif os.path.exists(stamp):
+        os.remove(stamp)
+    return True
+
+
+def radio_responding():
+    '''
+    Returns True if the radio peripheral is configured, judged by its 125 MHz timer register counting
+    '''
+    if os.path.exists(FPGA_MANAGER_STATE):
+        with open(FPGA_MANAGER_STATE) as f:
+            if (f.read().strip() != 'operating'):
+                return False
+    from registers import open_radio, TIMER_OFFSET
+    radio = open_radio()
+    try:
+        first = radio.radio.read(TIMER_OFFSET)
+        time.sleep(0.001)
+        return radio.radio.read(TIMER_OFFSET) != first
+    finally:
+        radio.close()
+
+
+def load_bitstreams(bitstreams=(CODEC_BITSTREAM, RADIO_BITSTREAM), force=False, state_path=FPGA_STATE_PATH):
+    '''
+    Loads the FPGA images in order through fpgautil, unless the same images are recorded as loaded and the radio
+    responds
+
+    Parameters:
+        bitstreams (tuple): the images to load, in order
+        force (bool): load even if the images are recorded as loaded
+        state_path (str): the record of the loaded images
+
+    Returns:
+        loaded (bool): True if fpgautil was run
+    '''
+    hashes = [[path, file_hash(path)] for path in bitstreams]
+    if not force and os.path.exists(state_path):
+        with open(state_path) as f:
+            try:
+                recorded = json.load(f).get('bitstreams')
+            except ValueError:
+                recorded = None
+        if (recorded == hashes and radio_responding()):
+            print(f"{', '.join(bitstreams)} already loaded, skipping")
+            return False
+    # Clear the record first, so an interrupted load is never taken for a complete one
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    for path in bitstreams:
+        print('')
+        print(f'Loading {path} ...')
+        print('')
+        if (subprocess.run(['fpgautil', '-b', path]).returncode != 0):
+            return True
+    with open(state_path, 'w') as f:
+        json.dump({'bitstreams': hashes, 'loaded_at': time.strftime('%Y-%m-%dT%H:%M:%S')}, f)
+    return True
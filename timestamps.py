@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+### Packet timestamps and pipeline latency
+# The radio's 125 MHz timer register is 32 bits and wraps every 34 seconds. TimerUnwrapper extends it to 64 bits:
+#   the first reading is placed in the 2^32-tick period nearest CLOCK_MONOTONIC counted in timer ticks, so every reader
+#   on a board (the Python readers, fifo_reader, the controller) arrives at the same 64-bit values without sharing any
+#   state; after that each wrap is counted, which only needs a reading at least once per period
+# Readers stamp each packet's extended header with the 64-bit timer when its first sample was drained from the FIFO,
+# and with the ticks from that drain until the packet was handed to the socket (see packet_ring.py)
+# LatencyHistogram counts latencies in quarter-octave bins of microseconds, the same bins fifo_reader.c uses:
+#   drain -> send   measured by the readers, as each packet is sent
+#   drain -> receive, send -> receive
+#                   measured by udp_receiver.py, which relates the board's timer to its own clock through the "timer"
+#                   command of the board's JSON control API (sync_timer())
+
+import json
+import socket
+import time
+from registers import SAMP_FREQ
+
+# Define constants
+TIMER_HZ = SAMP_FREQ
+TIMER_PERIOD = 1 << 32
+LATENCY_BINS = 104
+
+
+def extend_timer(raw, monotonic_ns=None):
+    '''
+    Extends a single 32-bit timer reading to 64 bits, placing it in the period nearest the monotonic clock
+
+    Parameters:
+        raw (int): the timer register value
+        monotonic_ns (int): time.monotonic_ns() at the reading, read now if not given
+
+    Returns:
+        timer (int): the 64-bit timer value
+    '''
+    if monotonic_ns is None:
+        monotonic_ns = time.monotonic_ns()
+    mono_ticks = monotonic_ns * TIMER_HZ // 1000000000
+    return max((mono_ticks - raw + TIMER_PERIOD // 2) // TIMER_PERIOD, 0) * TIMER_PERIOD + raw
+
+
+class TimerUnwrapper():
+    '''
+    Extends successive 32-bit timer readings to 64 bits, see extend_timer() for the first one
+    '''
+
+    def __init__(self):
+        self.high = None
+        self.last = 0
+
+
+    def extend(self, raw):
+        '''
+        Returns the 64-bit value of a timer reading, readings must be in time order and at most 34 s apart
+        '''
+        if self.high is None:
+            self.high = extend_timer(raw) - raw
+        elif (raw < self.last):
+            self.high += TIMER_PERIOD
+        self.last = raw
+        return self.high + raw
+
+
+    def follow(self, value):
+        '''
+        Continues from a 64-bit value extended elsewhere, e.g. by another process reading the same timer, so later
+        readings here extend consistently with it
+        '''
+        self.high = value - (value & 0xFFFFFFFF)
+        self.last = value & 0xFFFFFFFF
+
+
+def latency_bin(us):
+    '''
+    Returns the histogram bin of a latency: bins 0-3 are 0-3 us, then each octave of microseconds is split into 4 bins
+    '''
+    us = int(us)
+    if (us < 4):
+        return max(us, 0)
+    msb = us.bit_length() - 1
+    return min(4 * (msb - 1) + ((us >> (msb - 2)) & 3), LATENCY_BINS - 1)
+
+
+def bin_edge(bin):
+    '''
+    Returns the lowest latency (us) in a histogram bin
+    '''
+    if (bin < 4):
+        return bin
+    return (4 + bin % 4) << (bin // 4 - 1)
+
+
+class LatencyHistogram():
+    '''
+    Counts of latencies in microseconds, in the bins of latency_bin(), with the exact count, sum and maximum
+    '''
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.counts = [0] * LATENCY_BINS
+        self.count = 0
+        self.total_us = 0.0
+        self.max_us = 0.0
+
+
+    def add(self, us):
+        self.counts[latency_bin(us)] += 1
+        self.count += 1
+        self.total_us += us
+        self.max_us = max(self.max_us, us)
+
+
+    def add_array(self, us):
+        '''
+        Adds an array of latencies at once
+
+        Parameters:
+            us (ndarray): latencies in microseconds
+        '''
+        import numpy as np
+        us = np.maximum(np.floor(np.asarray(us, dtype=np.float64)), 0)
+        if not len(us):
+            return
+        mantissa, exponent = np.frexp(us)
+        octave = 4 * (exponent.astype(np.int64) - 2) + (mantissa * 8).astype(np.int64) - 4
+        bins = np.clip(np.where(us < 4, us.astype(np.int64), octave), 0, LATENCY_BINS - 1)
+        for bin, count in zip(*np.unique(bins, return_counts=True)):
+            self.counts[int(bin)] += int(count)
+        self.count += len(us)
+        self.total_us += float(us.sum())
+        self.max_us = max(self.max_us, float(us.max()))
+
+
+    def add_bins(self, counts, max_us=0.0):
+        '''
+        Adds counts already binned, e.g. fifo_reader's histogram
+
+        Parameters:
+            counts (dict): bin to count
+            max_us (float): the largest latency counted
+        '''
+        for bin, count in counts.items():
+            self.counts[bin] += count
+            self.count += count
+            self.total_us += count * (bin_edge(bin) + bin_edge(bin + 1)) / 2
+        self.max_us = max(self.max_us, max_us)
+
+
+    def percentile(self, q):
+        '''
+        Returns the upper edge of the bin holding the q-th percentile (0-100), in microseconds, or 0 with no counts
+        '''
+        if not self.count:
+            return 0
+        needed = q / 100 * self.count
+        seen = 0
+        for bin, count in enumerate(self.counts):
+            seen += count
+            if (count and seen >= needed):
+                return min(bin_edge(bin + 1), self.max_us)
+        return self.max_us
+
+
+    def summary(self):
+        '''
+        Returns the count, mean, median, 99th percentile and maximum (us) as a dict
+        '''
+        return {'count': self.count, 'mean_us': self.total_us / self.count if self.count else 0.0,
+                'p50_us': self.percentile(50), 'p99_us': self.percentile(99), 'max_us': self.max_us}
+
+
+    def bins(self):
+        '''
+        Returns the non-empty bins as a dict of the bin's lowest latency (us) to its count
+        '''
+        return {bin_edge(bin): count for bin, count in enumerate(self.counts) if count}
+
+
+def sync_timer(addr, probes=5, timeout=0.2):
+    '''
+    Relates a board's 64-bit timer to this host's monotonic clock with the "timer" command of the board's JSON control
+    API over UDP, keeping the probe with the shortest round trip
+
+    Parameters:
+        addr (tuple): the (ip, port) of the board's control endpoint
+        probes (int): the number of requests
+        timeout (float): seconds to wait for each reply
+
+    Returns:
+        offset (float): seconds to add to timer / TIMER_HZ for this host's time.monotonic(), or None if no reply came
+        rtt (float): the round trip of the probe used, the offset is good to half of it
+    '''
+    best = (None, None)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        for probe in range(probes):
+            sent = time.monotonic()
+            sock.sendto(json.dumps({'cmd': 'timer', 'id': probe}).encode(), addr)
+            try:
+                reply = json.loads(sock.recv(4096))
+            except (socket.timeout, ValueError):
+                continue
+            received = time.monotonic()
+            if not reply.get('ok') or reply.get('id') != probe or 'timer64' not in reply:
+                continue
+            rtt = received - sent
+            if best[1] is None or rtt < best[1]:
+                best = ((sent + received) / 2 - reply['timer64'] / TIMER_HZ, rtt)
+    finally:
+        sock.close()
+    return best
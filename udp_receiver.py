@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+
+### UDP stream receiver and analyzer
+# Headless replacement for collect_data_complex.m: receives the radio packet streams, tracks lost and out-of-order
+# packets and the bursts of loss, and computes the averaged power spectral density of each stream
+#   Datagrams are received in batches with recvmmsg() straight into the rows of a NumPy ring, each row long enough for
+#   a jumbo frame, and each run of datagrams of one frame format is decoded with a single view of the rows
+#   The PSD is Welch's method: Hann-windowed FFT segments with overlap, averaged over the most recent segments
+#   The latest spectrum of each stream can be published in shared memory for dashboards, see SharedSpectrum
+#   Extended-header packets carry their drain time on the board's timer, and the ticks until they were sent; with the
+#   board's timer related to this host's clock (--sync, see timestamps.py) the drain to receive and send to receive
+#   latencies of every packet are counted
+# One process serves any number of streams (one UDP port each) from a single selector loop
+
+### UDP Frame format
+# Bytes 0-1: 16-bit unsigned counter, increments by one in each transmitted UDP frame
+# Bytes 2-1025: 512 Interleaved 16-bit signed IQ, little endian, 48 kHz sample rate
+# Other samples per frame and the extended header (see packet_ring.py) are recognized from each datagram's length, and
+# compressed samples (see iq_compression.py) from the extended header's flags
+# Spectrum datagrams, from a board in spectrum mode (see spectrum_frames.py), are put back together into the board's
+# spectra, which are reported and published in shared memory in place of the PSD computed here
+
+import argparse
+import ctypes
+import errno
+import selectors
+import socket
+import struct
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from packet_ring import iovec, mmsghdr, load_recvmmsg, SEQ_MODULUS, MAX_DATAGRAM_BYTES, EXT_HEADER_BYTES, \
+    EXT_TIMER_OFFSET, EXT_SEND_DELAY_OFFSET, SPEC_HEADER_BYTES, SPEC_VERSION, COMPRESSIONS, EXT_FLAGS_FORMAT_SHIFT, \
+    EXT_FLAGS_EXPONENT_MASK, parse_geometry, parse_spectrum
+from spectrum_frames import SpectrumAssembler
+from iq_compression import decode_frames
+from iq_tools import to_complex
+from timestamps import LatencyHistogram, sync_timer, TIMER_HZ
+
+# Define constants
+SAMP_FREQ = 125000000 / 2560
+REORDER_WINDOW = 1024
+
+
+class SequenceTracker():
+    '''
+    Counts received, lost, duplicate, and out-of-order packets from their sequence numbers, and the bursts of loss
+
+    A forward jump of more than one counts the skipped packets as lost, as one burst; a packet from up to
+    reorder_window behind the newest one is out of order, and is taken back off the lost count since it did arrive.
+    A packet further behind means the sender restarted its count, so tracking resynchronizes on it
+    '''
+
+    def __init__(self, modulus=SEQ_MODULUS, reorder_window=REORDER_WINDOW):
+        self.modulus = modulus
+        self.reorder_window = reorder_window
+        self.last = None
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.resyncs = 0
+        # Bursts are the gaps as first seen, before any late packets fill them
+        self.bursts = 0
+        self.burst_lost = 0
+        self.max_burst = 0
+        self.interval_start = (0, 0, 0, 0)
+        self.interval_max_burst = 0
+
+
+    def add_bursts(self, lengths):
+        '''
+        Records gaps of lengths lost packets each
+        '''
+        if (len(lengths) == 0):
+            return
+        longest = int(lengths.max()) if isinstance(lengths, np.ndarray) else max(lengths)
+        self.bursts += len(lengths)
+        self.burst_lost += int(sum(lengths))
+        self.lost += int(sum(lengths))
+        self.max_burst = max(self.max_burst, longest)
+        self.interval_max_burst = max(self.interval_max_burst, longest)
+
+
+    def update(self, seqs):
+        '''
+        Tracks a batch of sequence numbers, in arrival order
+
+        Parameters:
+            seqs (array): the sequence numbers (uint16)
+
+        Returns:
+            None
+        '''
+        if (len(seqs) == 0):
+            return
+        self.received += len(seqs)
+        seqs = seqs.astype(np.int64)
+        if self.last is None:
+            self.last = int(seqs[0]) - 1
+        steps = np.diff(seqs, prepend=self.last) % self.modulus
+        if ((steps >= 1) & (steps < self.modulus // 2)).all():
+            # Fast path, the batch moves the stream forward, so every step over one is a gap
+            gaps = steps[steps > 1] - 1
+            self.add_bursts(gaps)
+            self.last = int(seqs[-1])
+            return
+        for seq in seqs.tolist():
+            step = (seq - self.last) % self.modulus
+            if (step == 0):
+                self.duplicates += 1
+            elif (step < self.modulus // 2):
+                if (step > 1):
+                    self.add_bursts([step - 1])
+                self.last = seq
+            elif (self.modulus - step <= self.reorder_window):
+                self.reordered += 1
+                self.lost = max(self.lost - 1, 0)
+            else:
+                self.resyncs += 1
+                self.last = seq
+
+
+    def loss_rate(self):
+        '''
+        Returns the fraction of packets lost since the start
+        '''
+        expected = self.received + self.lost
+        return self.lost / expected if expected else 0.0
+
+
+    def interval(self):
+        '''
+        Returns the counts since the previous call, for real-time reporting
+
+        Returns:
+            counts (dict): received, lost, loss_rate (fraction), bursts, and mean_burst and max_burst (packets)
+        '''
+        received = self.received - self.interval_start[0]
+        lost = max(self.lost - self.interval_start[1], 0)
+        bursts = self.bursts - self.interval_start[2]
+        burst_lost = self.burst_lost - self.interval_start[3]
+        counts = {
+            'received': received,
+            'lost': lost,
+            'loss_rate': lost / (received + lost) if received + lost else 0.0,
+            'bursts': bursts,
+            'mean_burst': burst_lost / bursts if bursts else 0.0,
+            'max_burst': self.interval_max_burst,
+        }
+        self.interval_start = (self.received, self.lost, self.bursts, self.burst_lost)
+        self.interval_max_burst = 0
+        return counts
+
+
+class SpectrumAnalyzer():
+    '''
+    Welch power spectral density of a complex sample stream: Hann-windowed segments of nfft samples, overlapping by
+    overlap, averaged over the latest averages segments
+    '''
+
+    def __init__(self, nfft=4096, overlap=0.5, averages=8, fs=SAMP_FREQ):
+        self.nfft = nfft
+        self.hop = max(1, int(nfft * (1 - overlap)))
+        self.fs = fs
+        self.window = np.hanning(nfft).astype(np.float32)
+        # PSD scaling of a windowed periodogram, per Hz
+        self.scale = 1.0 / (fs * float(np.sum(self.window.astype(np.float64) ** 2)))
+        self.segments = np.zeros((averages, nfft), dtype=np.float32)
+        self.num_segments = 0
+        self.pending = np.zeros(nfft, dtype=np.complex64)
+        self.pending_len = 0
+        self.freqs = np.fft.fftshift(np.fft.fftfreq(nfft, 1 / fs))
+        self.updates = 0
+
+
+    def add_samples(self, samples):
+        '''
+        Adds complex samples, computing a segment periodogram for every hop samples once nfft samples are available
+
+        Parameters:
+            samples (array): complex64 samples
+
+        Returns:
+            new_segments (int): the number of periodograms computed
+        '''
+        new_segments = 0
+        pos = 0
+        while (pos < len(samples)):
+            take = min(self.nfft - self.pending_len, len(samples) - pos)
+            self.pending[self.pending_len:self.pending_len + take] = samples[pos:pos + take]
+            self.pending_len += take
+            pos += take
+            if (self.pending_len == self.nfft):
+                spectrum = np.fft.fft(self.pending * self.window)
+                self.segments[self.num_segments % len(self.segments)] = (spectrum.real ** 2 + spectrum.imag ** 2)
+                self.num_segments += 1
+                new_segments += 1
+                # Keep the overlapping tail for the next segment
+                keep = self.nfft - self.hop
+                self.pending[:keep] = self.pending[self.hop:]
+                self.pending_len = keep
+        self.updates += new_segments
+        return new_segments
+
+
+    def psd(self):
+        '''
+        Returns the averaged power spectral density (dB/Hz, full scale = 1.0), ordered from -fs/2 to fs/2
+        '''
+        count = min(self.num_segments, len(self.segments))
+        if (count == 0):
+            return np.full(self.nfft, -np.inf, dtype=np.float32)
+        average = self.segments[:count].mean(axis=0) * self.scale
+        return np.fft.fftshift(10 * np.log10(average + 1e-30)).astype(np.float32)
+
+
+class SharedSpectrum():
+    '''
+    The latest spectrum of a stream in shared memory (/dev/shm/<name>), guarded by a sequence counter
+
+    Layout: header '<QIIdQQQ' (counter, nfft, reserved, fs, packets, lost, reordered) followed by nfft float32 PSD
+    values in dB/Hz from -fs/2 to fs/2. The writer makes the counter odd while it updates; readers retry if the counter
+    was odd or changed while they copied
+    '''
+
+    HEADER = struct.Struct('<QIIdQQQ')
+    BODY = struct.Struct('<IIdQQQ')
+
+    def __init__(self, name, nfft=None, create=False):
+        if create:
+            try:
+                old = shared_memory.SharedMemory(name)
+                old.close()
+                old.unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = shared_memory.SharedMemory(name, create=True, size=self.HEADER.size + 4 * nfft)
+            self.HEADER.pack_into(self.shm.buf, 0, 0, nfft, 0, 0.0, 0, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name)
+            # A reader must not remove the block when it exits, only the receiver that created it
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+            nfft = self.HEADER.unpack_from(self.shm.buf, 0)[1]
+        self.nfft = nfft
+        self.owner = create
+        self.counter = np.ndarray((1,), dtype='<u8', buffer=self.shm.buf)
+        self.values = np.ndarray((nfft,), dtype='<f4', buffer=self.shm.buf, offset=self.HEADER.size)
+
+
+    def write(self, psd, fs, packets, lost, reordered):
+        self.counter[0] += 1
+        self.BODY.pack_into(self.shm.buf, 8, self.nfft, 0, fs, packets, lost, reordered)
+        self.values[:] = psd
+        self.counter[0] += 1
+
+
+    def read(self):
+        '''
+        Returns a consistent copy of the spectrum
+
+        Returns:
+            psd (array): the PSD (dB/Hz), from -fs/2 to fs/2
+            info (dict): fs, packets, lost, reordered
+        '''
+        while True:
+            before = int(self.counter[0])
+            if (before % 2 == 0):
+                _, _, _, fs, packets, lost, reordered = self.HEADER.unpack_from(self.shm.buf, 0)
+                psd = self.values.copy()
+                if (int(self.counter[0]) == before):
+                    return psd, {'fs': fs, 'packets': packets, 'lost': lost, 'reordered': reordered}
+            time.sleep(0)
+
+
+    def close(self):
+        del self.counter, self.values
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class StreamReceiver():
+    '''
+    Receives one radio packet stream on a UDP port into a ring of packets, and feeds the tracker and the analyzer
+
+    ring (uint8 array) holds the latest ring_packets datagrams in arrival order, one per row of MAX_DATAGRAM_BYTES, and
+    lengths their lengths, formats their sample formats (index into COMPRESSIONS) and recv_times when they were
+    received (time.monotonic() after the batch); ring_head is the row the next datagram is received into.
+    samples_per_packet, header_bytes and compression are the frame format of the latest packet
+
+    With sync_addr, the board's control endpoint, drain_latency and network_latency count the drain to receive and
+    send to receive latencies of extended-header packets, using timer_offset from sync()
+
+    sink, if given, is called with the complex64 samples of each run of packets, e.g. a channelizer's process method
+
+    Spectrum datagrams are not kept in the ring: spectra puts them back together into the board's spectrum frames
+    '''
+
+    def __init__(self, port, ip='0.0.0.0', batch=64, ring_packets=1024, analyzer=None, tracker=None, shared=None,
+                 rcvbuf=4 << 20, sync_addr=None, sink=None):
+        self.port = port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind((ip, port))
+        self.sock.setblocking(False)
+        self.batch = min(batch, ring_packets)
+        self.ring = np.zeros((ring_packets, MAX_DATAGRAM_BYTES), dtype=np.uint8)
+        self.ring_bytes = self.ring
+        self.lengths = np.zeros(ring_packets, dtype=np.int64)
+        self.formats = np.zeros(ring_packets, dtype=np.uint8)
+        self.recv_times = np.zeros(ring_packets)
+        self.ring_head = 0
+        # Frame format by datagram length and sample format, as (samples_per_packet, header_bytes), as a compressed
+        # frame can be as long as an uncompressed one of fewer samples
+        self.geometries = {}
+        self.samples_per_packet = None
+        self.header_bytes = None
+        self.compression = None
+        self.analyzer = analyzer
+        self.sink = sink
+        self.tracker = tracker if tracker is not None else SequenceTracker()
+        self.shared = shared
+        self.spectra = SpectrumAssembler()
+        self.bad_packets = 0
+        self.recv_calls = 0
+        self.sync_addr = sync_addr
+        self.timer_offset = None
+        self.sync_rtt = None
+        self.drain_latency = LatencyHistogram()
+        self.network_latency = LatencyHistogram()
+
+        # One iovec/mmsghdr per ring row, so a batch is received in place without building anything
+        self.recvmmsg = load_recvmmsg()
+        base = self.ring.ctypes.data
+        self.iovecs = (iovec * ring_packets)()
+        self.msgs = (mmsghdr * ring_packets)()
+        for i in range(ring_packets):
+            # Oversized datagrams come back with MSG_TRUNC set and are dropped
+            self.iovecs[i].iov_base = base + i * MAX_DATAGRAM_BYTES
+            self.iovecs[i].iov_len = MAX_DATAGRAM_BYTES
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+    def receive_batch(self):
+        '''
+        Receives up to batch waiting datagrams into the ring without blocking
+
+        Returns:
+            rows (slice): the ring rows holding the valid packets received, in arrival order
+        '''
+        first = self.ring_head
+        count = min(self.batch, len(self.ring) - first)
+        self.recv_calls += 1
+        if self.recvmmsg is not None:
+            num = self.recvmmsg(self.sock.fileno(), ctypes.addressof(self.msgs) + first * ctypes.sizeof(mmsghdr),
+                                count, socket.MSG_DONTWAIT, None)
+            if (num < 0):
+                err = ctypes.get_errno()
+                if (err == errno.ENOSYS):
+                    self.recvmmsg = None
+                elif err not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    raise OSError(err, 'recvmmsg failed')
+                return slice(first, first)
+            lengths = [self.msgs[first + i].msg_len for i in range(num)]
+            flags = [self.msgs[first + i].msg_hdr.msg_flags for i in range(num)]
+        else:
+            num = 0
+            lengths, flags = [], []
+            while (num < count):
+                try:
+                    nbytes, msg_flags, _, _ = self.sock.recvmsg_into([self.ring_bytes[first + num]])
+                except BlockingIOError:
+                    break
+                lengths.append(nbytes)
+                flags.append(msg_flags)
+                num += 1
+
+        # Drop datagrams that are not radio packets, moving the later packets up so the valid rows stay contiguous
+        valid = first
+        for i in range(num):
+            length = lengths[i]
+            if (length % 4 == 0 and length > SPEC_HEADER_BYTES and self.ring_bytes[first + i, 2] == SPEC_VERSION and
+                    not (flags[i] & socket.MSG_TRUNC)):
+                if not self.add_spectrum(self.ring_bytes[first + i, :length]):
+                    self.bad_packets += 1
+                continue
+            # Only extended-header frames, a multiple of 4 long, have flags
+            code = int(self.ring_bytes[first + i, 3]) >> EXT_FLAGS_FORMAT_SHIFT if length % 4 == 0 else 0
+            if ((length, code) not in self.geometries and not (flags[i] & socket.MSG_TRUNC)):
+                geometry = parse_geometry(self.ring_bytes[first + i, :length].data)
+                if geometry is not None:
+                    self.geometries[(length, code)] = geometry
+            if ((length, code) in self.geometries and not (flags[i] & socket.MSG_TRUNC)):
+                if (valid != first + i):
+                    self.ring_bytes[valid, :length] = self.ring_bytes[first + i, :length]
+                self.lengths[valid] = length
+                self.formats[valid] = code
+                valid += 1
+            else:
+                self.bad_packets += 1
+        self.recv_times[first:valid] = time.monotonic()
+        self.ring_head = valid % len(self.ring)
+        return slice(first, valid)
+
+
+    def poll(self):
+        '''
+        Receives every waiting datagram and updates the sequence tracking and the spectrum
+
+        Returns:
+            received (int): the number of valid packets received
+        '''
+        received = 0
+        while True:
+            rows = self.receive_batch()
+            num = rows.stop - rows.start
+            if (num == 0):
+                break
+            received += num
+            # Decode each run of one frame format, normally the whole batch, with one view of its rows
+            lengths = self.lengths[rows]
+            formats = self.formats[rows]
+            changes = (lengths[1:] != lengths[:-1]) | (formats[1:] != formats[:-1])
+            bounds = [0] + list(np.flatnonzero(changes) + 1) + [num]
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                length = int(lengths[start])
+                code = int(formats[start])
+                self.samples_per_packet, self.header_bytes = self.geometries[(length, code)]
+                self.compression = COMPRESSIONS[code]
+                packets = self.ring[rows.start + start:rows.start + stop, :length]
+                self.tracker.update(np.ascontiguousarray(packets[:, :2]).view('<u2')[:, 0])
+                if (self.header_bytes == EXT_HEADER_BYTES and self.timer_offset is not None):
+                    self.add_latencies(packets, self.recv_times[rows.start + start:rows.start + stop])
+                if self.analyzer is not None or self.sink is not None:
+                    iq = decode_frames(packets[:, self.header_bytes:], self.samples_per_packet, self.compression,
+                                       packets[:, 3] & EXT_FLAGS_EXPONENT_MASK)
+                    samples = to_complex(iq)
+                    if self.analyzer is not None:
+                        self.analyzer.add_samples(samples)
+                    if self.sink is not None:
+                        self.sink(samples)
+        if received and self.shared is not None and self.analyzer is not None and self.analyzer.num_segments:
+            tracker = self.tracker
+            self.shared.write(self.analyzer.psd(), self.analyzer.fs, tracker.received, tracker.lost, tracker.reordered)
+        return received
+
+
+    def add_spectrum(self, payload):
+        '''
+        Adds a spectrum datagram to the board's spectrum frame it belongs to, publishing each complete frame in shared
+        memory if the FFT sizes match
+
+        Parameters:
+            payload (ndarray): uint8 datagram
+
+        Returns:
+            valid (bool): False if the datagram is not a spectrum datagram
+        '''
+        header = parse_spectrum(payload.data)
+        if header is None:
+            return False
+        self.tracker.update(np.array([header[0]], dtype=np.uint16))
+        if (self.spectra.add(payload, header) and self.shared is not None and self.shared.nfft == header[9]):
+            tracker = self.tracker
+            self.shared.write(self.spectra.psd, SAMP_FREQ, tracker.received, tracker.lost, tracker.reordered)
+        return True
+
+
+    def add_latencies(self, packets, recv_times):
+        '''
+        Counts the drain to receive and send to receive latencies of extended-header packets
+
+        Parameters:
+            packets (ndarray): uint8 rows of the packets
+            recv_times (ndarray): the time.monotonic() each packet was received
+        '''
+        timers = np.ascontiguousarray(packets[:, EXT_TIMER_OFFSET:EXT_TIMER_OFFSET + 8]).view('<u8')[:, 0]
+        send_delays = np.ascontiguousarray(packets[:, EXT_SEND_DELAY_OFFSET:EXT_SEND_DELAY_OFFSET + 4]).view('<u4')[:, 0]
+        drain_latency = recv_times - (timers / TIMER_HZ + self.timer_offset)
+        self.drain_latency.add_array(1e6 * drain_latency)
+        self.network_latency.add_array(1e6 * (drain_latency - send_delays / TIMER_HZ))
+
+
+    def sync(self, probes=3, timeout=0.1):
+        '''
+        Relates the board's timer to this host's clock again, keeping the previous offset if the board does not answer
+
+        Returns:
+            synced (bool): True if the board answered
+        '''
+        if self.sync_addr is None:
+            return False
+        offset, rtt = sync_timer(self.sync_addr, probes, timeout)
+        if offset is None:
+            return False
+        self.timer_offset, self.sync_rtt = offset, rtt
+        return True
+
+
+    def close(self):
+        self.sock.close()
+        if self.shared is not None:
+            self.shared.close()
+
+
+def main(ports, ip='0.0.0.0', nfft=4096, overlap=0.5, averages=8, shm_prefix=None, seq_modulus=SEQ_MODULUS,
+         report_interval=1.0, duration=None, sync_addrs=()):
+    receivers = []
+    selector = selectors.DefaultSelector()
+    for index, port in enumerate(ports):
+        shared = SharedSpectrum(f'{shm_prefix}_{port}', nfft, create=True) if shm_prefix is not None else None
+        # One board control endpoint per stream, or one for all of them
+        sync_addr = sync_addrs[min(index, len(sync_addrs) - 1)] if sync_addrs else None
+        receiver = StreamReceiver(port, ip, analyzer=SpectrumAnalyzer(nfft, overlap, averages),
+                                  tracker=SequenceTracker(seq_modulus), shared=shared, sync_addr=sync_addr)
+        receivers.append(receiver)
+        selector.register(receiver, selectors.EVENT_READ)
+        print(f'Receiving on {ip}:{port}' + (f', spectrum in /dev/shm/{shm_prefix}_{port}' if shared else ''))
+        if sync_addr is not None and not receiver.sync():
+            print(f'    {sync_addr[0]}:{sync_addr[1]} did not answer the timer command, latency is not measured yet')
+
+    start = time.monotonic()
+    next_report = start + report_interval
+    try:
+        while (duration is None or time.monotonic() - start < duration):
+            for key, _ in selector.select(timeout=report_interval):
+                key.fileobj.poll()
+            now = time.monotonic()
+            if (now >= next_report):
+                for receiver in receivers:
+                    tracker = receiver.tracker
+                    counts = tracker.interval()
+                    rate = counts['received'] / (now - next_report + report_interval)
+                    line = (f"{receiver.port}: {rate:8.1f} packets/s, {tracker.received} received, {tracker.lost} lost"
+                            f" ({100 * tracker.loss_rate():.3f} %), {tracker.reordered} out of order;"
+                            f" interval loss {100 * counts['loss_rate']:.3f} % in {counts['bursts']} bursts"
+                            f" (mean {counts['mean_burst']:.1f}, max {counts['max_burst']})")
+                    if receiver.samples_per_packet is not None:
+                        line += f', {receiver.samples_per_packet} samples per packet'
+                        if (receiver.compression != 'none'):
+                            line += f' ({receiver.compression})'
+                    spectra = receiver.spectra
+                    if spectra.psd is not None:
+                        nfft, averages = spectra.header[9], spectra.header[11]
+                        peak = int(np.argmax(spectra.psd))
+                        freq = (peak - nfft // 2) * SAMP_FREQ / nfft
+                        line += (f', {spectra.frames} board spectra ({nfft}-point, {averages} averages,'
+                                 f' {spectra.incomplete} incomplete) peaking at {freq:.1f} Hz, {spectra.psd[peak]:.1f} dB/Hz')
+                    if receiver.analyzer.num_segments:
+                        psd = receiver.analyzer.psd()
+                        peak = int(np.argmax(psd))
+                        line += f', peak {receiver.analyzer.freqs[peak]:.1f} Hz at {psd[peak]:.1f} dB/Hz'
+                    if receiver.drain_latency.count:
+                        drain, network = receiver.drain_latency, receiver.network_latency
+                        line += (f'; drain to receive median {drain.percentile(50) / 1e3:.2f} ms'
+                                 f' (99% {drain.percentile(99) / 1e3:.2f} ms), send to receive median'
+                                 f' {network.percentile(50) / 1e3:.2f} ms (99% {network.percentile(99) / 1e3:.2f} ms),'
+                                 f' sync within {receiver.sync_rtt * 1e3 / 2:.2f} ms')
+                        drain.reset()
+                        network.reset()
+                    print(line)
+                    # Follow the drift between the board's crystal and this host's clock
+                    receiver.sync()
+                next_report = now + report_interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for receiver in receivers:
+            receiver.close()
+    return receivers
+
+
+if __name__ == '__main__':
+    description = "UDP stream receiver - Receives radio packet streams, reports packet loss and reordering, and computes the averaged spectrum of each stream"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-p', '--ports', nargs='+', type=int, help='UDP ports to receive, one stream per port', default=[25344])
+    parser.add_argument('-i', '--ip', help='Local IP address to receive on', default='0.0.0.0')
+    parser.add_argument('-n', '--nfft', type=int, help='FFT size of each PSD segment', default=4096)
+    parser.add_argument('-o', '--overlap', type=float, help='Overlap of consecutive PSD segments (0 to <1)', default=0.5)
+    parser.add_argument('-a', '--averages', type=int, help='Number of segments averaged into the PSD', default=8)
+    parser.add_argument('--shm', nargs='?', const='linux_sdr_spectrum', help='Publish each spectrum in shared memory as /dev/shm/<SHM>_<port>', default=None)
+    parser.add_argument('--seq_modulus', type=int, help='Value at which the sender wraps the sequence number', default=SEQ_MODULUS)
+    parser.add_argument('-t', '--time', type=float, help='Seconds to run (default: until Ctrl-C)', default=None)
+    parser.add_argument('--sync', nargs='+', help="Control endpoint HOST:PORT of each stream's board (one for all streams, or one per port), to measure the latency of extended-header packets", default=[])
+    args = parser.parse_args()
+
+    sync_addrs = [(addr.rpartition(':')[0], int(addr.rpartition(':')[2])) for addr in args.sync]
+    main(args.ports, args.ip, args.nfft, args.overlap, args.averages, args.shm, args.seq_modulus, duration=args.time,
+         sync_addrs=sync_addrs)